@@ -2,23 +2,54 @@
 # -*- coding: utf-8 -*-
 
 import os
-import uuid
+import gzip
+import time
+import functools
+import zipfile
 import tempfile
-from datetime import datetime
-from flask import Flask, request, jsonify, send_file, render_template
+from datetime import date, datetime, timezone
+from flask import Flask, Request, Response, g, request, jsonify, make_response, send_file, render_template, current_app, stream_with_context
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 import logging
 
 # 导入日历生成器模块
-from calendar_generator import BJTUCalendarGenerator
+from calendar_generator import BJTUCalendarGenerator, Parser, Writer, load_html, output_fingerprint
 from caldav_integration import radicale_integration
+from credential_pool import LoginThrottle, credential_pool
+from result_cache import ResultCache, make_cache_key
+from artifact_store import ArtifactStore
+from feed_store import FeedStore
+from jobs import JobQueue, QueueFull
+from batch_converter import collect_inputs, stream_batch_zip
+from free_slots import FreeSlotFinder, LESSONS, WEEKDAYS, parse_range
+from holiday_table import HOLIDAY_TABLE
+from section_index import SectionIndex
+from occurrences import expand, occurrence_to_dict
+import metrics
+from metrics import stage
+from profiling import PROFILE_HEADER, Profiler, profile_secret
+
+class SpooledRequest(Request):
+    """上传文件先缓存在内存中，超过阈值才落盘"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        max_size = current_app.config['UPLOAD_SPOOL_MAX_SIZE']
+        return tempfile.SpooledTemporaryFile(max_size=max_size, mode='rb+')
 
 app = Flask(__name__)
+app.request_class = SpooledRequest
 CORS(app)
 
+# 前面的反向代理层数（如 nginx 为 1），设置后按 X-Forwarded-For 取客户端地址（用于限制校验密码失败次数）
+PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+if PROXY_FIX_X_FOR:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_X_FOR)
+
 # 配置
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['UPLOAD_SPOOL_MAX_SIZE'] = int(os.environ.get('UPLOAD_SPOOL_MAX_SIZE', 2 * 1024 * 1024))  # 超过2MB的上传才写入临时文件
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'outputs'
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -27,6 +58,29 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-i
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
+# 生成文件存储：分目录保存，后台线程按保留时间和总大小清理
+artifact_store = ArtifactStore(app.config['OUTPUT_FOLDER'], upload_folder=app.config['UPLOAD_FOLDER'])
+artifact_store.start_sweeper()
+
+# ICS结果缓存：相同课表重复上传时直接返回已生成的文件
+result_cache = ResultCache(
+    artifact_store,
+    max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 4096)),
+    ttl=int(os.environ.get('RESULT_CACHE_TTL', 7 * 24 * 3600)),
+)
+
+# 后台生成任务：状态保存在 outputs/ 下的 SQLite 中，各 worker 共享
+job_queue = JobQueue(os.environ.get('JOBS_DB_PATH', os.path.join(app.config['OUTPUT_FOLDER'], '.jobs.sqlite3')))
+
+# 日历订阅：固定的订阅标识 -> 最近一次生成的ICS文件
+feed_store = FeedStore(os.environ.get('FEEDS_DB_PATH', os.path.join(app.config['OUTPUT_FOLDER'], '.feeds.sqlite3')))
+
+# 教学班索引：每次成功解析后记录各教学班的课程记录，用于发现不一致和生成合并日历
+section_index = SectionIndex(os.environ.get('SECTION_INDEX_PATH', os.path.join(app.config['OUTPUT_FOLDER'], '.sections.sqlite3')))
+
+# 按需性能分析：抽样或带签名头的请求（签名密钥见 profiling.profile_secret）
+profiler = Profiler(secret=profile_secret())
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -34,6 +88,23 @@ logger = logging.getLogger(__name__)
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'html', 'htm'}
 
+# 更新CalDAV日历时校验密码失败的次数限制（按用户名和客户端地址）
+login_throttle = LoginThrottle()
+
+# CalDAV账户中的日历名称
+CALDAV_CALENDAR_NAME = '课表'
+
+# 订阅地址的缓存时间（秒），日历应用和代理在这段时间内不会重复请求
+FEED_MAX_AGE = int(os.environ.get('FEED_MAX_AGE', 3600))
+
+# 是否在响应中附带各阶段耗时的 Server-Timing 头
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') != '0'
+
+# 动态压缩的响应类型、最小大小（字节）和压缩级别；ICS 文件使用生成时写好的压缩版本
+COMPRESS_MIMETYPES = {'application/json', 'text/html'}
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+
 def allowed_file(filename):
     """检查文件扩展名是否允许"""
     return '.' in filename and \
@@ -44,7 +115,70 @@ def index():
     """主页"""
     return render_template('index.html')
 
+def upload_result(ics_filename):
+    """上传成功的响应内容"""
+    return {
+        'success': True,
+        'message': '课表解析成功',
+        'ics_file': ics_filename,
+        'download_url': f'/api/download/{ics_filename}'
+    }
+
+def generate_and_store(html, semester_start, cache_key):
+    """解析课表、生成并保存ICS文件，同步上传和后台任务共用"""
+    courses, chunks = BJTUCalendarGenerator().iter_from_html(html, semester_start)
+    ics_content = "".join(chunks)
+    index_sections(courses)
+    
+    ics_filename = result_cache.filename_for(cache_key)
+    with stage('file_write'):
+        ics_path = artifact_store.write_text(ics_filename, ics_content,
+                                             metadata={'semester_start': semester_start.strftime('%Y-%m-%d')})
+    result_cache.put(cache_key, ics_filename)
+    
+    logger.info(f"ICS文件已生成: {ics_path}")
+    return upload_result(ics_filename)
+
+def index_sections(courses):
+    """把解析结果交给教学班索引的后台线程写入，不等待写完；失败不影响生成"""
+    try:
+        with stage('section_index'):
+            if not section_index.submit(courses):
+                metrics.count('section_index_dropped')
+                logger.warning("教学班索引写入队列已满，丢弃本次解析结果")
+    except Exception as e:
+        logger.warning(f"写入教学班索引失败: {str(e)}")
+
+def buffered_view(view, *args, **kwargs):
+    """
+    执行接口并生成完整的响应内容：流式响应（行内上传、批量 zip）的内容在接口返回之后才生成，
+    分析时先在 cProfile 下生成完，结果和 Server-Timing 才包含生成日历和写出的耗时
+    """
+    response = make_response(view(*args, **kwargs))
+    if response.is_streamed:
+        response.make_sequence()
+    return response
+
+def profiled(view):
+    """需要时在 cProfile 下执行接口，响应头 X-Profile-Id 给出结果文件名"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not profiler.should_profile(request.headers.get(PROFILE_HEADER)):
+            return view(*args, **kwargs)
+        response, profile_name = profiler.run(request.endpoint, buffered_view, view, *args, **kwargs)
+        if profile_name:
+            response.headers['X-Profile-Id'] = profile_name
+        return response
+    return wrapper
+
+def wants_inline():
+    """行内模式：mode=inline，或 Accept 头优先 text/calendar"""
+    if request.values.get('mode') == 'inline':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'text/calendar']) == 'text/calendar'
+
 @app.route('/api/upload', methods=['POST'])
+@profiled
 def upload_file():
     """上传课表HTML文件并生成ICS文件"""
     try:
@@ -58,67 +192,234 @@ def upload_file():
         if not allowed_file(file.filename):
             return jsonify({'error': '只支持HTML文件'}), 400
         
-        # 保存上传的文件
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
+        logger.info(f"文件已上传: {file.filename}")
         
-        logger.info(f"文件已上传: {file_path}")
-        
-        # 生成ICS文件
+        # 生成ICS文件（直接从上传流解析，不落盘）
         try:
             generator = BJTUCalendarGenerator()
-            ics_content = generator.generate_from_html(file_path)
-            
-            # 保存ICS文件
-            ics_filename = f"{uuid.uuid4()}.ics"
-            ics_path = os.path.join(app.config['OUTPUT_FOLDER'], ics_filename)
+            with stage('upload_read'):
+                html = load_html(file.stream)
+            semester_start = generator.resolve_semester_start()
             
-            with open(ics_path, 'w', encoding='utf-8') as f:
-                f.write(ics_content)
+            # 相同课表已生成过时直接返回，不再解析
+            with stage('cache_lookup'):
+                cache_key = make_cache_key(html, semester_start, output_fingerprint())
+                ics_filename = result_cache.get(cache_key)
+            inline = wants_inline()
+            if ics_filename:
+                metrics.count('result_cache_hit')
+                logger.info(f"命中ICS缓存: {ics_filename}")
+                if inline:
+                    file_path = artifact_store.resolve(ics_filename)
+                    if file_path:
+                        return send_calendar(file_path)
+                else:
+                    return jsonify(upload_result(ics_filename))
+            metrics.count('result_cache_miss')
             
-            logger.info(f"ICS文件已生成: {ics_path}")
+            # 行内模式：直接在响应中流式返回ICS内容，不写入outputs/，也不写入教学班索引
+            if inline:
+                courses, chunks = generator.iter_from_html(html, semester_start)
+                response = Response(
+                    stream_with_context(chunk.encode('utf-8') for chunk in chunks),
+                    mimetype='text/calendar',
+                    headers={
+                        'Content-Disposition': "attachment; filename=calendar.ics; filename*=UTF-8''%E8%AF%BE%E8%A1%A8.ics",
+                        'X-Course-Count': str(len(courses)),
+                    }
+                )
+                response.cache_control.no_store = True
+                return response
             
-            # 清理上传的HTML文件
-            os.remove(file_path)
+            # 任务模式：放入后台队列，立即返回任务ID
+            if request.values.get('mode') == 'job':
+                try:
+                    job_id = job_queue.submit(generate_and_store, html, semester_start, cache_key)
+                except QueueFull as e:
+                    metrics.count('job_rejected')
+                    return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+                logger.info(f"已提交生成任务: {job_id}")
+                return jsonify({
+                    'success': True,
+                    'job_id': job_id,
+                    'status': 'queued',
+                    'status_url': f'/api/jobs/{job_id}'
+                }), 202
             
-            return jsonify({
-                'success': True,
-                'message': '课表解析成功',
-                'ics_file': ics_filename,
-                'download_url': f'/api/download/{ics_filename}'
-            })
+            return jsonify(generate_and_store(html, semester_start, cache_key))
             
         except Exception as e:
             logger.error(f"生成ICS文件时出错: {str(e)}")
-            # 清理上传的文件
-            if os.path.exists(file_path):
-                os.remove(file_path)
             return jsonify({'error': f'解析课表失败: {str(e)}'}), 500
+        finally:
+            file.close()
             
     except Exception as e:
         logger.error(f"上传文件时出错: {str(e)}")
         return jsonify({'error': f'上传失败: {str(e)}'}), 500
 
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """查询生成任务状态：queued / running / done / failed"""
+    try:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': '任务不存在'}), 404
+        return jsonify(job)
+    except Exception as e:
+        logger.error(f"查询任务状态时出错: {str(e)}")
+        return jsonify({'error': f'查询任务失败: {str(e)}'}), 500
+
+@app.route('/api/batch', methods=['POST'])
+def batch_convert():
+    """批量转换：接收zip或多个HTML文件，返回包含ICS文件和manifest.json的zip"""
+    try:
+        files = request.files.getlist('files') or request.files.getlist('file')
+        if not files:
+            return jsonify({'error': '没有选择文件'}), 400
+        
+        try:
+            inputs = collect_inputs(files)
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({'error': f'读取文件失败: {str(e)}'}), 400
+        if not inputs:
+            return jsonify({'error': '没有找到HTML文件'}), 400
+        
+        logger.info(f"批量转换: {len(inputs)} 个文件")
+        semester_start = BJTUCalendarGenerator().resolve_semester_start()
+        
+        return Response(
+            stream_with_context(stream_batch_zip(inputs, semester_start, on_parsed=index_sections)),
+            mimetype='application/zip',
+            headers={'Content-Disposition': "attachment; filename=calendars.zip; filename*=UTF-8''%E8%AF%BE%E8%A1%A8.zip"}
+        )
+        
+    except Exception as e:
+        logger.error(f"批量转换时出错: {str(e)}")
+        return jsonify({'error': f'批量转换失败: {str(e)}'}), 500
+
+def negotiate_encoding(file_path):
+    """按 Accept-Encoding 选择预先压缩好的版本，返回 (发送的文件路径, 内容编码或 None)"""
+    variants = artifact_store.variants(file_path)
+    if variants:
+        encoding = request.accept_encodings.best_match(list(variants) + ['identity'], default='identity')
+        if encoding in variants:
+            return variants[encoding], encoding
+    return file_path, None
+
+def set_content_encoding(response, encoding):
+    """标记内容编码，响应随 Accept-Encoding 变化"""
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def send_calendar(file_path):
+    """以附件形式发送已生成的ICS文件，按 Accept-Encoding 选择压缩版本"""
+    artifact_store.record_access(file_path)
+    send_path, encoding = negotiate_encoding(file_path)
+    response = send_file(
+        send_path,
+        as_attachment=True,
+        download_name='课表.ics',
+        mimetype='text/calendar'
+    )
+    return set_content_encoding(response, encoding)
+
 @app.route('/api/download/<filename>')
 def download_file(filename):
     """下载ICS文件"""
     try:
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-        if not os.path.exists(file_path):
+        file_path = artifact_store.resolve(filename)
+        if not file_path:
             return jsonify({'error': '文件不存在'}), 404
         
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name='课表.ics',
-            mimetype='text/calendar'
-        )
+        return send_calendar(file_path)
     except Exception as e:
         logger.error(f"下载文件时出错: {str(e)}")
         return jsonify({'error': f'下载失败: {str(e)}'}), 500
 
+@app.route('/api/feed', methods=['POST'])
+def subscribe_calendar():
+    """
+    订阅生成的ICS文件：没有给出订阅标识时新建订阅；
+    给出订阅标识和修改密钥时把原来的订阅指向新文件，日历应用下次轮询时就能看到新课表
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not data or 'ics_file' not in data:
+            return jsonify({'error': '缺少ICS文件参数'}), 400
+        
+        ics_filename = data['ics_file']
+        if not artifact_store.resolve(ics_filename):
+            return jsonify({'error': 'ICS文件不存在'}), 404
+        
+        token = data.get('feed_token')
+        key = data.get('feed_key')
+        if token:
+            if not key or not feed_store.update(token, key, ics_filename):
+                return jsonify({'error': '订阅标识或修改密钥不正确'}), 403
+            created = False
+        else:
+            token, key = feed_store.create(ics_filename)
+            created = True
+        
+        return jsonify({
+            'success': True,
+            'created': created,
+            'feed_token': token,
+            'feed_key': key,
+            'feed_url': f'/api/feed/{token}.ics'
+        })
+    except Exception as e:
+        logger.error(f"创建订阅时出错: {str(e)}")
+        return jsonify({'error': f'创建订阅失败: {str(e)}'}), 500
+
+@app.route('/api/feed/<token>.ics')
+def calendar_feed(token):
+    """日历订阅地址：日历应用定期轮询，内容未变化时返回 304，不读取文件"""
+    try:
+        subscription = feed_store.lookup(token)
+        if subscription:
+            ics_filename, updated_at = subscription
+        else:
+            # 兼容之前直接用ICS文件名作为标识的订阅地址
+            ics_filename, updated_at = f"{token}.ics", 0
+        file_path = artifact_store.resolve(ics_filename)
+        if not file_path:
+            return jsonify({'error': '日历不存在'}), 404
+        
+        # 不同内容编码是不同的表示，强 ETag 也要区分
+        send_path, encoding = negotiate_encoding(file_path)
+        etag = artifact_store.etag(file_path)
+        if encoding:
+            etag = f"{etag}-{encoding}"
+        # 订阅改指向较早生成的文件时，修改时间也要晚于上次发送的版本
+        last_modified = datetime.fromtimestamp(int(max(os.path.getmtime(file_path), updated_at)), timezone.utc)
+        artifact_store.record_access(file_path)
+        
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = FEED_MAX_AGE
+            response.expires = time.time() + FEED_MAX_AGE
+            return set_content_encoding(response, None)
+        
+        response = send_file(
+            send_path,
+            mimetype='text/calendar',
+            download_name='课表.ics',
+            etag=etag,
+            last_modified=last_modified,
+            max_age=FEED_MAX_AGE,
+            conditional=False
+        )
+        return set_content_encoding(response, encoding)
+    except Exception as e:
+        logger.error(f"读取订阅日历时出错: {str(e)}")
+        return jsonify({'error': f'读取日历失败: {str(e)}'}), 500
+
 @app.route('/api/caldav/create', methods=['POST'])
 def create_caldav_account():
     """创建CalDAV账户"""
@@ -128,27 +429,40 @@ def create_caldav_account():
             return jsonify({'error': '缺少ICS文件参数'}), 400
         
         ics_filename = data['ics_file']
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], ics_filename)
+        file_path = artifact_store.resolve(ics_filename)
         
-        if not os.path.exists(file_path):
+        if not file_path:
             return jsonify({'error': 'ICS文件不存在'}), 404
+        artifact_store.record_access(file_path)
         
-        # 生成CalDAV账户信息
-        account_id = str(uuid.uuid4())
-        username = f"user_{account_id[:8]}"
-        password = str(uuid.uuid4())[:12]
+        # 生成CalDAV账户信息（预先生成的凭据，无需等待密码哈希）
+        with stage('credentials'):
+            try:
+                credentials = credential_pool.acquire()
+            except TimeoutError as e:
+                logger.error(f"生成CalDAV凭据超时: {str(e)}")
+                return jsonify({'error': '服务器繁忙，请稍后重试'}), 503, {'Retry-After': '5'}
+        account_id, username, password = credentials.account_id, credentials.username, credentials.password
         
         # 读取ICS文件内容
         with open(file_path, 'r', encoding='utf-8') as f:
             ics_content = f.read()
         
         # 创建Radicale用户
-        if not radicale_integration.create_user(username, password):
+        if not radicale_integration.create_user(username, password, credentials.password_hash):
             return jsonify({'error': '创建CalDAV用户失败'}), 500
         
-        # 上传日历到Radicale
-        calendar_name = '课表'
-        if not radicale_integration.upload_calendar(username, calendar_name, ics_content):
+        # 上传日历到Radicale，记录生成日历时的学期开始日期，之后更新课表时沿用；
+        # 文件可能是更早（默认学期不同时）生成的缓存，使用与文件一起保存的日期
+        semester_start = artifact_store.metadata(file_path).get('semester_start')
+        if semester_start:
+            semester_start = date.fromisoformat(semester_start)
+        else:
+            # 升级前生成的文件没有保存学期开始日期：不记录，第一次更新时按更新请求的日期写入
+            semester_start = None
+            logger.warning(f"ICS文件 {ics_filename} 没有记录学期开始日期")
+        if not radicale_integration.upload_calendar(username, CALDAV_CALENDAR_NAME, ics_content, password,
+                                                    semester_start=semester_start):
             return jsonify({'error': '上传日历失败'}), 500
         
         # 获取服务器URL（从环境变量或使用默认值）
@@ -189,14 +503,318 @@ def create_caldav_account():
         logger.error(f"创建CalDAV账户时出错: {str(e)}")
         return jsonify({'error': f'创建账户失败: {str(e)}'}), 500
 
+@app.route('/api/caldav/update', methods=['POST'])
+def update_caldav_calendar():
+    """用新的课表更新已有CalDAV账户的日历：只写入变化的事件，并返回差异"""
+    try:
+        username = request.form.get('username', '')
+        password = request.form.get('password', '')
+        if not username or not password:
+            return jsonify({'error': '缺少账户参数'}), 400
+        
+        file = request.files.get('file')
+        if file is None or file.filename == '':
+            return jsonify({'error': '没有选择文件'}), 400
+        if not allowed_file(file.filename):
+            return jsonify({'error': '只支持HTML文件'}), 400
+        
+        # 失败次数过多时不再校验：每次校验都要在补充凭据的进程池中算一次 bcrypt
+        throttle_keys = (f"user:{username}", f"addr:{request.remote_addr}")
+        retry_after = login_throttle.retry_after(*throttle_keys)
+        if retry_after:
+            return jsonify({'error': '密码错误次数过多，请稍后重试'}), 429, {'Retry-After': str(retry_after)}
+        
+        password_hash = radicale_integration.user_store.get(username)
+        try:
+            verified = bool(password_hash) and credential_pool.verify(password, password_hash)
+        except TimeoutError as e:
+            logger.error(f"校验CalDAV密码超时: {str(e)}")
+            return jsonify({'error': '服务器繁忙，请稍后重试'}), 503, {'Retry-After': '5'}
+        if not verified:
+            login_throttle.failed(*throttle_keys)
+            return jsonify({'error': '用户名或密码错误'}), 401
+        login_throttle.succeeded(throttle_keys[0])
+        
+        try:
+            html = load_html(file.stream)
+        finally:
+            file.close()
+        courses = Parser(html).parse_courses()
+        if not courses:
+            return jsonify({'error': '未能从HTML文件中解析出课程信息'}), 400
+        index_sections(courses)
+        
+        # 学期开始日期：请求中指定的 > 创建账户时记录的 > 默认值（默认值每年9月变化，会改动所有事件）
+        try:
+            semester_start = request.form.get('semester_start')
+            semester_start = date.fromisoformat(semester_start) if semester_start else \
+                radicale_integration.calendar_state.semester_start(username, CALDAV_CALENDAR_NAME)
+        except ValueError:
+            return jsonify({'error': '日期格式应为 YYYY-MM-DD'}), 400
+        if semester_start is None:
+            semester_start = BJTUCalendarGenerator().resolve_semester_start().date()
+            logger.warning(f"账户 {username} 没有记录学期开始日期，使用默认值 {semester_start}")
+        objects = [
+            (uid, body, {
+                'course_id': course.course_id,
+                'class_id': course.class_id,
+                'weekday': course.weekday,
+                'lesson': course.lesson,
+                'summary': f"{course.name} - {course.teacher}",
+                'location': course.location,
+            })
+            for uid, course, body in Writer(courses, datetime.combine(semester_start, datetime.min.time())).iter_objects()
+        ]
+        
+        diff = radicale_integration.sync_calendar(username, password, CALDAV_CALENDAR_NAME, objects,
+                                                  semester_start=semester_start)
+        if diff is None:
+            return jsonify({'error': '更新日历失败'}), 500
+        
+        return jsonify({
+            'success': True,
+            'message': f"新增 {len(diff['added'])} 个、修改 {len(diff['modified'])} 个、删除 {len(diff['deleted'])} 个事件"
+                       + (f"，{len(diff['unverified'])} 个无法比较已重新写入" if diff['unverified'] else ""),
+            'semester_start': semester_start.isoformat(),
+            'diff': diff
+        })
+        
+    except Exception as e:
+        logger.error(f"更新CalDAV日历时出错: {str(e)}")
+        return jsonify({'error': f'更新日历失败: {str(e)}'}), 500
+
+@app.route('/api/schedule', methods=['POST'])
+def schedule():
+    """按周（week=N）或日期范围（start=YYYY-MM-DD&end=YYYY-MM-DD）查询课表中每一次上课，落在节假日的标记为 holiday"""
+    try:
+        file = request.files.get('file')
+        if file is None or file.filename == '':
+            return jsonify({'error': '没有选择文件'}), 400
+        if not allowed_file(file.filename):
+            return jsonify({'error': '只支持HTML文件'}), 400
+        
+        try:
+            week = request.values.get('week', type=int)
+            first_day = request.values.get('start')
+            last_day = request.values.get('end') or first_day
+            first_day = date.fromisoformat(first_day) if first_day else None
+            last_day = date.fromisoformat(last_day) if last_day else None
+        except ValueError:
+            return jsonify({'error': '日期格式应为 YYYY-MM-DD'}), 400
+        if 'week' in request.values and week is None:
+            return jsonify({'error': 'week 应为整数'}), 400
+        
+        try:
+            html = load_html(file.stream)
+        finally:
+            file.close()
+        courses = Parser(html).parse_courses()
+        if not courses:
+            return jsonify({'error': '未能从HTML文件中解析出课程信息'}), 400
+        
+        semester_start = BJTUCalendarGenerator().resolve_semester_start()
+        try:
+            with stage('expand'):
+                occurrences = expand(courses, semester_start)
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 503
+        if week is not None:
+            occurrences = occurrences.in_week(week)
+        if first_day is not None:
+            occurrences = occurrences.between(first_day, last_day)
+        
+        records = occurrences.records()
+        return jsonify({
+            'success': True,
+            'semester_start': semester_start.date().isoformat(),
+            'week': week,
+            'start': first_day.isoformat() if first_day else None,
+            'end': last_day.isoformat() if last_day else None,
+            'count': sum(1 for record in records if not record.holiday),
+            'occurrences': [
+                occurrence_to_dict(record, HOLIDAY_TABLE.names.get(record.start.date())) for record in records
+            ]
+        })
+        
+    except Exception as e:
+        logger.error(f"查询课表时出错: {str(e)}")
+        return jsonify({'error': f'查询课表失败: {str(e)}'}), 500
+
+@app.route('/api/free-slots', methods=['POST'])
+def free_slots():
+    """多份课表（HTML文件或zip）的共同空闲时段，没有时返回冲突人数最少的时段"""
+    try:
+        files = request.files.getlist('files') or request.files.getlist('file')
+        if not files:
+            return jsonify({'error': '没有选择文件'}), 400
+        
+        try:
+            weeks = parse_range(request.values.get('weeks'), 1, 63)
+            weekdays = parse_range(request.values.get('weekdays'), 1, WEEKDAYS)
+            lessons = parse_range(request.values.get('lessons'), 1, LESSONS)
+        except ValueError as e:
+            return jsonify({'error': f'参数错误: {str(e)}'}), 400
+        
+        try:
+            inputs = collect_inputs(files)
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({'error': f'读取文件失败: {str(e)}'}), 400
+        if not inputs:
+            return jsonify({'error': '没有找到HTML文件'}), 400
+        
+        # 参与者以文件名区分，同名文件追加序号
+        timetables = {}
+        errors = []
+        with stage('html_parse_all'):
+            for name, raw in inputs:
+                stem = participant = os.path.splitext(os.path.basename(name))[0] or 'timetable'
+                suffix = 2
+                while participant in timetables:
+                    participant = f"{stem} ({suffix})"
+                    suffix += 1
+                try:
+                    courses = Parser(raw).parse_courses()
+                except Exception as e:
+                    errors.append({'file': name, 'error': str(e)})
+                    continue
+                if not courses:
+                    errors.append({'file': name, 'error': '未能从HTML文件中解析出课程信息'})
+                    continue
+                timetables[participant] = courses
+        if not timetables:
+            return jsonify({'error': '没有可用的课表', 'errors': errors}), 400
+        
+        with stage('free_slots'):
+            result = FreeSlotFinder(timetables, weeks, weekdays, lessons).find()
+        return jsonify(dict(result, success=True, errors=errors))
+        
+    except Exception as e:
+        logger.error(f"查找空闲时间时出错: {str(e)}")
+        return jsonify({'error': f'查找空闲时间失败: {str(e)}'}), 500
+
+@app.route('/api/sections/disagreements')
+def section_disagreements():
+    """教学班索引中内容不一致的教学班（如新导出的课表换了教室）"""
+    try:
+        limit = request.args.get('limit', 100, type=int)
+        return jsonify({'success': True, 'sections': section_index.disagreements(limit)})
+    except Exception as e:
+        logger.error(f"查询教学班索引时出错: {str(e)}")
+        return jsonify({'error': f'查询失败: {str(e)}'}), 500
+
+@app.route('/api/sections/calendar')
+def section_calendar():
+    """
+    由教学班索引生成合并日历，不需要上传或重新解析课表：
+    section=<课程号>-<班号>（可重复）指定教学班，course=<课程号>（可重复）包含该课程的所有教学班
+    """
+    try:
+        sections = []
+        for value in request.args.getlist('section'):
+            course_id, _, class_id = value.rpartition('-')
+            if not course_id or not class_id:
+                return jsonify({'error': f'教学班格式应为 课程号-班号: {value}'}), 400
+            sections.append((course_id, class_id))
+        course_ids = request.args.getlist('course')
+        if not sections and not course_ids:
+            return jsonify({'error': '缺少 section 或 course 参数'}), 400
+        
+        with stage('section_lookup'):
+            courses = section_index.canonical(sections, course_ids)
+        if not courses:
+            return jsonify({'error': '索引中没有这些教学班'}), 404
+        
+        semester_start = BJTUCalendarGenerator().resolve_semester_start()
+        with stage('render'):
+            ics_content = "".join(Writer(courses, semester_start).iter_ics())
+        response = Response(ics_content, mimetype='text/calendar', headers={
+            'Content-Disposition': "attachment; filename=sections.ics; filename*=UTF-8''%E5%90%88%E5%B9%B6%E8%AF%BE%E8%A1%A8.ics",
+            'X-Course-Count': str(len(courses)),
+        })
+        return response
+    except Exception as e:
+        logger.error(f"生成合并日历时出错: {str(e)}")
+        return jsonify({'error': f'生成合并日历失败: {str(e)}'}), 500
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.start_timings()
+
+@app.after_request
+def record_request(response):
+    """
+    按接口统计请求数和耗时，并把各阶段耗时写入 Server-Timing 头
+    （在其他 after_request 之后执行，包含响应压缩的耗时）
+
+    流式响应的内容在发出响应头之后才生成：Server-Timing 只能包含之前的阶段，并用 stream 项标明，
+    请求耗时在内容发送完毕、响应关闭时才记录，此时的完整阶段耗时写入 debug 日志
+    """
+    started = g.pop('request_started', None)
+    if started is not None and response.is_streamed:
+        timings = dict(metrics.peek_timings())
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = metrics.server_timing(timings) + ', stream;desc="body timed on close"'
+        endpoint, method, status = request.endpoint or 'unmatched', request.method, response.status_code
+
+        def finish():
+            elapsed = time.perf_counter() - started
+            metrics.observe_request(endpoint, method, status, elapsed)
+            logger.debug(f"流式响应 {endpoint} 完成: {metrics.server_timing(metrics.collect_timings(), elapsed * 1000)}")
+
+        response.call_on_close(finish)
+        return response
+    timings = metrics.collect_timings()
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        metrics.observe_request(request.endpoint or 'unmatched', request.method, response.status_code, elapsed)
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = metrics.server_timing(timings, elapsed * 1000)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """压缩较大的 JSON、HTML 响应"""
+    if (response.mimetype not in COMPRESS_MIMETYPES or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings.quality('gzip') <= 0:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 @app.route('/api/health')
 def health_check():
-    """健康检查"""
+    """健康检查（只报告内存中的计数，不查询数据库）"""
+    try:
+        sections = section_index.counters()
+    except Exception as e:
+        logger.warning(f"读取教学班索引计数失败: {str(e)}")
+        sections = {'error': str(e)}
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'result_cache': result_cache.stats(),
+        'artifacts': artifact_store.stats(),
+        'jobs': job_queue.stats(),
+        'credentials': credential_pool.stats(),
+        'sections': sections
     })
 
+@app.route('/api/metrics')
+def prometheus_metrics():
+    """Prometheus 指标（多 worker 时汇总所有进程）"""
+    try:
+        content, content_type = metrics.render()
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 503
+    return Response(content, content_type=content_type)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
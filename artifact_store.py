@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+生成文件（outputs/）的存储与清理
+
+文件按文件名哈希的前两位分散到 256 个子目录（outputs/ab/<文件名>），单个目录不会积累几十万个文件。
+下载时用 os.utime 记录访问时间（不依赖挂载选项中的 atime），
+清理线程（或 `python artifact_store.py sweep` 命令）定期删除：
+  - 超过最长保留时间未被访问的文件
+  - 总大小超过上限时，最久未访问的文件（LRU）
+  - 进程崩溃遗留的临时文件和 uploads/ 中的孤立上传文件
+
+写入时同时计算内容的强 ETag，保存在同目录的 <文件名>.etag 中，订阅接口处理条件请求时只需读取这个小文件；
+并写好压缩版本 <文件名>.gz（以及安装了 brotli 时的 <文件名>.br），下载时按 Accept-Encoding 直接发送，不在请求中压缩。
+生成参数（如学期开始日期）可以一起保存在 <文件名>.meta 中。
+附属文件的大小计入主文件，随主文件一起淘汰和删除。
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 文件最长保留时间（按最后访问时间计算，秒）
+OUTPUT_MAX_AGE = int(os.environ.get('OUTPUT_MAX_AGE', 30 * 24 * 3600))
+# outputs/ 总大小上限（字节）
+OUTPUT_MAX_BYTES = int(os.environ.get('OUTPUT_MAX_BYTES', 1024 * 1024 * 1024))
+# 清理间隔（秒），0 表示不在应用进程中启动清理线程（改用定时任务执行命令行）
+OUTPUT_SWEEP_INTERVAL = int(os.environ.get('OUTPUT_SWEEP_INTERVAL', 600))
+# 临时文件、孤立上传文件超过该时间才清理，避免删掉正在写入的文件
+ORPHAN_MAX_AGE = 3600
+# 同一文件两次记录访问时间的最小间隔，热门文件不必每次下载都写元数据
+ACCESS_RESOLUTION = 60
+# 生成时写入的压缩版本，逗号分隔：gzip、br（需要安装 brotli），留空表示不压缩
+OUTPUT_COMPRESSION = os.environ.get('OUTPUT_COMPRESSION', 'br,gzip')
+# 只生成一次、之后多次下载，gzip 使用最高压缩级别；
+# brotli 10、11 级压缩率略高但耗时是 6 级的十倍以上（见 benchmark.py --only compression）
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 6
+
+TMP_SUFFIX = '.tmp'
+ETAG_SUFFIX = '.etag'
+# 生成参数（如学期开始日期），JSON
+META_SUFFIX = '.meta'
+# 内容编码 -> 压缩文件后缀
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+# 附属文件（随主文件一起删除）
+SIDECAR_SUFFIXES = (ETAG_SUFFIX, META_SUFFIX) + tuple(ENCODING_SUFFIXES.values())
+SWEEP_LOCK_NAME = '.sweep.lock'
+
+def content_etag(data: bytes) -> str:
+    """内容的强 ETag"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """按内容编码压缩（gzip 不写入时间戳，相同内容得到相同结果）"""
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise ValueError(f"不支持的内容编码: {encoding}")
+
+def enabled_encodings(setting: str = OUTPUT_COMPRESSION):
+    """配置中可用的内容编码，按优先顺序"""
+    encodings = [item.strip() for item in setting.split(',') if item.strip()]
+    for encoding in encodings:
+        if encoding not in ENCODING_SUFFIXES:
+            raise ValueError(f"不支持的内容编码: {encoding}")
+    return [encoding for encoding in encodings if encoding != 'br' or brotli is not None]
+
+class ArtifactStore:
+    """outputs/ 中生成文件的路径、写入、访问记录与清理"""
+
+    def __init__(self, root: str, max_age: int = OUTPUT_MAX_AGE, max_bytes: int = OUTPUT_MAX_BYTES,
+                 upload_folder: Optional[str] = None, encodings: Optional[List[str]] = None):
+        """
+        :param root: 输出目录
+        :param max_age: 最长保留时间（秒）
+        :param max_bytes: 总大小上限（字节）
+        :param upload_folder: 需要清理孤立文件的上传目录
+        :param encodings: 写入时生成的压缩版本，默认按 OUTPUT_COMPRESSION
+        """
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.upload_folder = upload_folder
+        self.encodings = enabled_encodings() if encodings is None else encodings
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.metrics = {
+            'sweeps': 0,
+            'expired': 0,
+            'evicted': 0,
+            'orphans': 0,
+            'bytes_freed': 0,
+            'files': 0,
+            'bytes': 0,
+            'last_sweep_at': None,
+            'last_sweep_ms': None,
+        }
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def is_valid_name(filename: str) -> bool:
+        """只接受不含路径的普通文件名"""
+        return bool(filename) and os.path.basename(filename) == filename and not filename.startswith('.')
+
+    @staticmethod
+    def shard_for(filename: str) -> str:
+        """文件名 -> 子目录名（文件名哈希的前两位）"""
+        return hashlib.sha1(filename.encode('utf-8')).hexdigest()[:2]
+
+    def path_for(self, filename: str) -> str:
+        """文件的存储路径"""
+        if not self.is_valid_name(filename):
+            raise ValueError(f"非法文件名: {filename}")
+        return os.path.join(self.root, self.shard_for(filename), filename)
+
+    def resolve(self, filename: str) -> Optional[str]:
+        """查找已存在的文件，返回路径；兼容分目录之前直接放在 outputs/ 下的文件"""
+        if not self.is_valid_name(filename):
+            return None
+        path = self.path_for(filename)
+        if os.path.isfile(path):
+            return path
+        legacy_path = os.path.join(self.root, filename)
+        if os.path.isfile(legacy_path):
+            return legacy_path
+        return None
+
+    def exists(self, filename: str) -> bool:
+        return self.resolve(filename) is not None
+
+    def mtime(self, filename: str) -> Optional[float]:
+        """文件生成时间，不存在时返回 None"""
+        path = self.resolve(filename)
+        if path is None:
+            return None
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def write_text(self, filename: str, content: str, metadata: Optional[Dict] = None) -> str:
+        """
+        写入文件、压缩版本和 ETag，返回路径
+        :param metadata: 与文件一起保存的生成参数，用 metadata() 读取
+        """
+        path = self.path_for(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = content.encode('utf-8')
+        self._write_atomic(path, data)
+        for encoding in self.encodings:
+            self._write_atomic(f"{path}{ENCODING_SUFFIXES[encoding]}", compress(data, encoding))
+        if metadata is not None:
+            self._write_atomic(f"{path}{META_SUFFIX}", json.dumps(metadata, ensure_ascii=False).encode('utf-8'))
+        self._write_atomic(f"{path}{ETAG_SUFFIX}", content_etag(data).encode('ascii'))
+        return path
+
+    def metadata(self, path: str) -> Dict:
+        """写入文件时保存的生成参数；没有（如升级前生成的文件）或无法读取时返回空字典"""
+        try:
+            with open(f"{path}{META_SUFFIX}", 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def variants(self, path: str) -> Dict[str, str]:
+        """文件已有的压缩版本 {内容编码: 路径}，按优先顺序"""
+        variants = {}
+        for encoding in self.encodings:
+            variant_path = f"{path}{ENCODING_SUFFIXES[encoding]}"
+            if os.path.isfile(variant_path):
+                variants[encoding] = variant_path
+        return variants
+
+    def etag(self, path: str) -> str:
+        """文件的强 ETag（不含引号）；没有 .etag 文件或它比主文件旧时（如升级前生成的文件）重新计算"""
+        etag_path = f"{path}{ETAG_SUFFIX}"
+        try:
+            if os.stat(etag_path).st_mtime_ns >= os.stat(path).st_mtime_ns:
+                with open(etag_path, 'r', encoding='ascii') as f:
+                    return f.read().strip()
+        except (OSError, ValueError):
+            pass
+        with open(path, 'rb') as f:
+            etag = content_etag(f.read())
+        try:
+            self._write_atomic(etag_path, etag.encode('ascii'))
+        except OSError as e:
+            logger.warning(f"保存ETag失败: {path}: {str(e)}")
+        return etag
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes) -> None:
+        """先写临时文件再改名，避免其他worker读到写了一半的文件"""
+        tmp_path = f"{path}.{uuid.uuid4().hex}{TMP_SUFFIX}"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def record_access(self, path: str) -> None:
+        """记录访问时间（只改 atime，保留 mtime 作为生成时间）"""
+        try:
+            st = os.stat(path)
+            now = time.time()
+            if now - st.st_atime >= ACCESS_RESOLUTION:
+                os.utime(path, (now, st.st_mtime))
+        except OSError as e:
+            logger.warning(f"记录访问时间失败: {path}: {str(e)}")
+
+    def sweep(self, now: Optional[float] = None) -> Dict[str, int]:
+        """执行一次清理，返回本次清理的统计"""
+        now = time.time() if now is None else now
+        started = time.perf_counter()
+        result = {'expired': 0, 'evicted': 0, 'orphans': 0, 'bytes_freed': 0, 'files': 0, 'bytes': 0}
+
+        lock_file = self._acquire_sweep_lock()
+        if lock_file is False:
+            logger.info("其他进程正在清理，跳过本次清理")
+            return result
+
+        try:
+            entries = []  # (最后访问时间, 大小, 路径)
+            sidecar_bytes = {}  # 主文件路径 -> 附属文件总大小
+            for path, st in self._iter_files():
+                if path.endswith(TMP_SUFFIX):
+                    if now - st.st_mtime > ORPHAN_MAX_AGE and self._remove(path):
+                        result['orphans'] += 1
+                        result['bytes_freed'] += st.st_size
+                    continue
+                if path.endswith(SIDECAR_SUFFIXES):
+                    main_path = os.path.splitext(path)[0]
+                    if os.path.exists(main_path):
+                        sidecar_bytes[main_path] = sidecar_bytes.get(main_path, 0) + st.st_size
+                    elif now - st.st_mtime > ORPHAN_MAX_AGE and self._remove(path):
+                        # 主文件已不存在的附属文件
+                        result['orphans'] += 1
+                        result['bytes_freed'] += st.st_size
+                    continue
+                last_access = max(st.st_atime, st.st_mtime)
+                if now - last_access > self.max_age:
+                    if self._remove(path):
+                        result['expired'] += 1
+                        result['bytes_freed'] += st.st_size
+                    continue
+                entries.append((last_access, st.st_size, path))
+
+            # 超过总大小上限时从最久未访问的开始删除
+            entries = [(last_access, size + sidecar_bytes.get(path, 0), path) for last_access, size, path in entries]
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                entries.sort()
+                index = 0
+                while index < len(entries) and total > self.max_bytes:
+                    _, size, path = entries[index]
+                    index += 1
+                    total -= size
+                    if self._remove(path):
+                        result['evicted'] += 1
+                        result['bytes_freed'] += size
+                entries = entries[index:]
+
+            result['files'] = len(entries)
+            result['bytes'] = total
+
+            if self.upload_folder and os.path.isdir(self.upload_folder):
+                with os.scandir(self.upload_folder) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_file() and now - entry.stat().st_mtime > ORPHAN_MAX_AGE:
+                                size = entry.stat().st_size
+                                if self._remove(entry.path):
+                                    result['orphans'] += 1
+                                    result['bytes_freed'] += size
+                        except OSError:
+                            continue
+        finally:
+            self._release_sweep_lock(lock_file)
+
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        with self._lock:
+            self.metrics['sweeps'] += 1
+            for name in ('expired', 'evicted', 'orphans', 'bytes_freed'):
+                self.metrics[name] += result[name]
+            self.metrics['files'] = result['files']
+            self.metrics['bytes'] = result['bytes']
+            self.metrics['last_sweep_at'] = now
+            self.metrics['last_sweep_ms'] = elapsed_ms
+
+        if result['expired'] or result['evicted'] or result['orphans']:
+            logger.info(f"清理完成: 过期 {result['expired']}，超限淘汰 {result['evicted']}，"
+                        f"孤立文件 {result['orphans']}，释放 {result['bytes_freed']} 字节，用时 {elapsed_ms}ms")
+        return result
+
+    def stats(self) -> Dict:
+        """累计清理统计"""
+        with self._lock:
+            return dict(self.metrics, max_bytes=self.max_bytes, max_age=self.max_age)
+
+    def start_sweeper(self, interval: int = OUTPUT_SWEEP_INTERVAL) -> None:
+        """启动后台清理线程（每个进程只启动一个）"""
+        if interval <= 0 or self._sweeper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"清理输出目录时出错: {str(e)}")
+
+        self._sweeper = threading.Thread(target=run, name='artifact-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def _iter_files(self):
+        """遍历输出目录（子目录和兼容的顶层文件），产出 (路径, stat)"""
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                items = [entry]
+                if entry.is_dir(follow_symlinks=False):
+                    try:
+                        with os.scandir(entry.path) as shard:
+                            items = list(shard)
+                    except OSError:
+                        continue
+                for item in items:
+                    try:
+                        if not item.is_file(follow_symlinks=False):
+                            continue
+                        st = item.stat(follow_symlinks=False)
+                    except OSError:
+                        # 文件在遍历过程中被删除（其他进程，或随主文件删除的附属文件）
+                        continue
+                    yield item.path, st
+
+    def _remove(self, path: str) -> bool:
+        """删除文件及其附属文件"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.warning(f"删除文件失败: {path}: {str(e)}")
+            return False
+        if not path.endswith(SIDECAR_SUFFIXES):
+            for suffix in SIDECAR_SUFFIXES:
+                try:
+                    os.remove(f"{path}{suffix}")
+                except OSError:
+                    pass
+        return True
+
+    def _acquire_sweep_lock(self):
+        """多个 gunicorn worker 同时运行清理线程时，同一时间只有一个在清理"""
+        if fcntl is None:
+            return None
+        lock_file = open(os.path.join(self.root, SWEEP_LOCK_NAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        return lock_file
+
+    def _release_sweep_lock(self, lock_file) -> None:
+        if lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+def main(argv=None) -> int:
+    """
+    命令行：
+        python artifact_store.py sweep [输出目录] [上传目录]
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != 'sweep':
+        print("用法: python artifact_store.py sweep [outputs] [uploads]")
+        return 2
+    root = argv[1] if len(argv) > 1 else 'outputs'
+    upload_folder = argv[2] if len(argv) > 2 else 'uploads'
+    logging.basicConfig(level=logging.INFO)
+    store = ArtifactStore(root, upload_folder=upload_folder)
+    print(json.dumps(store.sweep(), ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+批量转换
+
+班长、辅导员一次提交整个班级/学院的课表导出（zip 或多个HTML文件），
+解析和生成ICS在有界进程池中并行执行，结果按完成顺序流式写入 zip，最后附上 manifest.json。
+"""
+
+import os
+import json
+import time
+import zipfile
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, List, Tuple
+
+from calendar_generator import Parser, Writer
+
+logger = logging.getLogger(__name__)
+
+# 进程池大小，默认与CPU核数相同
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', os.cpu_count() or 2))
+# 单次批量请求最多处理的HTML文件数
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 500))
+# zip 中单个HTML文件解压后的大小上限
+BATCH_MAX_FILE_SIZE = 16 * 1024 * 1024
+# 单次批量请求所有HTML文件（解压后）的总大小上限
+BATCH_MAX_TOTAL_SIZE = int(os.environ.get('BATCH_MAX_TOTAL_SIZE', 256 * 1024 * 1024))
+
+HTML_EXTENSIONS = ('.html', '.htm')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ProcessPoolExecutor:
+    """获取（按需创建）当前进程共用的转换进程池"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # 使用 spawn，避免从带线程的 gunicorn worker 中 fork
+            _executor = ProcessPoolExecutor(
+                max_workers=BATCH_MAX_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _executor
+
+def discard_executor(executor: ProcessPoolExecutor) -> None:
+    """子进程异常退出后进程池不可再用，丢弃它，下次请求重新创建"""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def convert_one(name: str, raw: bytes, semester_start) -> dict:
+    """在子进程中转换单个课表，返回转换结果"""
+    start = time.perf_counter()
+    try:
+        data = Parser(raw).parse_courses()
+        if not data:
+            raise ValueError("未能从HTML文件中解析出课程信息")
+        ics_content = "".join(Writer(data, semester_start).iter_ics())
+        return {'file': name, 'status': 'ok', 'courses': len(data), 'ics': ics_content, 'parsed': data,
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 2)}
+    except Exception as e:
+        return {'file': name, 'status': 'error', 'error': str(e),
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 2)}
+
+def collect_inputs(files) -> List[Tuple[str, bytes]]:
+    """
+    从上传的文件中收集待转换的HTML
+    文件数、单个文件大小和总大小在读取（解压）每个文件之前检查，超出时抛出 ValueError，
+    zip 炸弹或包含大量文件的 zip 不会先被完整解压到内存
+    :param files: 上传的 FileStorage 列表，可以是HTML文件，也可以是包含HTML文件的zip
+    """
+    inputs = []
+    total_size = 0
+
+    def admit(name: str, size: int) -> None:
+        nonlocal total_size
+        if len(inputs) >= BATCH_MAX_FILES:
+            raise ValueError(f"单次最多转换 {BATCH_MAX_FILES} 个文件")
+        if size > BATCH_MAX_FILE_SIZE:
+            raise ValueError(f"文件过大: {name}")
+        total_size += size
+        if total_size > BATCH_MAX_TOTAL_SIZE:
+            raise ValueError(f"文件总大小超过 {BATCH_MAX_TOTAL_SIZE // (1024 * 1024)} MB")
+
+    for file in files:
+        filename = file.filename or ''
+        if filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                for member in archive.infolist():
+                    member_name = member.filename
+                    if member.is_dir() or member_name.startswith('__MACOSX/'):
+                        continue
+                    if not member_name.lower().endswith(HTML_EXTENSIONS):
+                        continue
+                    # 解压出的字节数不会超过 file_size（zipfile 按它截断并校验）
+                    admit(member_name, member.file_size)
+                    inputs.append((member_name, archive.read(member)))
+        elif filename.lower().endswith(HTML_EXTENSIONS):
+            raw = file.stream.read(BATCH_MAX_FILE_SIZE + 1)
+            admit(filename, len(raw))
+            inputs.append((filename, raw))
+    return inputs
+
+def ics_name_for(name: str, used: set) -> str:
+    """由HTML文件名生成不重复的ICS文件名"""
+    stem = os.path.splitext(os.path.basename(name))[0] or 'timetable'
+    candidate = f"{stem}.ics"
+    index = 2
+    while candidate in used:
+        candidate = f"{stem}_{index}.ics"
+        index += 1
+    used.add(candidate)
+    return candidate
+
+class _ZipStream:
+    """供 zipfile 写入的只追加缓冲区，写完一个文件就把已生成的字节交给响应"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_batch_zip(inputs: Iterable[Tuple[str, bytes]], semester_start,
+                     executor=None, max_in_flight=None, on_parsed=None) -> Iterator[bytes]:
+    """
+    并行转换并流式生成 zip：每完成一个文件就写入一个ICS，最后写入 manifest.json
+    同时提交到进程池的任务数不超过 max_in_flight，避免一次性占满内存
+    on_parsed 在主进程中以每个文件解析出的 Course 列表调用（如写入教学班索引）
+    """
+    shared_executor = executor is None
+    executor = executor or get_executor()
+    max_in_flight = max_in_flight or BATCH_MAX_WORKERS * 2
+
+    buffer = _ZipStream()
+    archive = zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED)
+    manifest = []
+    used_names = set()
+    pending = {}  # future -> 文件名
+    inputs = iter(inputs)
+    exhausted = False
+    broken = False
+
+    while pending or not exhausted:
+        # 补充任务直到达到并发上限
+        while not exhausted and len(pending) < max_in_flight:
+            try:
+                name, raw = next(inputs)
+            except StopIteration:
+                exhausted = True
+                break
+            if broken:
+                manifest.append({'file': name, 'status': 'error', 'error': '转换进程异常退出'})
+                continue
+            try:
+                pending[executor.submit(convert_one, name, raw, semester_start)] = name
+            except BrokenProcessPool:
+                broken = True
+                manifest.append({'file': name, 'status': 'error', 'error': '转换进程异常退出'})
+
+        if not pending:
+            break
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                # 子进程崩溃等情况
+                logger.error(f"批量转换 {name} 失败: {str(e)}")
+                manifest.append({'file': name, 'status': 'error', 'error': str(e)})
+                if isinstance(e, BrokenProcessPool):
+                    broken = True
+                continue
+
+            ics_content = result.pop('ics', None)
+            parsed = result.pop('parsed', None)
+            if parsed and on_parsed is not None:
+                on_parsed(parsed)
+            if ics_content is not None:
+                result['ics_file'] = ics_name_for(result['file'], used_names)
+                archive.writestr(result['ics_file'], ics_content)
+            manifest.append(result)
+
+        chunk = buffer.drain()
+        if chunk:
+            yield chunk
+
+    if broken and shared_executor:
+        discard_executor(executor)
+
+    archive.writestr('manifest.json', json.dumps({
+        'total': len(manifest),
+        'succeeded': sum(1 for item in manifest if item['status'] == 'ok'),
+        'files': manifest,
+    }, ensure_ascii=False, indent=2))
+    archive.close()
+    yield buffer.drain()
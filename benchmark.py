@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+性能基准套件
+
+用合成的教务系统课表页面分别测量解析、周数识别、ICS生成、序列化以及 /api/upload 端到端的耗时，
+结果可以保存为JSON，并与保存的基线对比。
+
+用法:
+    python benchmark.py                                   # 运行全部基准
+    python benchmark.py --only stages --courses 10 100    # 只测各阶段耗时
+    python benchmark.py --save baseline.json              # 保存结果作为基线
+    python benchmark.py --baseline baseline.json          # 与基线对比，慢于阈值的项会被标出
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import logging
+import random
+import argparse
+import platform
+import statistics
+import tempfile
+import threading
+import warnings
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from calendar_generator import BJTUCalendarGenerator, Parser, Writer, week_type_detect
+from course_model import as_courses, mask_from_week_data
+
+# 课表的节次数和星期数（与教务系统一致）
+LESSONS = 7
+WEEKDAYS = 7
+
+# 默认的周数格式比例
+DEFAULT_WEEK_MIX = {"continuous": 0.6, "discontinuous": 0.2, "interval": 0.2}
+
+SEMESTER_START = datetime(2025, 9, 8)
+
+# 与教务系统导出格式一致的课程块
+COURSE_DIV_TEMPLATE = """
+                    <div>
+                        <span>
+                            {course_id} [{class_id}] <br />
+                            {name}<br />
+                        </span>
+                        <div style="max-width:120px;">
+                            {weeks}
+                            <i>{teacher}</i>
+                        </div>
+                        <span class="text-muted">海淀西校区, {building}, {room}</span>
+                    </div>"""
+
+BUILDINGS = ["逸夫教学楼", "思源楼", "思源西楼", "第九教学楼", "机械楼"]
+
+def make_week_spec(week_type, rng):
+    """按类型随机生成一个周数描述，如 "第01-16周"、"第2, 5, 7周"、"第02, 04, 06, 08周" """
+    if week_type == "continuous":
+        start = rng.randint(1, 8)
+        return f"第{start:02d}-{rng.randint(start, 18):02d}周"
+    if week_type == "interval":
+        start, step = rng.randint(1, 3), rng.choice([2, 3])
+        weeks = range(start, start + step * rng.randint(3, 8), step)
+        return "第" + ", ".join(f"{week:02d}" for week in weeks) + "周"
+    if week_type == "discontinuous":
+        while True:
+            weeks = sorted(rng.sample(range(1, 19), rng.randint(3, 6)))
+            gaps = {b - a for a, b in zip(weeks, weeks[1:])}
+            if len(gaps) > 1:  # 等差的会被识别为 interval
+                return "第" + ", ".join(str(week) for week in weeks) + "周"
+    raise ValueError(f"未知的周数类型: {week_type}")
+
+def make_timetable_html(courses=35, multi_div_ratio=0.0, week_mix=None, seed=0):
+    """
+    生成教务系统格式的课表页面
+    :param courses: 课程块总数
+    :param multi_div_ratio: 放进已有课程的格子（同一格多个 <div>）的比例
+    :param week_mix: 各周数格式的比例，如 {"continuous": 0.6, "discontinuous": 0.2, "interval": 0.2}
+    :param seed: 随机种子，相同参数生成相同页面
+    """
+    rng = random.Random(seed)
+    week_mix = week_mix or DEFAULT_WEEK_MIX
+    week_types = list(week_mix)
+    week_weights = [week_mix[week_type] for week_type in week_types]
+
+    free_cells = [(lesson, weekday) for lesson in range(1, LESSONS + 1) for weekday in range(1, WEEKDAYS + 1)]
+    rng.shuffle(free_cells)
+    cells = {}
+    for i in range(courses):
+        if not free_cells or (cells and rng.random() < multi_div_ratio):
+            cell = rng.choice(list(cells))
+        else:
+            cell = free_cells.pop()
+        week_type = rng.choices(week_types, week_weights)[0]
+        cells.setdefault(cell, []).append(COURSE_DIV_TEMPLATE.format(
+            course_id=f"M{i:05d}B",
+            class_id=f"{i % 20 + 1:02d}",
+            name=f"课程{i}",
+            weeks=make_week_spec(week_type, rng),
+            teacher=f"教师{i % 50}",
+            building=rng.choice(BUILDINGS),
+            room=f"R{rng.randint(100, 599)}",
+        ))
+
+    rows = ["<tr><th>时间</th>" + "".join(f"<th>星期{d}</th>" for d in range(1, WEEKDAYS + 1)) + "</tr>"]
+    for lesson in range(1, LESSONS + 1):
+        tds = "".join(f"<td>{''.join(cells.get((lesson, weekday), []))}</td>" for weekday in range(1, WEEKDAYS + 1))
+        rows.append(f"<tr><td>第{lesson}节</td>{tds}</tr>")
+    return f'<html><body><table class="table table-bordered">{"".join(rows)}</table></body></html>'
+
+def make_sample_html():
+    """默认规模的课表页面（35门课，只有连续周）"""
+    return make_timetable_html(courses=35, week_mix={"continuous": 1})
+
+def make_courses(count):
+    """直接构造 count 门课程数据（不经过HTML解析）"""
+    courses = []
+    for i in range(count):
+        courses.append({
+            "course_id": f"M{i:06d}B",
+            "class_id": f"{i % 10:02d}",
+            "name": f"课程{i}",
+            "time": {"weekday": i % 7 + 1, "lesson": i % 7 + 1},
+            "teacher": f"教师{i}",
+            "location": "逸夫教学楼 YF415" if i % 2 else "思源楼 SY207",
+            "weeks": {"type": "continuous", "data": {"start": 1, "end": 16}},
+        })
+    return courses
+
+def measure(func, repeat, warmup=1):
+    """重复执行 func，返回耗时统计（毫秒）"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean_ms": round(statistics.mean(samples), 4),
+        "median_ms": round(statistics.median(samples), 4),
+        "min_ms": round(min(samples), 4),
+        "repeat": repeat,
+    }
+
+def report(results, key, stats, note=""):
+    """记录并打印一项结果"""
+    results[key] = stats
+    print(f"  {key:<48} {stats['mean_ms']:>10.3f}ms  (min {stats['min_ms']:.3f}ms){note}")
+
+def bench_stages(args, results):
+    """各阶段耗时：解析、周数识别、生成事件、str(cal)、原生序列化、/api/upload 端到端"""
+    from app import app, artifact_store
+
+    print("各阶段耗时")
+    client = app.test_client()
+    for size in args.courses:
+        html = make_timetable_html(size, args.multi_div, args.week_mix, seed=size)
+        label = f"[courses={size}]"
+
+        for engine in ("bs4", "lxml"):
+            report(results, f"parse.{engine}{label}", measure(lambda: Parser(html, engine=engine).parse(), args.repeat))
+
+        data = Parser(html).parse()
+        week_specs = [line.strip() for line in html.splitlines() if line.strip().startswith("第")]
+        report(results, f"week_type_detect{label}",
+               measure(lambda: [week_type_detect(spec) for spec in week_specs], args.repeat))
+
+        writer = Writer(data, SEMESTER_START)
+        report(results, f"writer.generate_ics{label}", measure(writer.generate_ics, args.repeat))
+        cal = writer.generate_ics()
+        report(results, f"writer.str_cal{label}", measure(lambda: str(cal), args.repeat))
+        report(results, f"writer.native{label}", measure(lambda: "".join(writer.iter_ics()), args.repeat))
+
+        created = []
+
+        def upload(body):
+            data = {'file': (io.BytesIO(body), 'timetable.html')}
+            response = client.post('/api/upload', data=data, content_type='multipart/form-data')
+            created.append(response.get_json()['ics_file'])
+
+        # 每次在表格中插入不同的注释，避免命中结果缓存
+        counter = iter(range(10 ** 9))
+        uncached = lambda: upload(html.replace("</table>", f"<!-- {time.time_ns()}-{next(counter)} --></table>").encode("utf-8"))
+        report(results, f"upload.e2e{label}", measure(uncached, args.repeat))
+        cached_body = html.encode("utf-8")
+        report(results, f"upload.cached{label}", measure(lambda: upload(cached_body), args.repeat))
+
+        for ics_file in set(created):
+            path = artifact_store.resolve(ics_file)
+            if path:
+                os.remove(path)
+
+def convert_via_disk(raw, upload_dir):
+    """旧流程：保存上传文件 -> 按路径重新读取解析 -> 删除"""
+    path = os.path.join(upload_dir, f"{time.perf_counter_ns()}_{os.getpid()}.html")
+    with open(path, "wb") as f:
+        f.write(raw)
+    try:
+        return BJTUCalendarGenerator().generate_from_html(path)
+    finally:
+        os.remove(path)
+
+def convert_in_memory(raw, upload_dir):
+    """新流程：直接从内存中的上传流解析"""
+    return BJTUCalendarGenerator().generate_from_html(io.BytesIO(raw))
+
+def bench_upload_io(args, results):
+    """并发下对比落盘流程与内存流程"""
+    raw = make_sample_html().encode("utf-8")
+    print(f"上传流程: {args.requests} 次请求, {args.workers} 并发, 页面 {len(raw) / 1024:.1f} KB")
+    with tempfile.TemporaryDirectory() as upload_dir:
+        for label, func in (("disk", convert_via_disk), ("memory", convert_in_memory)):
+            def run():
+                with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                    list(executor.map(lambda _: func(raw, upload_dir), range(args.requests)))
+            stats = measure(run, repeat=1)
+            stats["per_request_ms"] = round(stats["mean_ms"] / args.requests, 4)
+            report(results, f"upload_io.{label}[workers={args.workers}]", stats,
+                   note=f"  平均 {stats['per_request_ms']:.2f}ms/次")
+
+def bench_serializers(args, results):
+    """对比 ics 库对象模型与原生序列化的渲染耗时"""
+    print("ICS序列化: ics 库 vs 原生")
+    for size in (10, 100, 1000):
+        writer = Writer(make_courses(size), SEMESTER_START)
+        report(results, f"serialize.ics[courses={size}]", measure(lambda: str(writer.generate_ics()), args.repeat))
+        report(results, f"serialize.native[courses={size}]", measure(lambda: "".join(writer.iter_ics()), args.repeat))
+
+def create_user_rewrite(path, username, password_hash):
+    """旧流程：读取整个用户文件，加入新用户后整体写回"""
+    users = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and ':' in line:
+                    name, value = line.split(':', 1)
+                    users[name] = value
+    users[username] = password_hash
+    with open(path, 'w', encoding='utf-8') as f:
+        for name, value in users.items():
+            f.write(f"{name}:{value}\n")
+
+def bench_user_store(args, results):
+    """创建CalDAV用户的耗时随用户文件大小的变化：整体重写 vs 加锁追加"""
+    from user_store import HtpasswdUserStore
+
+    print("创建用户: 整体重写 vs 加锁追加")
+    password_hash = "$2b$12$" + "x" * 53
+    with tempfile.TemporaryDirectory() as root:
+        for size in (1000, 10000, 100000):
+            prefill = "".join(f"user_{i:08x}:{password_hash}\n" for i in range(size))
+            counter = iter(range(10 ** 9))
+
+            for label in ("rewrite", "append", "append+fsync"):
+                path = os.path.join(root, f"users_{label}_{size}")
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(prefill)
+                if label == "rewrite":
+                    create = lambda: create_user_rewrite(path, f"new_{next(counter)}", password_hash)
+                else:
+                    store = HtpasswdUserStore(path, fsync=label == "append+fsync")
+                    create = lambda: store.add(f"new_{next(counter)}", password_hash)
+                report(results, f"users.{label}[users={size}]", measure(create, args.repeat))
+
+def bench_feed(args, results):
+    """
+    订阅地址轮询：经过真实的 WSGI 服务器（werkzeug，每次请求一个新连接，与日历应用轮询一样），
+    按课表规模比较完整下载和条件请求返回 304 的耗时和响应字节数（状态行 + 响应头 + 响应体）
+    """
+    import http.client
+    from werkzeug.serving import make_server
+    from app import app
+
+    # 不打印每个请求的访问日志
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_port
+
+    def get(path, headers=None, body=None, method="GET"):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+            head = len(f"HTTP/1.1 {response.status} {response.reason}\r\n") + len(response.msg.as_bytes())
+            return response, data, head + len(data)
+        finally:
+            conn.close()
+
+    client = app.test_client()
+    print(f"订阅轮询（WSGI 服务器）: {args.requests} 次请求, {args.workers} 并发")
+    try:
+        for size in args.courses:
+            html = make_timetable_html(size, args.multi_div, args.week_mix, seed=200 + size)
+            data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+            ics_file = client.post('/api/upload', data=data, content_type='multipart/form-data').get_json()['ics_file']
+            feed_url = client.post('/api/feed', json={'ics_file': ics_file}).get_json()['feed_url']
+
+            cases = []
+            for encoding in ("identity", "gzip"):
+                response, _, _ = get(feed_url, {'Accept-Encoding': encoding})
+                etag = response.headers['ETag']
+                cases.append((f"full-{encoding}", {'Accept-Encoding': encoding}))
+                cases.append((f"304-{encoding}", {'Accept-Encoding': encoding, 'If-None-Match': etag}))
+
+            for label, headers in cases:
+                fetch = lambda _: get(feed_url, headers)[2]
+                def run():
+                    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                        return sum(executor.map(fetch, range(args.requests)))
+                stats = measure(run, repeat=3)
+                stats["per_request_ms"] = round(stats["mean_ms"] / args.requests, 4)
+                stats["bytes_per_request"] = fetch(None)
+                report(results, f"feed.{label}[courses={size},workers={args.workers}]", stats,
+                       note=f"  平均 {stats['per_request_ms']:.3f}ms/次, {stats['bytes_per_request']} 字节/次")
+    finally:
+        server.shutdown()
+        thread.join()
+
+def bench_compression(args, results):
+    """生成的ICS文件的压缩率和压缩、解压耗时"""
+    import gzip
+    from artifact_store import GZIP_LEVEL, BROTLI_QUALITY, brotli
+
+    print("ICS压缩: 压缩率与CPU耗时")
+    codecs = [(f"gzip-{level}", lambda data, level=level: gzip.compress(data, compresslevel=level, mtime=0),
+               gzip.decompress) for level in (1, 6, GZIP_LEVEL)]
+    if brotli is not None:
+        codecs += [(f"br-{quality}", lambda data, quality=quality: brotli.compress(data, quality=quality),
+                    brotli.decompress) for quality in (BROTLI_QUALITY, 11)]
+    else:
+        print("  （未安装 brotli，跳过 br）")
+    for size in args.courses:
+        data = "".join(Writer(make_courses(size), SEMESTER_START).iter_ics()).encode("utf-8")
+        for label, compress, decompress in codecs:
+            compressed = compress(data)
+            stats = measure(lambda: compress(data), args.repeat)
+            stats["bytes"] = len(data)
+            stats["compressed_bytes"] = len(compressed)
+            stats["ratio"] = round(len(data) / len(compressed), 2)
+            stats["decompress_ms"] = measure(lambda: decompress(compressed), args.repeat)["mean_ms"]
+            report(results, f"compress.{label}[courses={size}]", stats,
+                   note=f"  {len(data) / 1024:.1f}KB -> {len(compressed) / 1024:.1f}KB "
+                        f"({stats['ratio']}x), 解压 {stats['decompress_ms']:.3f}ms")
+
+def bench_expansion(args, results):
+    """上课实例展开：NumPy 向量化 vs 逐个课程的纯 Python 循环"""
+    from occurrences import expand, expand_python, np
+
+    if np is None:
+        print("上课实例展开: 未安装 numpy，跳过")
+        return
+    print("上课实例展开: 向量化 vs 纯Python")
+    for size in sorted(set(args.courses) | {10000}):
+        courses = as_courses(make_courses(size))
+        occurrences = len(expand(courses, SEMESTER_START))
+        repeat = max(3, args.repeat // 4) if size >= 10000 else args.repeat
+        python = measure(lambda: expand_python(courses, SEMESTER_START), repeat)
+        vectorized = measure(lambda: expand(courses, SEMESTER_START), repeat)
+        vectorized["occurrences"] = occurrences
+        vectorized["speedup"] = round(python["mean_ms"] / vectorized["mean_ms"], 1)
+        report(results, f"expand.python[courses={size}]", python)
+        report(results, f"expand.numpy[courses={size}]", vectorized,
+               note=f"  {occurrences} 次上课, 快 {vectorized['speedup']}x")
+
+def bench_free_slots(args, results):
+    """多份课表的共同空闲时段：构建位集 + 按位或 + 逐位计数"""
+    from free_slots import FreeSlotFinder
+
+    print("共同空闲时间: 位集")
+    rng = random.Random(0)
+    for count in (10, 100, 500):
+        timetables = {}
+        for i in range(count):
+            html = make_timetable_html(35, args.multi_div, args.week_mix, seed=rng.randrange(1 << 30))
+            timetables[f"学生{i}"] = Parser(html).parse_courses()
+        stats = measure(lambda: FreeSlotFinder(timetables, weekdays=range(1, 6)).find(), args.repeat)
+        report(results, f"free_slots[timetables={count}]", stats)
+
+# 教务系统中常见的不规则上课周（考试周、实验周穿插、期中调课等）
+IRREGULAR_WEEK_SPECS = [
+    "第1-4, 6, 9-16周",
+    "第1-8, 10, 12, 14, 16周",
+    "第2-7, 9-17周",
+    "第1, 3, 5, 7, 9-16周",
+    "第1-3, 5-7, 9-11, 13-15周",
+    "第1-12, 14-15周",
+    "第3, 4, 7, 8, 11, 12, 15, 16周",
+    "第1, 2, 5-18周",
+]
+
+def split_contiguous(course):
+    """朴素拆法：每段连续的周一个事件（不用 INTERVAL、RDATE、EXDATE）"""
+    from dataclasses import replace
+    from course_model import first_week_of
+
+    parts = []
+    weeks = course.weeks
+    while weeks:
+        low = weeks & -weeks
+        run = ((weeks + low) ^ weeks) & weeks  # 从最低位开始的连续 1
+        parts.append(replace(course, class_id=f"{course.class_id}-{first_week_of(run)}", weeks=run))
+        weeks &= ~run
+    return parts
+
+def bench_week_rules(args, results):
+    """不规则上课周的编码：每段连续周一个事件 vs 拆成等差段 + RDATE/EXDATE，比较事件数和字节数"""
+    from dataclasses import replace
+    from holiday_table import HolidayTable
+    from course_model import weeks_to_mask
+    from week_rules import SEARCH_MAX_WEEKS, _rest, decompose_weeks
+
+    print("上课周重复规则: 每段连续周一个事件 vs 最少字节拆分")
+    no_holidays = HolidayTable({})
+    rng = random.Random(0)
+    specs = IRREGULAR_WEEK_SPECS + [make_week_spec("discontinuous", rng) for _ in range(40)]
+    base = as_courses(make_courses(1))[0]
+    courses = [
+        replace(base, class_id=f"{i:02d}", weekday=i % 5 + 1, weeks=mask_from_week_data(*week_type_detect(spec)))
+        for i, spec in enumerate(specs)
+    ]
+
+    def render(items):
+        return "".join(Writer(items, SEMESTER_START, holiday_table=no_holidays).iter_ics())
+
+    for label, items in (("all", courses), ("real", courses[:len(IRREGULAR_WEEK_SPECS)])):
+        naive = render([part for course in items for part in split_contiguous(course)])
+        encoded = render(items)
+        naive_events, encoded_events = naive.count("BEGIN:VEVENT"), encoded.count("BEGIN:VEVENT")
+
+        def decompose_cold():
+            _rest.cache_clear()
+            for course in items:
+                decompose_weeks(course.weeks)
+
+        stats = measure(decompose_cold, args.repeat)
+        stats.update(naive_events=naive_events, events=encoded_events,
+                     naive_bytes=len(naive.encode("utf-8")), bytes=len(encoded.encode("utf-8")))
+        report(results, f"week_rules[{label}, patterns={len(items)}]", stats,
+               note=f"  事件 {naive_events} -> {encoded_events}, "
+                    f"字节 {stats['naive_bytes']} -> {stats['bytes']} "
+                    f"({(stats['bytes'] / stats['naive_bytes'] - 1) * 100:+.1f}%)")
+
+    # 最坏情况：分布很散的周集合（SEARCH_MAX_WEEKS、32 of 63 周），完整搜索受 SEARCH_BUDGET 限制
+    sparse = [weeks_to_mask(rng.sample(range(1, 64), n)) for n in (SEARCH_MAX_WEEKS, 32) for _ in range(50)]
+
+    def decompose_sparse():
+        _rest.cache_clear()
+        for mask in sparse:
+            decompose_weeks(mask)
+
+    stats = measure(decompose_sparse, args.repeat)
+    report(results, f"week_rules[sparse, masks={len(sparse)}]", stats,
+           note=f"  平均 {stats['mean_ms'] / len(sparse):.3f}ms/门课")
+
+def make_block_courses(count, block_ratio, seed=0):
+    """count 门课，其中 block_ratio 比例连上 2-3 节（每节一条记录，与解析结果一致）"""
+    from course_model import Course
+
+    rng = random.Random(seed)
+    courses = []
+    for i in range(count):
+        lessons = rng.choice([2, 3]) if rng.random() < block_ratio else 1
+        first = rng.randint(1, LESSONS - lessons + 1)
+        weekday, location = rng.randint(1, 5), f"{rng.choice(BUILDINGS)} R{rng.randint(100, 599)}"
+        weeks = mask_from_week_data(*week_type_detect(make_week_spec("continuous", rng)))
+        for lesson in range(first, first + lessons):
+            courses.append(Course(f"M{i:05d}B", f"{i % 20 + 1:02d}", f"课程{i}", weekday, lesson,
+                                  f"教师{i % 50}", location, weeks))
+    return courses
+
+def bench_coalesce(args, results):
+    """连堂课合并：每节一个事件 vs 合并为一个事件，比较事件数、字节数和生成耗时"""
+    print("连堂课合并: 每节一个事件 vs 合并")
+    for ratio in (0.3, 0.6):
+        for size in args.courses:
+            courses = make_block_courses(size, ratio, seed=size)
+            separate = Writer(courses, SEMESTER_START, coalesce=False)
+            merged = Writer(courses, SEMESTER_START, coalesce=True)
+            separate_ics, merged_ics = "".join(separate.iter_ics()), "".join(merged.iter_ics())
+            stats = measure(lambda: "".join(merged.iter_ics()), args.repeat)
+            stats.update(records=len(courses),
+                         separate_events=separate_ics.count("BEGIN:VEVENT"), events=merged_ics.count("BEGIN:VEVENT"),
+                         separate_bytes=len(separate_ics.encode("utf-8")), bytes=len(merged_ics.encode("utf-8")))
+            baseline = measure(lambda: "".join(separate.iter_ics()), args.repeat)
+            report(results, f"coalesce.separate[courses={size}, blocks={ratio}]", baseline)
+            report(results, f"coalesce.merged[courses={size}, blocks={ratio}]", stats,
+                   note=f"  事件 {stats['separate_events']} -> {stats['events']} "
+                        f"({(stats['events'] / stats['separate_events'] - 1) * 100:+.1f}%), "
+                        f"字节 {stats['separate_bytes']} -> {stats['bytes']}")
+
+BENCHMARKS = {
+    'stages': bench_stages,
+    'upload-io': bench_upload_io,
+    'serialize': bench_serializers,
+    'users': bench_user_store,
+    'feed': bench_feed,
+    'compression': bench_compression,
+    'expand': bench_expansion,
+    'free-slots': bench_free_slots,
+    'week-rules': bench_week_rules,
+    'coalesce': bench_coalesce,
+}
+
+def compare_with_baseline(results, baseline_path, threshold):
+    """与基线对比，返回变慢超过阈值的项"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)["results"]
+
+    print(f"\n与基线对比 ({baseline_path})")
+    regressions = []
+    for key, stats in results.items():
+        if key not in baseline:
+            continue
+        ratio = stats["mean_ms"] / baseline[key]["mean_ms"] if baseline[key]["mean_ms"] else 1.0
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  ⚠️ 变慢"
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = "  ✅ 变快"
+        print(f"  {key:<48} {baseline[key]['mean_ms']:>10.3f}ms -> {stats['mean_ms']:>10.3f}ms ({(ratio - 1) * 100:+.1f}%){flag}")
+    return regressions
+
+def parse_week_mix(value):
+    """解析 "continuous=0.6,discontinuous=0.2,interval=0.2" """
+    mix = {}
+    for item in value.split(","):
+        week_type, _, weight = item.partition("=")
+        mix[week_type.strip()] = float(weight)
+    return mix
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="课表日历生成器性能基准")
+    arg_parser.add_argument("--only", choices=sorted(BENCHMARKS), action="append",
+                            help="只运行指定的基准，可重复指定")
+    arg_parser.add_argument("--courses", type=int, nargs="+", default=[10, 50, 200],
+                            help="合成课表的课程数")
+    arg_parser.add_argument("--multi-div", type=float, default=0.2,
+                            help="同一格子多门课的比例")
+    arg_parser.add_argument("--week-mix", type=parse_week_mix, default=DEFAULT_WEEK_MIX,
+                            help="周数格式比例，如 continuous=0.6,discontinuous=0.2,interval=0.2")
+    arg_parser.add_argument("--repeat", type=int, default=20)
+    arg_parser.add_argument("--requests", type=int, default=200)
+    arg_parser.add_argument("--workers", type=int, default=4)
+    arg_parser.add_argument("--save", help="把结果保存为JSON")
+    arg_parser.add_argument("--baseline", help="与之对比的基线JSON")
+    arg_parser.add_argument("--threshold", type=float, default=0.1,
+                            help="与基线相比变慢超过该比例视为退化")
+    args = arg_parser.parse_args()
+
+    # ics 库的 str(Component) 会提示 FutureWarning，基准中不需要
+    warnings.simplefilter("ignore", FutureWarning)
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        BENCHMARKS[name](args, results)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({
+                "meta": {
+                    "timestamp": datetime.now().isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "args": {key: value for key, value in vars(args).items() if key not in ("save", "baseline")},
+                },
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.save}")
+
+    if args.baseline and compare_with_baseline(results, args.baseline, args.threshold):
+        sys.exit(1)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+CalDAV 客户端
+
+通过 HTTP 把课表写入 Radicale：MKCALENDAR 创建日历，每个事件单独 PUT 一个日历对象。
+所有请求共用一个带连接池的 requests.Session（keep-alive），失败时按指数退避重试，
+事件较多时并行 PUT。
+"""
+
+import os
+import re
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import quote, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# 并行 PUT 的线程数（同时也是连接池大小）
+CALDAV_PUT_WORKERS = int(os.environ.get('CALDAV_PUT_WORKERS', 8))
+# 失败重试次数（连接错误、429、5xx）
+CALDAV_RETRIES = int(os.environ.get('CALDAV_RETRIES', 3))
+# 单个请求超时（秒）
+CALDAV_TIMEOUT = float(os.environ.get('CALDAV_TIMEOUT', 10))
+
+VEVENT_RE = re.compile(r'BEGIN:VEVENT\r?\n.*?END:VEVENT\r?\n', re.DOTALL)
+VTIMEZONE_RE = re.compile(r'BEGIN:VTIMEZONE\r?\n.*?END:VTIMEZONE\r?\n', re.DOTALL)
+UID_RE = re.compile(r'^UID:(.*)$', re.MULTILINE)
+SUMMARY_RE = re.compile(r'^SUMMARY:(.*)$', re.MULTILINE)
+LOCATION_RE = re.compile(r'^LOCATION:(.*)$', re.MULTILINE)
+FOLD_RE = re.compile(r'\r?\n[ \t]')
+ESCAPED_RE = re.compile(r'\\([\\;,nN])')
+PRODID_RE = re.compile(r'^PRODID:.*$', re.MULTILINE)
+
+MKCALENDAR_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<C:mkcalendar xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+    '<D:set><D:prop>'
+    '<D:displayname>{name}</D:displayname>'
+    '<C:supported-calendar-component-set><C:comp name="VEVENT"/></C:supported-calendar-component-set>'
+    '</D:prop></D:set>'
+    '</C:mkcalendar>'
+)
+
+PROPFIND_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<D:propfind xmlns:D="DAV:"><D:prop><D:getetag/></D:prop></D:propfind>'
+)
+
+REPORT_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+    '<D:prop><D:getetag/><C:calendar-data/></D:prop>'
+    '<C:filter><C:comp-filter name="VCALENDAR"/></C:filter>'
+    '</C:calendar-query>'
+)
+
+class CalDAVError(Exception):
+    """CalDAV 请求失败"""
+
+def split_calendar(ics_content: str) -> List[Tuple[str, str]]:
+    """
+    把一个日历拆成每个事件一个日历对象
+    :return: [(UID, 只含这一个 VEVENT 的 VCALENDAR 文本)]
+    """
+    prodid = PRODID_RE.search(ics_content)
+    header = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\n"
+    if prodid:
+        header += prodid.group(0).rstrip('\r') + "\r\n"
+    # 本地时间模式下每个对象都需要带上时区定义
+    timezone = VTIMEZONE_RE.search(ics_content)
+    if timezone:
+        header += timezone.group(0)
+
+    objects = []
+    for match in VEVENT_RE.finditer(ics_content):
+        vevent = match.group(0)
+        # UID 行可能被折行
+        uid = UID_RE.search(FOLD_RE.sub('', vevent))
+        if not uid:
+            raise ValueError("事件缺少UID")
+        objects.append((uid.group(1).strip(), f"{header}{vevent}END:VCALENDAR\r\n"))
+    return objects
+
+def describe_object(body: str) -> Dict[str, str]:
+    """日历对象的标题和地点，用于在差异报告中描述事件"""
+    unfolded = FOLD_RE.sub('', body)
+    info = {}
+    for key, pattern in (('summary', SUMMARY_RE), ('location', LOCATION_RE)):
+        match = pattern.search(unfolded)
+        if match:
+            value = match.group(1).rstrip('\r')
+            info[key] = ESCAPED_RE.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+    return info
+
+def object_name(uid: str) -> str:
+    """日历对象的文件名（URL 最后一段），HTTP 和直接写数据目录两种方式一致"""
+    return f"{quote(uid, safe='@')}.ics"
+
+def uid_from_name(name: str) -> str:
+    """object_name() 的逆运算"""
+    return unquote(name[:-len('.ics')] if name.endswith('.ics') else name)
+
+class CalDAVClient:
+    """带连接池和重试的 CalDAV 客户端"""
+
+    def __init__(self, base_url: str, workers: int = CALDAV_PUT_WORKERS, retries: int = CALDAV_RETRIES,
+                 timeout: float = CALDAV_TIMEOUT):
+        """
+        :param base_url: CalDAV 服务地址，如 http://radicale:5232
+        :param workers: 并行 PUT 的线程数
+        :param retries: 失败重试次数
+        :param timeout: 单个请求超时（秒）
+        """
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'PUT', 'DELETE', 'PROPFIND', 'REPORT', 'MKCALENDAR'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def calendar_url(self, username: str, calendar_name: str) -> str:
+        """日历集合的 URL"""
+        return f"{self.base_url}/{quote(username)}/{quote(calendar_name)}/"
+
+    def make_calendar(self, username: str, password: str, calendar_name: str) -> bool:
+        """创建日历，返回是否新建（已存在时返回 False）"""
+        response = self.session.request(
+            'MKCALENDAR', self.calendar_url(username, calendar_name),
+            data=MKCALENDAR_BODY.format(name=escape(calendar_name)).encode('utf-8'),
+            headers={'Content-Type': 'application/xml; charset=utf-8'},
+            auth=(username, password), timeout=self.timeout,
+        )
+        if response.status_code == 201:
+            return True
+        # 已存在：Radicale 返回 409（resource-must-be-null），其他服务器可能返回 405
+        if response.status_code in (405, 409):
+            return False
+        raise CalDAVError(f"创建日历失败: HTTP {response.status_code}")
+
+    def put_object(self, username: str, password: str, calendar_name: str, uid: str, body: str) -> int:
+        """写入一个日历对象，返回 HTTP 状态码"""
+        url = f"{self.calendar_url(username, calendar_name)}{object_name(uid)}"
+        response = self.session.put(
+            url, data=body.encode('utf-8'),
+            headers={'Content-Type': 'text/calendar; charset=utf-8'},
+            auth=(username, password), timeout=self.timeout,
+        )
+        if response.status_code not in (200, 201, 204):
+            raise CalDAVError(f"写入事件 {uid} 失败: HTTP {response.status_code}")
+        return response.status_code
+
+    def delete_object(self, username: str, password: str, calendar_name: str, uid: str) -> bool:
+        """删除一个日历对象，对象不存在时返回 False"""
+        url = f"{self.calendar_url(username, calendar_name)}{object_name(uid)}"
+        response = self.session.delete(url, auth=(username, password), timeout=self.timeout)
+        if response.status_code == 404:
+            return False
+        if response.status_code not in (200, 204):
+            raise CalDAVError(f"删除事件 {uid} 失败: HTTP {response.status_code}")
+        return True
+
+    def list_objects(self, username: str, password: str, calendar_name: str) -> List[str]:
+        """列出日历中所有对象的 UID，日历不存在时返回空列表"""
+        response = self.session.request(
+            'PROPFIND', self.calendar_url(username, calendar_name),
+            data=PROPFIND_BODY.encode('utf-8'),
+            headers={'Content-Type': 'application/xml; charset=utf-8', 'Depth': '1'},
+            auth=(username, password), timeout=self.timeout,
+        )
+        if response.status_code == 404:
+            return []
+        if response.status_code != 207:
+            raise CalDAVError(f"读取日历失败: HTTP {response.status_code}")
+        uids = []
+        for href in ElementTree.fromstring(response.content).iter('{DAV:}href'):
+            name = urlsplit(href.text or '').path.rstrip('/').rsplit('/', 1)[-1]
+            if name.endswith('.ics'):
+                uids.append(uid_from_name(name))
+        return uids
+
+    def fetch_objects(self, username: str, password: str, calendar_name: str) -> Dict[str, str]:
+        """
+        用 REPORT calendar-query 读取日历中所有对象的内容 {UID: 日历对象文本}，日历不存在时返回空字典
+        服务器不支持 REPORT 时抛出 CalDAVError
+        """
+        response = self.session.request(
+            'REPORT', self.calendar_url(username, calendar_name),
+            data=REPORT_BODY.encode('utf-8'),
+            headers={'Content-Type': 'application/xml; charset=utf-8', 'Depth': '1'},
+            auth=(username, password), timeout=self.timeout,
+        )
+        if response.status_code == 404:
+            return {}
+        if response.status_code != 207:
+            raise CalDAVError(f"读取日历内容失败: HTTP {response.status_code}")
+        objects = {}
+        for item in ElementTree.fromstring(response.content).iter('{DAV:}response'):
+            href = item.find('{DAV:}href')
+            data = item.find('.//{urn:ietf:params:xml:ns:caldav}calendar-data')
+            if href is None or data is None or not data.text:
+                continue
+            name = urlsplit(href.text or '').path.rstrip('/').rsplit('/', 1)[-1]
+            if name.endswith('.ics'):
+                objects[uid_from_name(name)] = data.text
+        return objects
+
+    def apply_changes(self, username: str, password: str, calendar_name: str,
+                      puts: List[Tuple[str, str]], deletes: List[str]) -> None:
+        """并行写入和删除日历对象，请求数与变化的事件数成正比"""
+        tasks = [lambda item=item: self.put_object(username, password, calendar_name, *item) for item in puts]
+        tasks += [lambda uid=uid: self.delete_object(username, password, calendar_name, uid) for uid in deletes]
+        self._run(tasks)
+
+    def upload_calendar(self, username: str, password: str, calendar_name: str, ics_content: str) -> Dict[str, int]:
+        """创建日历并逐个事件 PUT，事件多时并行执行（不与已有内容比较，应用中由 RadicaleIntegration 只写入差异）"""
+        objects = split_calendar(ics_content)
+        self.make_calendar(username, password, calendar_name)
+
+        statuses = self._run([
+            lambda item=item: self.put_object(username, password, calendar_name, *item) for item in objects
+        ])
+
+        return {
+            'events': len(objects),
+            'created': sum(1 for status in statuses if status == 201),
+            'updated': sum(1 for status in statuses if status != 201),
+        }
+
+    def _run(self, tasks: List[Callable]) -> List:
+        """执行一组请求，多于一个时在线程池中并行"""
+        if len(tasks) <= 1 or self.workers <= 1:
+            return [task() for task in tasks]
+        return list(self._get_executor().map(lambda task: task(), tasks))
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='caldav-put')
+            return self._executor
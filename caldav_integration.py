@@ -2,34 +2,58 @@
 # -*- coding: utf-8 -*-
 
 import os
-import subprocess
-import hashlib
+import json
+import uuid
 import logging
-from typing import Dict, Optional
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from user_store import HtpasswdUserStore
+from credential_pool import credential_pool
+from caldav_client import CalDAVClient, CalDAVError, describe_object, object_name, split_calendar, uid_from_name
+from calendar_state import CalendarState, event_digest, object_digest
+from metrics import stage
 
 logger = logging.getLogger(__name__)
 
+# 日历写入方式："http" 通过 CalDAV 协议写入（默认）；"filesystem" 直接写 Radicale 数据目录（需要共享数据卷）
+CALDAV_UPLOAD_MODE = os.environ.get('CALDAV_UPLOAD_MODE', 'http')
+# 应用访问 Radicale 的内部地址（如 docker-compose 中的 http://radicale:5232），默认与对外地址相同
+RADICALE_INTERNAL_URL = os.environ.get(
+    'RADICALE_INTERNAL_URL', os.environ.get('RADICALE_SERVER_URL', 'http://localhost:5232'))
+
 class RadicaleIntegration:
     """Radicale CalDAV服务集成"""
     
-    def __init__(self, radicale_config_path: str = "/config"):
+    def __init__(self, radicale_config_path: str = "/config", upload_mode: str = CALDAV_UPLOAD_MODE,
+                 server_url: str = RADICALE_INTERNAL_URL, data_path: str = "/data"):
         self.config_path = radicale_config_path
         self.users_file = os.path.join(radicale_config_path, "users")
+        self.user_store = HtpasswdUserStore(self.users_file)
+        self.upload_mode = upload_mode
+        self.data_path = data_path
+        self.caldav_client = CalDAVClient(server_url)
+        self.calendar_state = CalendarState(os.environ.get(
+            'CALDAV_STATE_PATH', os.path.join(radicale_config_path, 'calendars.sqlite3')))
         
-    def create_user(self, username: str, password: str) -> bool:
-        """创建Radicale用户"""
+    def create_user(self, username: str, password: str, password_hash: Optional[str] = None) -> bool:
+        """
+        创建Radicale用户
+        :param password_hash: 预先计算好的密码哈希，不提供时在哈希进程池中计算
+        """
         try:
             # 生成bcrypt密码哈希
-            hashed_password = self._hash_password_bcrypt(password)
-            
-            # 读取现有用户文件
-            users = self._read_users_file()
-            
-            # 添加新用户
-            users[username] = hashed_password
+            hashed_password = password_hash or credential_pool.hash(password)
             
-            # 写回用户文件
-            self._write_users_file(users)
+            # 追加到用户文件（文件锁保证多个worker同时创建时不丢用户）
+            with stage('user_store_write'):
+                self.user_store.add(username, hashed_password)
             
             logger.info(f"用户 {username} 创建成功")
             return True
@@ -41,10 +65,7 @@ class RadicaleIntegration:
     def delete_user(self, username: str) -> bool:
         """删除Radicale用户"""
         try:
-            users = self._read_users_file()
-            if username in users:
-                del users[username]
-                self._write_users_file(users)
+            if self.user_store.delete(username):
                 logger.info(f"用户 {username} 删除成功")
                 return True
             return False
@@ -53,73 +74,199 @@ class RadicaleIntegration:
             logger.error(f"删除用户失败: {str(e)}")
             return False
     
-    def upload_calendar(self, username: str, calendar_name: str, ics_content: str) -> bool:
-        """上传日历到Radicale"""
+    def upload_calendar(self, username: str, calendar_name: str, ics_content: str,
+                        password: Optional[str] = None, semester_start: Optional[date] = None) -> bool:
+        """
+        上传日历到Radicale
+        :param password: 用户密码，通过 CalDAV 协议写入时用于认证
+        :param semester_start: 生成日历使用的学期开始日期，之后更新课表时沿用
+        """
         try:
-            # 创建用户目录
-            user_dir = os.path.join("/data", username)
-            os.makedirs(user_dir, exist_ok=True)
+            with stage('calendar_upload'):
+                if self.upload_mode != 'filesystem':
+                    # 与已写入的事件比较，只 PUT 变化的、删除已不存在的；重复上传不产生任何写入
+                    diff = self.sync_calendar(username, password, calendar_name, [
+                        (uid, body, describe_object(body)) for uid, body in split_calendar(ics_content)
+                    ], semester_start)
+                    return diff is not None
+                result = self.write_collection(username, calendar_name, ics_content)
+                logger.info(f"日历 {calendar_name} 上传成功: {result}")
             
-            # 创建日历文件
-            calendar_file = os.path.join(user_dir, f"{calendar_name}.ics")
-            with open(calendar_file, 'w', encoding='utf-8') as f:
-                f.write(ics_content)
-            
-            logger.info(f"日历 {calendar_name} 上传成功")
+            # 记录写入的事件，之后更新课表时只写入差异
+            self.calendar_state.replace(username, calendar_name, [
+                (uid, object_digest(body), describe_object(body)) for uid, body in split_calendar(ics_content)
+            ], semester_start)
             return True
             
         except Exception as e:
             logger.error(f"上传日历失败: {str(e)}")
             return False
     
-    def _hash_password_bcrypt(self, password: str) -> str:
-        """使用bcrypt哈希密码"""
-        try:
-            import bcrypt
-            salt = bcrypt.gensalt()
-            hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
-            return hashed.decode('utf-8')
-        except ImportError:
-            # 如果没有bcrypt，使用htpasswd命令
-            return self._hash_password_htpasswd(password)
-    
-    def _hash_password_htpasswd(self, password: str) -> str:
-        """使用htpasswd命令哈希密码"""
+    def sync_calendar(self, username: str, password: str, calendar_name: str,
+                      objects: List[Tuple[str, str, Dict]], semester_start: Optional[date] = None) -> Optional[Dict]:
+        """
+        用新的事件集合更新已有日历：按 UID（即课程号、班号、星期、节次）与已写入的事件比较，
+        只写入新增和修改的事件、删除已不存在的事件
+        :param objects: [(UID, 日历对象文本, 课程信息)]，来自 Writer.iter_objects()
+        :param semester_start: 生成事件使用的学期开始日期，记录下来供之后的更新使用
+        :return: 差异 {'added': [...], 'modified': [...], 'deleted': [...], 'unverified': [...], 'unchanged': 数量}，
+                 unverified 为无法读取内容、不知道是否变化而重新写入的事件；失败时返回 None
+        """
         try:
-            # 使用htpasswd命令生成bcrypt哈希
-            result = subprocess.run([
-                'htpasswd', '-nbB', 'temp_user', password
-            ], capture_output=True, text=True)
+            stored = self.calendar_state.load(username, calendar_name)
+            first_sync = stored is None
+            digest = object_digest
+            if first_sync:
+                # 没有记录（如更早创建的账户）：以日历中现有的事件为准，按事件属性比较（服务器可能重新序列化）
+                stored = self._existing_objects(username, password, calendar_name)
+                digest = event_digest
+            
+            new = {uid: (digest(body), body, info) for uid, body, info in objects}
+            added = [uid for uid in new if uid not in stored]
+            unverified = [uid for uid in new if uid in stored and stored[uid][0] is None]
+            modified = [uid for uid in new
+                        if uid in stored and stored[uid][0] is not None and stored[uid][0] != new[uid][0]]
+            deleted = [uid for uid in stored if uid not in new]
+            puts = [(uid, new[uid][1]) for uid in added + modified + unverified]
+            
+            with stage('calendar_sync'):
+                if self.upload_mode == 'filesystem':
+                    collection = self.collection_path(username, calendar_name)
+                    self._write_objects(collection, calendar_name, puts, [object_name(uid) for uid in deleted])
+                else:
+                    if first_sync:
+                        self.caldav_client.make_calendar(username, password, calendar_name)
+                    self.caldav_client.apply_changes(username, password, calendar_name, puts, deleted)
             
-            if result.returncode == 0:
-                # 提取哈希部分
-                return result.stdout.split(':')[1].strip()
+            if first_sync:
+                # 第一次同步后日历中就是新的事件集合，全部记录（包括未变化的）
+                self.calendar_state.replace(username, calendar_name, [
+                    (uid, object_digest(body), info) for uid, (_, body, info) in new.items()
+                ], semester_start)
             else:
-                raise Exception(f"htpasswd命令失败: {result.stderr}")
-                
+                self.calendar_state.apply(
+                    username, calendar_name,
+                    [(uid, new[uid][0], new[uid][2]) for uid in added + modified],
+                    deleted, semester_start,
+                )
+            logger.info(f"日历 {calendar_name} 更新成功: 新增 {len(added)}，修改 {len(modified)}，"
+                        f"删除 {len(deleted)}，未能比较 {len(unverified)}")
+            return {
+                'added': [dict(new[uid][2], uid=uid) for uid in added],
+                'modified': [dict(new[uid][2], uid=uid) for uid in modified],
+                'deleted': [dict(stored[uid][1], uid=uid) for uid in deleted],
+                'unverified': [dict(new[uid][2], uid=uid) for uid in unverified],
+                'unchanged': len(new) - len(added) - len(modified) - len(unverified),
+            }
+            
         except Exception as e:
-            logger.error(f"密码哈希失败: {str(e)}")
-            # 降级到简单的MD5哈希（不推荐用于生产环境）
-            return hashlib.md5(password.encode()).hexdigest()
+            logger.error(f"更新日历失败: {str(e)}")
+            return None
+    
+    def collection_path(self, username: str, calendar_name: str) -> str:
+        """日历集合在Radicale数据目录中的位置：collection-root/<用户>/<日历>/"""
+        for component in (username, calendar_name):
+            if not component or component.startswith('.') or '/' in component or '\\' in component:
+                raise ValueError(f"非法的集合名称: {component}")
+        return os.path.join(self.data_path, 'collection-root', username, calendar_name)
+    
+    def write_collection(self, username: str, calendar_name: str, ics_content: str) -> Dict[str, int]:
+        """
+        按Radicale文件系统存储格式写入日历集合：每个事件一个文件，.Radicale.props 标记为日历
+        UID 由课程号、班号、时段确定，内容没变的事件不重写，客户端同步时只会拉取变化的事件
+        """
+        collection = self.collection_path(username, calendar_name)
+        objects = {object_name(uid): body for uid, body in split_calendar(ics_content)}
+        
+        # 删除已不存在的事件（以 . 开头的是Radicale的元数据和缓存）
+        stale = []
+        if os.path.isdir(collection):
+            with os.scandir(collection) as it:
+                stale = [entry.name for entry in it
+                         if entry.is_file() and not entry.name.startswith('.') and entry.name not in objects]
+        return self._write_objects(collection, calendar_name, list(objects.items()), stale)
+    
+    def _write_objects(self, collection: str, calendar_name: str, puts: List[Tuple[str, str]],
+                       delete_names: List[str]) -> Dict[str, int]:
+        """在存储锁内写入、删除集合中的文件；puts 为 [(文件名或UID, 内容)]"""
+        result = {'added': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+        with self._storage_lock():
+            os.makedirs(collection, exist_ok=True)
+            props = json.dumps({
+                'C:supported-calendar-component-set': 'VEVENT',
+                'D:displayname': calendar_name,
+                'tag': 'VCALENDAR',
+            }, ensure_ascii=False, sort_keys=True)
+            _write_if_changed(os.path.join(collection, '.Radicale.props'), props)
+            
+            for name, body in puts:
+                if not name.endswith('.ics'):
+                    name = object_name(name)
+                result[_write_if_changed(os.path.join(collection, name), body)] += 1
+            
+            for name in delete_names:
+                try:
+                    os.remove(os.path.join(collection, name))
+                    result['deleted'] += 1
+                except FileNotFoundError:
+                    pass
+        return result
     
-    def _read_users_file(self) -> Dict[str, str]:
-        """读取用户文件"""
-        users = {}
-        if os.path.exists(self.users_file):
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and ':' in line:
-                        username, password_hash = line.split(':', 1)
-                        users[username] = password_hash
-        return users
+    def _existing_objects(self, username: str, password: str, calendar_name: str) -> Dict[str, Tuple[Optional[str], Dict]]:
+        """
+        读取日历中已有的事件 {UID: (event_digest 摘要, 课程信息)}
+        HTTP 方式用 REPORT 读取内容；服务器不支持时只能列出 UID，摘要为 None
+        """
+        if self.upload_mode != 'filesystem':
+            try:
+                bodies = self.caldav_client.fetch_objects(username, password, calendar_name)
+            except CalDAVError as e:
+                logger.warning(f"读取日历内容失败，无法比较已有事件: {str(e)}")
+                return {uid: (None, {}) for uid in self.caldav_client.list_objects(username, password, calendar_name)}
+            return {uid: (event_digest(body), describe_object(body)) for uid, body in bodies.items()}
+        
+        collection = self.collection_path(username, calendar_name)
+        existing = {}
+        if os.path.isdir(collection):
+            with os.scandir(collection) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        with open(entry.path, 'r', encoding='utf-8') as f:
+                            body = f.read()
+                        existing[uid_from_name(entry.name)] = (event_digest(body), describe_object(body))
+        return existing
+    
+    @contextmanager
+    def _storage_lock(self):
+        """与Radicale共用的存储锁（<数据目录>/.Radicale.lock），写入期间Radicale不会读到一半的集合"""
+        os.makedirs(self.data_path, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.data_path, '.Radicale.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _write_if_changed(path: str, content: str) -> str:
+    """内容不同时才写入（写临时文件后原子替换），返回 added / updated / unchanged"""
+    data = content.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return 'unchanged'
+        status = 'updated'
+    except FileNotFoundError:
+        status = 'added'
     
-    def _write_users_file(self, users: Dict[str, str]) -> None:
-        """写入用户文件"""
-        os.makedirs(os.path.dirname(self.users_file), exist_ok=True)
-        with open(self.users_file, 'w', encoding='utf-8') as f:
-            for username, password_hash in users.items():
-                f.write(f"{username}:{password_hash}\n")
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return status
 
 # 全局实例
 radicale_integration = RadicaleIntegration()
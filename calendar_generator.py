@@ -3,41 +3,44 @@
 
 import os
 import re
-from datetime import datetime, timedelta
+import codecs
+import hashlib
+from collections import namedtuple
+from datetime import datetime, date, time, timedelta
 from bs4 import BeautifulSoup
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:
+    etree = lxml_html = None
 from ics import Calendar, Event
 from ics.grammar.parse import ContentLine
 import pytz
 import logging
 
+from course_model import (Course, as_courses, first_week_of, mask_from_week_data, mask_interval, mask_to_weeks,
+                          week_data_from_mask, weeks_to_mask)
+from holiday_table import HOLIDAY_TABLE
+from lesson_blocks import MAX_GAP_MINUTES, coalesce_lessons, single_block
+from metrics import stage, timed_iter
+from slot_table import SLOT_TABLE
+from week_rules import WeekRun, decompose_weeks
+
 logger = logging.getLogger(__name__)
 
-# 添加时区 Asia/Shanghai
-SHANGHAI_TZ = pytz.timezone("Asia/Shanghai")
+# 默认的HTML解析引擎，可通过环境变量切换回 bs4
+PARSER_ENGINE = os.environ.get("PARSER_ENGINE", "lxml")
 
-# 课程时间段对应的具体时间
-TIME_SLOTS = {
-    1: "08:00",
-    2: "10:10",
-    3: "12:10",
-    4: "14:10",
-    5: "16:20",
-    6: "19:00",
-    7: "21:00",
-}
+# 默认的ICS序列化方式："native" 直接输出文本，"ics" 使用 ics 库的对象模型
+ICS_SERIALIZER = os.environ.get("ICS_SERIALIZER", "native")
 
-# 错峰上课时间段
-# 思源西楼、逸夫楼第二节课错后20分钟，其余不变
-STAGGERED_KEYWORD = ['思源西楼','逸夫教学楼']
-STAGGERED_TIME_SLOTS = {
-    1: "08:00",
-    2: "10:30",
-    3: "12:10",
-    4: "14:10",
-    5: "16:20",
-    6: "19:00",
-    7: "21:00",
-}
+# 事件时间格式："utc" 全部换算为UTC；"local" 使用 TZID 本地时间并附带一个共享的 VTIMEZONE（仅原生序列化支持）
+ICS_TIME_MODE = os.environ.get("ICS_TIME_MODE", "utc")
+
+# 是否把连堂课（同一天相邻节次的同一门课）合并为一个事件，设置为 0 时每一节一个事件
+COALESCE_LESSONS = os.environ.get("COALESCE_LESSONS", "1") != "0"
+
+# 添加时区 Asia/Shanghai
+SHANGHAI_TZ = pytz.timezone("Asia/Shanghai")
 
 # 星期映射 (iCalendar 格式)
 WEEKDAY_MAP = {
@@ -50,38 +53,63 @@ WEEKDAY_MAP = {
     7: "SU"
 }
 
+def output_fingerprint():
+    """影响生成结果的配置（作息表、节假日、时间格式、序列化方式、连堂合并），用于区分结果缓存"""
+    coalesce = f"coalesce={MAX_GAP_MINUTES}" if COALESCE_LESSONS else "separate"
+    return f"{SLOT_TABLE.fingerprint}|{HOLIDAY_TABLE.fingerprint}|{ICS_TIME_MODE}|{ICS_SERIALIZER}|{coalesce}"
+
 class BJTUCalendarGenerator:
     """北京交通大学课表日历生成器"""
     
     def __init__(self):
         pass
 
-    def generate_from_html(self, html_file_path, semester_start=None):
-        """从HTML文件生成ICS日历内容"""
+    def generate_from_html(self, source, semester_start=None, serializer=None):
+        """
+        从课表HTML生成ICS日历内容
+        :param source: HTML文件路径、HTML文本、原始字节或可读的文件对象（如上传流）
+        :param semester_start: 学期开始日期 (datetime 类型)
+        :param serializer: "native" 或 "ics"，默认取 ICS_SERIALIZER
+        """
         try:
-            # 如果没有提供学期开始日期，使用默认值
-            if semester_start is None:
-                semester_start = self._get_default_semester_start()
-            
-            # 解析HTML文件
-            parser = Parser(html_file_path)
-            data = parser.parse()
-            
-            if not data:
-                raise ValueError("未能从HTML文件中解析出课程信息")
-            
-            # 生成ICS内容
-            writer = Writer(data, semester_start)
-            cal = writer.generate_ics()
-            
-            # 转换为字符串
-            ics_content = str(cal)
-            return ics_content
-            
+            _, chunks = self.iter_from_html(source, semester_start, serializer)
+            return "".join(chunks)
+
         except Exception as e:
             logger.error(f"生成ICS文件时出错: {str(e)}")
             raise
 
+    def iter_from_html(self, source, semester_start=None, serializer=None):
+        """
+        与 generate_from_html 相同，但只在调用时完成解析，ICS文本在迭代时逐段生成，用于流式响应；
+        解析失败在调用时立即抛出，而不是在开始输出之后
+        :return: (解析出的 Course 列表, ICS文本片段的迭代器)
+        """
+        semester_start = self.resolve_semester_start(semester_start)
+
+        # 解析HTML内容
+        parser = Parser(source)
+        data = parser.parse_courses()
+
+        if not data:
+            raise ValueError("未能从HTML文件中解析出课程信息")
+
+        # 生成ICS内容
+        writer = Writer(data, semester_start)
+        if (serializer or ICS_SERIALIZER) == "ics":
+            with stage("build_events"):
+                calendar = writer.generate_ics()
+            with stage("serialize"):
+                return data, iter([str(calendar)])
+        # 原生序列化边生成事件边输出文本，两个阶段合并计时
+        return data, timed_iter("render", writer.iter_ics())
+
+    def resolve_semester_start(self, semester_start=None):
+        """如果没有提供学期开始日期，使用默认值"""
+        if semester_start is None:
+            return self._get_default_semester_start()
+        return semester_start
+
     def _get_default_semester_start(self):
         """获取默认学期开始日期"""
         # 默认使用当前年份的9月第一个周一
@@ -101,15 +129,73 @@ class BJTUCalendarGenerator:
         semester_start = september_first + timedelta(days=days_ahead)
         return semester_start
 
+# 探测字符集时只检查文档开头的这部分字节
+CHARSET_SNIFF_BYTES = 2048
+META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?\s*([A-Za-z0-9_-]+)""", re.IGNORECASE)
+
+def read_html_source(source):
+    """
+    读取课表HTML的原始字节
+    source 可以是文件路径、bytes 或带 read() 方法的文件对象（上传流、SpooledTemporaryFile 等）
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, "read"):
+        # 上传流可能已经被读过一部分，从头开始读取
+        if hasattr(source, "seek"):
+            try:
+                source.seek(0)
+            except (OSError, ValueError):
+                pass
+        data = source.read()
+        if isinstance(data, str):
+            return data.encode("utf-8")
+        return data
+    with open(source, "rb") as f:
+        return f.read()
+
+def decode_html(raw):
+    """
+    对原始字节只做一次字符集探测并解码
+    顺序：BOM -> <meta charset> -> UTF-8 -> GB18030（兼容旧版教务系统导出的GBK页面）
+    """
+    if raw.startswith(codecs.BOM_UTF8):
+        return raw[len(codecs.BOM_UTF8):].decode("utf-8")
+    if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return raw.decode("utf-16")
+    
+    match = META_CHARSET_RE.search(raw[:CHARSET_SNIFF_BYTES])
+    if match:
+        try:
+            return raw.decode(match.group(1).decode("ascii"))
+        except (LookupError, UnicodeDecodeError):
+            pass
+    
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("gb18030", errors="replace")
+
+def load_html(source):
+    """返回解码后的HTML文本；已经解码的HTML文本直接返回"""
+    if isinstance(source, str) and source.lstrip().startswith("<"):
+        return source
+    return decode_html(read_html_source(source))
+
 class Parser:
     """课表HTML解析器"""
     
-    def __init__(self, file_path):
-        self.file_path = file_path
+    def __init__(self, source, engine=None):
+        """
+        :param source: HTML文件路径、HTML文本、原始字节或可读的文件对象
+        :param engine: 解析引擎名称（"lxml" 或 "bs4"），默认取 PARSER_ENGINE
+        """
+        self.source = source
+        self.engine = engine or PARSER_ENGINE
 
     def parse(self):
         """
-        解析课表 HTML 文件，返回解析后的数据
+        解析课表 HTML 文件，返回解析后的数据（兼容格式，由 parse_courses() 的结果转换而来）
         数据格式：
         [
             {
@@ -146,14 +232,83 @@ class Parser:
             }
         ]
         """
+        return [course.to_dict() for course in self.parse_courses()]
+
+    def parse_courses(self):
+        """解析课表 HTML 文件，返回 Course 列表"""
+        html = load_html(self.source)
         
-        # 解析后的数据
+        with stage("html_parse"):
+            try:
+                entries = get_parser_engine(self.engine).extract(html)
+            except ValueError:
+                raise
+            except Exception as e:
+                # 快速引擎处理不了的页面退回到 BeautifulSoup
+                logger.warning(f"{self.engine} 引擎解析失败，改用 bs4: {str(e)}")
+                entries = BeautifulSoupEngine().extract(html)
+        
+        # 解析后的数据（课程信息、周数、地点）
         parsed_data = []
         
-        with open(self.file_path, "r", encoding="utf-8") as f:
-            html = f.read()
+        with stage("course_parse"):
+            for lesson_idx, weekday_idx, course_info, week_teacher_text, location_text in entries:
+                try:
+                    parsed_data.append(self._parse_entry(lesson_idx, weekday_idx, course_info, week_teacher_text, location_text))
+                except Exception as e:
+                    logger.warning(f"解析课程信息时出错: {str(e)}")
+                    continue
+
+        return parsed_data
+
+    def _parse_entry(self, lesson_idx, weekday_idx, course_info, week_teacher_text, location_text):
+        """把引擎提取出的单元格文本转换为 Course"""
+        if course_info is None:
+            raise ValueError("缺少课程名称")
+        if week_teacher_text is None:
+            raise ValueError("缺少上课周数和老师")
+        
+        # 解析课程信息
+        course_id, class_id, name = re.match(r"(\w+) \[(\w+)\]\s+(.+)", course_info.strip()).groups()
         
-        # 使用 BeautifulSoup 解析 HTML
+        # 解析上课周数和老师
+        weeks_str, teacher_str = week_teacher_text.strip().split("\n")
+        # 去除老师前面的空格
+        teacher = teacher_str.strip()
+        # 识别周数格式
+        weeks = mask_from_week_data(*week_type_detect(weeks_str))
+        
+        # 解析上课地点
+        # 20250905 修改：发现学校教务系统添加了校区信息，并且分隔使用", " 这里暂时只取第2个和第3个
+        if location_text is not None:
+            location = location_text.strip().split(", ")
+            if len(location) >= 3:
+                location = location[1] + " " + location[2]
+            else:
+                location = location_text.strip()
+        else:
+            location = "未知地点"
+        
+        return Course(
+            course_id=course_id,
+            class_id=class_id,
+            name=name,
+            weekday=weekday_idx,
+            lesson=lesson_idx,
+            teacher=teacher,
+            location=location,
+            weeks=weeks,
+        )
+
+class BeautifulSoupEngine:
+    """
+    基于 BeautifulSoup(html.parser) 的解析引擎，兼容性最好，作为后备引擎
+    extract() 返回 (节次, 星期, 课程文本, 周数和老师文本, 地点文本) 列表，缺失的字段为 None
+    """
+    
+    name = "bs4"
+    
+    def extract(self, html):
         soup = BeautifulSoup(html, "html.parser")
         
         # 选择表格：<table class="table table-bordered">
@@ -167,6 +322,8 @@ class Parser:
             else:
                 raise ValueError("未找到课表表格")
         
+        entries = []
+        
         # 选择表格中的所有行：<tr>
         rows = table.find_all("tr")
         
@@ -182,46 +339,74 @@ class Parser:
                 
                 # 遍历每一个div
                 for div in cell.find_all("div", recursive=False):
-                    try:
-                        # 解析课程信息
-                        course_info = div.find("span").get_text().strip()
-                        course_id, class_id, name = re.match(r"(\w+) \[(\w+)\]\s+(.+)", course_info).groups()
-                        
-                        # 解析上课周数和老师
-                        week_teacher_info = div.find_all("div")[0]
-                        weeks_str, teacher_str = week_teacher_info.get_text().strip().split("\n")
-                        # 去除老师前面的空格
-                        teacher = teacher_str.strip()
-                        # 识别周数格式
-                        time_type, time_data = week_type_detect(weeks_str)
-                        
-                        # 解析上课地点
-                        # 20250905 修改：发现学校教务系统添加了校区信息，并且分隔使用", " 这里暂时只取第2个和第3个
-                        location_spans = div.find_all("span")
-                        if len(location_spans) > 1:
-                            location = location_spans[1].get_text().strip().split(", ")
-                            if len(location) >= 3:
-                                location = location[1] + " " + location[2]
-                            else:
-                                location = location_spans[1].get_text().strip()
-                        else:
-                            location = "未知地点"
-                        
-                        # 保存解析后的数据
-                        parsed_data.append({
-                            "course_id": course_id,
-                            "class_id": class_id,
-                            "name": name,
-                            "time": {"weekday": weekday_idx, "lesson": lesson_idx},
-                            "teacher": teacher,
-                            "location": location,
-                            "weeks": {"type": time_type, "data": time_data}
-                        })
-                    except Exception as e:
-                        logger.warning(f"解析课程信息时出错: {str(e)}")
+                    course_span = div.find("span")
+                    inner_divs = div.find_all("div")
+                    spans = div.find_all("span")
+                    entries.append((
+                        lesson_idx,
+                        weekday_idx,
+                        course_span.get_text() if course_span else None,
+                        inner_divs[0].get_text() if inner_divs else None,
+                        spans[1].get_text() if len(spans) > 1 else None,
+                    ))
+        
+        return entries
+
+class LxmlEngine:
+    """
+    基于 lxml 的解析引擎：用预编译的 XPath 定位课表表格，再沿元素树直接取单元格
+    比 html.parser 快一个数量级，结果与 BeautifulSoupEngine 一致
+    """
+    
+    name = "lxml"
+    
+    TABLE_XPATH = etree.XPath('//table[@class="table table-bordered"]') if etree is not None else None
+    ANY_TABLE_XPATH = etree.XPath('//table') if etree is not None else None
+    
+    def extract(self, html):
+        # 统一按 UTF-8 字节交给 libxml2，避免文档内的编码声明与 str 冲突
+        parser = lxml_html.HTMLParser(encoding="utf-8")
+        root = lxml_html.document_fromstring(html.encode("utf-8"), parser=parser)
+        
+        tables = self.TABLE_XPATH(root) or self.ANY_TABLE_XPATH(root)
+        if not tables:
+            raise ValueError("未找到课表表格")
+        
+        entries = []
+        
+        # 第一行是表头，每行第一个单元格是时间，都不需要解析
+        rows = list(tables[0].iter("tr"))
+        for lesson_idx, row in enumerate(rows[1:], start=1):
+            cells = [child for child in row if child.tag == "td"]
+            for weekday_idx, cell in enumerate(cells[1:], start=1):
+                for div in cell:
+                    if div.tag != "div":
                         continue
+                    spans = list(div.iterdescendants("span"))
+                    inner_div = next(div.iterdescendants("div"), None)
+                    entries.append((
+                        lesson_idx,
+                        weekday_idx,
+                        spans[0].text_content() if spans else None,
+                        inner_div.text_content() if inner_div is not None else None,
+                        spans[1].text_content() if len(spans) > 1 else None,
+                    ))
+        
+        return entries
 
-        return parsed_data
+PARSER_ENGINES = {
+    BeautifulSoupEngine.name: BeautifulSoupEngine,
+    LxmlEngine.name: LxmlEngine,
+}
+
+def get_parser_engine(name):
+    """按名称获取解析引擎，lxml 不可用时退回 bs4"""
+    if name not in PARSER_ENGINES:
+        raise ValueError(f"未知的解析引擎: {name}")
+    if name == LxmlEngine.name and lxml_html is None:
+        logger.warning("lxml 未安装，改用 bs4 解析引擎")
+        name = BeautifulSoupEngine.name
+    return PARSER_ENGINES[name]()
 
 def week_type_detect(weeks_str):
     """
@@ -233,117 +418,277 @@ def week_type_detect(weeks_str):
         - interval: {"start": int, "interval": int, "count": int}
     """
     
-    if "-" in weeks_str:
-        match = re.match(r"第(\d+)-(\d+)周", weeks_str)
-        if match:
-            start_week, end_week = match.groups()
-            time_type = "continuous"
-            time_data = {"start": int(start_week), "end": int(end_week)}
-        else:
-            raise ValueError(f"Unknown week format: {weeks_str}")
-    elif ", " in weeks_str:
-        match = re.match(r"第(.+)周", weeks_str)
-        if match:
-            weeks = match.groups()[0].split(", ")
-            time_type = "discontinuous"
-            time_data = [int(week) for week in weeks]
-            # 进一步判断是否为间隔周数
-            if len(time_data) > 2:
-                interval = time_data[1] - time_data[0]
-                if all(time_data[i] - time_data[i-1] == interval for i in range(1, len(time_data))):
-                    time_type = "interval"
-                    time_data = {"start": time_data[0], "interval": interval, "count": len(time_data)}
-        else:
-            raise ValueError(f"Unknown week format: {weeks_str}")
+    match = re.match(r"第(\d+)-(\d+)周", weeks_str)
+    if match:
+        start_week, end_week = match.groups()
+        time_type = "continuous"
+        time_data = {"start": int(start_week), "end": int(end_week)}
+    elif ", " in weeks_str and "-" not in weeks_str and re.match(r"第(.+)周", weeks_str):
+        weeks = re.match(r"第(.+)周", weeks_str).groups()[0].split(", ")
+        time_type = "discontinuous"
+        time_data = [int(week) for week in weeks]
+        # 进一步判断是否为间隔周数
+        if len(time_data) > 2:
+            interval = time_data[1] - time_data[0]
+            if all(time_data[i] - time_data[i-1] == interval for i in range(1, len(time_data))):
+                time_type = "interval"
+                time_data = {"start": time_data[0], "interval": interval, "count": len(time_data)}
     else:
-        raise ValueError(f"Unknown week format: {weeks_str}")
+        # 区间和单周混合（如 第1-4, 6, 9-16周）或只有一周（第3周）
+        match = re.fullmatch(r"第(\d+(?:-\d+)?(?:, ?\d+(?:-\d+)?)*)周", weeks_str)
+        if not match:
+            raise ValueError(f"Unknown week format: {weeks_str}")
+        weeks = []
+        for part in match.group(1).split(","):
+            first, _, last = part.strip().partition("-")
+            weeks.extend(range(int(first), int(last or first) + 1))
+        time_type, time_data = week_data_from_mask(weeks_to_mask(weeks))
     
     return time_type, time_data
 
+# ICS 中的 PRODID
+PRODID = "-//BJTU iCalendar Generator//CN"
+
+# 按 RFC 5545，每行最多 75 个字节（不含换行），超出部分折行到以空格开头的续行
+MAX_LINE_OCTETS = 75
+
+# 单个事件的字段
+# rdates 为重复规则之外追加的各次开始时间，exdates 为规则中不上课（不在上课周内、节假日）的各次开始时间
+EventFields = namedtuple("EventFields", ["uid", "summary", "location", "start", "end", "rrule", "rdates", "exdates"],
+                         defaults=((), ()))
+
+def course_uid(course, seq=1, part=1):
+    """
+    由课程号、班号、星期和节次生成稳定的UID，重新生成日历时UID不变
+    不规则的上课周拆成多个事件时，第2个起追加段号
+    """
+    key = "|".join(str(value) for value in course.slot_key)
+    if seq > 1:
+        key += f"|{seq}"
+    if part > 1:
+        key += f"#{part}"
+    return f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}@bjtu-icalendar"
+
+def escape_text(value):
+    """转义 TEXT 类型的属性值"""
+    return (value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def fold_line(line):
+    """按字节长度折行，不拆开多字节字符，返回带 CRLF 结尾的文本"""
+    if len(line) * 4 <= MAX_LINE_OCTETS or len(line.encode("utf-8")) <= MAX_LINE_OCTETS:
+        return line + "\r\n"
+
+    parts = []
+    current = []
+    current_octets = 0
+    limit = MAX_LINE_OCTETS
+    for char in line:
+        char_octets = len(char.encode("utf-8"))
+        if current_octets + char_octets > limit:
+            parts.append("".join(current))
+            current = []
+            current_octets = 0
+            limit = MAX_LINE_OCTETS - 1  # 续行开头的空格占 1 个字节
+        current.append(char)
+        current_octets += char_octets
+    parts.append("".join(current))
+    return "\r\n ".join(parts) + "\r\n"
+
+def format_utc(dt):
+    """UTC 时间格式化为 20250908T000000Z"""
+    return dt.astimezone(pytz.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def format_datetime(name, dt, tzid):
+    """日期时间属性：带时区的按UTC输出，不带时区的按 TZID 本地时间输出"""
+    if dt.tzinfo is None:
+        return f"{name};TZID={tzid}:{dt.strftime('%Y%m%dT%H%M%S')}"
+    return f"{name}:{format_utc(dt)}"
+
+def format_datetime_list(name, dts, tzid):
+    """多个值的日期时间属性（如 EXDATE），格式同 format_datetime"""
+    if dts[0].tzinfo is None:
+        return f"{name};TZID={tzid}:" + ",".join(dt.strftime('%Y%m%dT%H%M%S') for dt in dts)
+    return f"{name}:" + ",".join(format_utc(dt) for dt in dts)
+
+def render_vevent(fields, tzid=None):
+    """把事件字段渲染为一个 VEVENT 块"""
+    lines = ["BEGIN:VEVENT"]
+    if fields.rrule:
+        lines.append(f"RRULE:{fields.rrule}")
+    if fields.rdates:
+        lines.append(format_datetime_list("RDATE", fields.rdates, tzid))
+    if fields.exdates:
+        lines.append(format_datetime_list("EXDATE", fields.exdates, tzid))
+    lines.append(format_datetime("DTEND", fields.end, tzid))
+    if fields.location:
+        lines.append(f"LOCATION:{escape_text(fields.location)}")
+    lines.append(format_datetime("DTSTART", fields.start, tzid))
+    if fields.summary:
+        lines.append(f"SUMMARY:{escape_text(fields.summary)}")
+    lines.append(f"UID:{fields.uid}")
+    lines.append("END:VEVENT")
+    return "".join(fold_line(line) for line in lines)
+
 class Writer:
     """ICS文件写入器"""
     
-    def __init__(self, data, semester_start):
+    def __init__(self, data, semester_start, slot_table=None, time_mode=None, holiday_table=None, coalesce=None):
         """
-        :param data: 课程数据列表
+        :param data: 课程数据列表（Course 或 Parser.parse() 的字典格式）
         :param semester_start: 学期开始日期 (datetime 类型)
+        :param slot_table: 上课时间表，默认使用 slot_profiles.json 中的配置
+        :param time_mode: "utc" 或 "local"，默认取 ICS_TIME_MODE
+        :param holiday_table: 节假日表，默认使用 holidays.json 中的配置
+        :param coalesce: 是否合并连堂课，默认取 COALESCE_LESSONS
         """
         self.data = data
+        self.courses = as_courses(data)
         self.semester_start = semester_start  # 例如 datetime(2025, 3, 3)
+        self.slot_table = slot_table or SLOT_TABLE
+        self.time_mode = time_mode or ICS_TIME_MODE
+        self.holiday_table = holiday_table or HOLIDAY_TABLE
+        self.coalesce = COALESCE_LESSONS if coalesce is None else coalesce
 
-    def generate_ics(self):
-        """生成 ICS 日历"""
-        cal = Calendar()
-
-        for course in self.data:
-            course_name = course["name"]
-            teacher = course["teacher"]
-            location = course["location"]
-            weekday = course["time"]["weekday"]
-            lesson = course["time"]["lesson"]
-            weeks_data = course["weeks"]
-
-            # 计算上课开始时间
-            if any(keyword in location for keyword in STAGGERED_KEYWORD):
-                start_time = STAGGERED_TIME_SLOTS.get(lesson)
-            else:
-                start_time = TIME_SLOTS.get(lesson)
-            if not start_time:
+    def _semester_midnight(self):
+        """学期第一天的本地零点（不带时区）"""
+        start = self.semester_start
+        start_date = start.date() if isinstance(start, datetime) else start
+        return datetime.combine(start_date, time())
+
+    def iter_events(self, time_mode=None):
+        """
+        逐个计算课程对应的事件字段，两种序列化方式共用
+        time_mode 为 "utc" 时事件时间是UTC时间，为 "local" 时是不带时区的本地时间
+        """
+        for _, fields in self.iter_course_events(time_mode):
+            yield fields
+
+    def lesson_blocks(self):
+        """要生成事件的时间块：合并连堂课时按块，否则每条记录一个块"""
+        if self.coalesce:
+            return coalesce_lessons(self.courses, self.slot_table)
+        return [single_block(course) for course in self.courses]
+
+    def iter_course_events(self, time_mode=None):
+        """逐个产出 (课程, 事件字段)；连堂课的课程为第一节的记录"""
+        seen_keys = {}
+        slot_table = self.slot_table
+
+        # 学期第一天零点只换算一次时区，之后每个事件只做分钟加法
+        # （作息时区不实行夏令时，偏移量固定）
+        midnight = self._semester_midnight()
+        if (time_mode or self.time_mode) == "local":
+            base = midnight
+        else:
+            base = (midnight - timedelta(minutes=slot_table.utc_offset_minutes(midnight))).replace(tzinfo=pytz.utc)
+        # 每个星期几放假的周位图，与上课周求交集即为要排除的周
+        holiday_masks = self.holiday_table.week_masks(midnight.date())
+
+        for course, last_lesson, _ in self.lesson_blocks():
+            location = course.location
+            weekday = course.weekday
+
+            # 计算上课开始、结束时间（当天的分钟数），连堂课到最后一节下课
+            slot = slot_table.slot(location, course.lesson)
+            if not slot:
                 continue  # 避免无效时间段
+            start_minute, end_minute = slot
+            if last_lesson != course.lesson:
+                end_minute = slot_table.slot(location, last_lesson)[1]
 
-            # 计算课程首次上课日期
-            first_week = self.get_first_week(weeks_data)
-            first_class_date = self.semester_start + timedelta(days=(first_week - 1) * 7 + (weekday - 1))
-            start_dt = datetime.combine(first_class_date, datetime.strptime(start_time, "%H:%M").time())
-            
-            # 转换为 Asia/Shanghai 时区
-            start_dt = SHANGHAI_TZ.localize(start_dt).astimezone(pytz.utc)
-            end_dt = start_dt + timedelta(minutes=110 if lesson != 7 else 50)
+            # 同一门课同一时段出现多次（如前后半学期换教室）时追加序号，保证UID唯一
+            key = course.slot_key
+            seen_keys[key] = seen_keys.get(key, 0) + 1
 
+            # 去掉节假日后的上课周拆成若干段重复规则，缺的周由 EXDATE 排除
+            weeks = course.weeks & ~holiday_masks[weekday]
+            for part, run in enumerate(decompose_weeks(weeks), 1):
+                # 这一段首次上课的日期
+                day_minutes = ((run.start - 1) * 7 + (weekday - 1)) * 1440
+                start_dt = base + timedelta(minutes=day_minutes + start_minute)
+                end_dt = base + timedelta(minutes=day_minutes + end_minute)
+
+                yield course, EventFields(
+                    uid=course_uid(course, seen_keys[key], part),
+                    summary=f"{course.name} - {course.teacher}",
+                    location=location,
+                    start=start_dt,
+                    end=end_dt,
+                    rrule=self.get_run_rrule(run, weekday),
+                    rdates=tuple(start_dt + timedelta(weeks=week - run.start) for week in run.rdates),
+                    exdates=tuple(start_dt + timedelta(weeks=week - run.start) for week in run.exdates),
+                )
+
+    def generate_ics(self):
+        """生成 ICS 日历（ics 库对象模型，事件时间总是UTC）"""
+        cal = Calendar(creator=PRODID)
+
+        for fields in self.iter_events(time_mode="utc"):
             event = Event()
-            event.name = f"{course_name} - {teacher}"
-            event.begin = start_dt
-            event.end = end_dt
-            event.location = location
+            event.name = fields.summary
+            event.begin = fields.start
+            event.end = fields.end
+            event.location = fields.location
+            event.uid = fields.uid
 
             # 生成 RRULE
-            rrule = self.get_rrule(weeks_data, weekday)
-            if rrule:
-                event.extra.append(ContentLine(name="RRULE", value=rrule))  # ✅ 这里使用 ContentLine
+            if fields.rrule:
+                event.extra.append(ContentLine(name="RRULE", value=fields.rrule))  # ✅ 这里使用 ContentLine
+            if fields.rdates:
+                event.extra.append(ContentLine(name="RDATE", value=",".join(format_utc(dt) for dt in fields.rdates)))
+            if fields.exdates:
+                event.extra.append(ContentLine(name="EXDATE", value=",".join(format_utc(dt) for dt in fields.exdates)))
 
             cal.events.add(event)
 
         return cal
 
-    def get_first_week(self, weeks_data):
-        """获取课程的第一次上课周"""
-        if weeks_data["type"] == "continuous":
-            return weeks_data["data"]["start"]
-        elif weeks_data["type"] == "discontinuous":
-            return min(weeks_data["data"])
-        elif weeks_data["type"] == "interval":
-            return weeks_data["data"]["start"]
-        return 1  # 默认第 1 周
+    def iter_ics(self):
+        """
+        直接按 RFC 5545 逐块生成 ICS 文本，不经过 ics 库的对象模型
+        每个 VEVENT 是一个块，属性顺序与 ics 库一致，便于逐字节对比
+        """
+        yield f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:{PRODID}\r\n"
+        tzid = None
+        if self.time_mode == "local":
+            tzid = self.slot_table.timezone_name
+            yield self.slot_table.vtimezone(self._semester_midnight())
+        for fields in self.iter_events():
+            yield render_vevent(fields, tzid)
+        yield "END:VCALENDAR\r\n"
 
-    def get_rrule(self, weeks_data, weekday):
-        """生成 RRULE 规则"""
-        week_day = WEEKDAY_MAP[weekday]
+    def iter_objects(self):
+        """
+        每个事件单独生成一个日历对象，写入 CalDAV 集合时使用
+        产出 (UID, 课程, 只含这一个事件的 VCALENDAR 文本)
+        """
+        header = f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:{PRODID}\r\n"
+        tzid = None
+        if self.time_mode == "local":
+            tzid = self.slot_table.timezone_name
+            header += self.slot_table.vtimezone(self._semester_midnight())
+        for course, fields in self.iter_course_events():
+            yield fields.uid, course, f"{header}{render_vevent(fields, tzid)}END:VCALENDAR\r\n"
 
-        if weeks_data["type"] == "continuous":
-            start = weeks_data["data"]["start"]
-            end = weeks_data["data"]["end"]
-            count = end - start + 1
-            return f"FREQ=WEEKLY;BYDAY={week_day};COUNT={count}"
+    def get_first_week(self, weeks_data):
+        """获取课程的第一次上课周（兼容字典格式的周数据）"""
+        return first_week_of(mask_from_week_data(weeks_data["type"], weeks_data["data"]))
 
-        elif weeks_data["type"] == "discontinuous":
-            weeks = weeks_data["data"]
-            weeks_str = ",".join(str(w) for w in weeks)
-            return f"FREQ=WEEKLY;BYDAY={week_day};BYSETPOS={weeks_str}"
+    def get_rrule(self, weeks_data, weekday):
+        """生成 RRULE 规则（兼容字典格式的周数据）"""
+        return self.get_week_rrule(mask_from_week_data(weeks_data["type"], weeks_data["data"]), weekday)
 
-        elif weeks_data["type"] == "interval":
-            start = weeks_data["data"]["start"]
-            interval = weeks_data["data"]["interval"]
-            count = weeks_data["data"]["count"]
-            return f"FREQ=WEEKLY;INTERVAL={interval};BYDAY={week_day};COUNT={count}"
+    def get_week_rrule(self, weeks, weekday):
+        """由上课周位图生成 RRULE 规则；不规则的周集合需要先用 decompose_weeks() 拆分"""
+        interval = mask_interval(weeks)
+        if interval is None:
+            raise ValueError(f"上课周不是等差序列: {mask_to_weeks(weeks)}")
+        return self.get_run_rrule(WeekRun(first_week_of(weeks), interval, weeks.bit_count(), (), ()), weekday)
 
-        return None
+    def get_run_rrule(self, run, weekday):
+        """一段等差上课周的 RRULE 规则"""
+        week_day = WEEKDAY_MAP[weekday]
+        if run.interval == 1 or run.count == 1:
+            return f"FREQ=WEEKLY;BYDAY={week_day};COUNT={run.count}"
+        return f"FREQ=WEEKLY;INTERVAL={run.interval};BYDAY={week_day};COUNT={run.count}"
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+CalDAV 日历的已写入状态
+
+记录每个账户日历中每个事件的 UID、内容摘要和课程信息，更新课表时据此计算差异，
+只写入新增、修改的事件，删除已不存在的事件，不需要从 Radicale 读回整个日历。
+同时记录创建日历时使用的学期开始日期，之后更新时沿用，不随默认学期变化。
+"""
+
+import os
+import re
+import json
+import sqlite3
+import threading
+import hashlib
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, Iterable, Optional, Tuple
+
+FOLD_RE = re.compile(r'\r?\n[ \t]')
+
+# 比较事件内容时忽略的属性（服务器可能改写）
+VOLATILE_PROPERTIES = ('DTSTAMP', 'LAST-MODIFIED', 'SEQUENCE', 'CREATED')
+
+def object_digest(body: str) -> str:
+    """日历对象内容摘要"""
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+def event_digest(body: str) -> str:
+    """
+    只按 VEVENT 的属性计算的摘要：展开折行、忽略属性顺序和 VOLATILE_PROPERTIES，
+    服务器重新序列化后读回的对象也能与生成的对象比较
+    """
+    lines = FOLD_RE.sub('', body).splitlines()
+    try:
+        start, end = lines.index('BEGIN:VEVENT'), lines.index('END:VEVENT')
+    except ValueError:
+        return object_digest(body)
+    properties = sorted(line for line in lines[start + 1:end]
+                        if re.split(r'[;:]', line, maxsplit=1)[0].upper() not in VOLATILE_PROPERTIES)
+    return hashlib.sha1('\n'.join(properties).encode('utf-8')).hexdigest()
+
+class CalendarState:
+    """(用户, 日历) -> {UID: (内容摘要, 课程信息)}，保存在 SQLite 中"""
+
+    def __init__(self, db_path: str):
+        """
+        :param db_path: 状态数据库路径
+        """
+        self.db_path = db_path
+        self._ready = False
+        self._init_lock = threading.Lock()
+
+    def _init_db(self) -> None:
+        """第一次使用时创建数据库（Radicale 配置目录可能在导入时还不存在）"""
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._open() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS calendars ('
+                'username TEXT NOT NULL, calendar TEXT NOT NULL, PRIMARY KEY (username, calendar))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS calendar_objects ('
+                'username TEXT NOT NULL, calendar TEXT NOT NULL, uid TEXT NOT NULL, '
+                'digest TEXT NOT NULL, info TEXT NOT NULL, PRIMARY KEY (username, calendar, uid))'
+            )
+            # 较早的数据库没有学期开始日期
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(calendars)')}
+            if 'semester_start' not in columns:
+                conn.execute('ALTER TABLE calendars ADD COLUMN semester_start TEXT')
+
+    def load(self, username: str, calendar: str) -> Optional[Dict[str, Tuple[str, Dict]]]:
+        """读取日历中的事件；没有记录过这个日历时返回 None"""
+        with self._connect() as conn:
+            known = conn.execute(
+                'SELECT 1 FROM calendars WHERE username = ? AND calendar = ?', (username, calendar)
+            ).fetchone()
+            if known is None:
+                return None
+            rows = conn.execute(
+                'SELECT uid, digest, info FROM calendar_objects WHERE username = ? AND calendar = ?',
+                (username, calendar),
+            ).fetchall()
+        return {uid: (digest, json.loads(info)) for uid, digest, info in rows}
+
+    def semester_start(self, username: str, calendar: str) -> Optional[date]:
+        """创建日历时使用的学期开始日期，没有记录时返回 None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT semester_start FROM calendars WHERE username = ? AND calendar = ?', (username, calendar)
+            ).fetchone()
+        return date.fromisoformat(row[0]) if row and row[0] else None
+
+    def _touch(self, conn, username: str, calendar: str, semester_start: Optional[date]) -> None:
+        """记录日历；给出学期开始日期时一并保存"""
+        conn.execute('INSERT OR IGNORE INTO calendars (username, calendar) VALUES (?, ?)', (username, calendar))
+        if semester_start is not None:
+            conn.execute('UPDATE calendars SET semester_start = ? WHERE username = ? AND calendar = ?',
+                         (semester_start.isoformat(), username, calendar))
+
+    def replace(self, username: str, calendar: str, objects: Iterable[Tuple[str, str, Dict]],
+                semester_start: Optional[date] = None) -> None:
+        """整个日历重新写入后，用新的事件集合替换记录"""
+        with self._connect() as conn:
+            self._touch(conn, username, calendar, semester_start)
+            conn.execute('DELETE FROM calendar_objects WHERE username = ? AND calendar = ?', (username, calendar))
+            conn.executemany(
+                'INSERT INTO calendar_objects (username, calendar, uid, digest, info) VALUES (?, ?, ?, ?, ?)',
+                [(username, calendar, uid, digest, json.dumps(info, ensure_ascii=False))
+                 for uid, digest, info in objects],
+            )
+
+    def apply(self, username: str, calendar: str, upserts: Iterable[Tuple[str, str, Dict]],
+              deletes: Iterable[str], semester_start: Optional[date] = None) -> None:
+        """
+        记录一次同步的结果
+        :param upserts: [(UID, 内容摘要, 课程信息)]
+        :param deletes: 已删除的 UID
+        :param semester_start: 生成事件使用的学期开始日期
+        """
+        with self._connect() as conn:
+            self._touch(conn, username, calendar, semester_start)
+            conn.executemany(
+                'INSERT OR REPLACE INTO calendar_objects (username, calendar, uid, digest, info) VALUES (?, ?, ?, ?, ?)',
+                [(username, calendar, uid, digest, json.dumps(info, ensure_ascii=False))
+                 for uid, digest, info in upserts],
+            )
+            conn.executemany(
+                'DELETE FROM calendar_objects WHERE username = ? AND calendar = ? AND uid = ?',
+                [(username, calendar, uid) for uid in deletes],
+            )
+
+    def _connect(self):
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return self._open()
+
+    @contextmanager
+    def _open(self):
+        """每次操作使用独立连接，结束时提交并关闭"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
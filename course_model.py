@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+课程数据模型
+
+Course 是不可变的紧凑记录，上课周用整数位图保存（第N周对应第N位），
+首周、周数、间隔判断以及周集合的比较、冲突检查都是位运算。
+Parser.parse() 原有的嵌套字典格式可以通过 to_dict() / from_dict() 相互转换。
+"""
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+def weeks_to_mask(weeks: Iterable[int]) -> int:
+    """周列表 -> 位图"""
+    mask = 0
+    for week in weeks:
+        mask |= 1 << week
+    return mask
+
+def mask_to_weeks(mask: int) -> List[int]:
+    """位图 -> 升序的周列表"""
+    weeks = []
+    while mask:
+        low = mask & -mask
+        weeks.append(low.bit_length() - 1)
+        mask ^= low
+    return weeks
+
+def first_week_of(mask: int) -> int:
+    """最早的上课周"""
+    return (mask & -mask).bit_length() - 1
+
+def last_week_of(mask: int) -> int:
+    """最晚的上课周"""
+    return mask.bit_length() - 1
+
+def progression_mask(start: int, interval: int, count: int) -> int:
+    """等差周序列 start, start+interval, ... 共 count 周的位图"""
+    if interval == 1:
+        return ((1 << count) - 1) << start
+    mask = 0
+    for i in range(count):
+        mask |= 1 << (start + i * interval)
+    return mask
+
+def mask_interval(mask: int) -> Optional[int]:
+    """周集合为等差序列时返回间隔（只有一周时为 1），否则返回 None"""
+    if not mask:
+        return None
+    start = first_week_of(mask)
+    rest = mask ^ (1 << start)
+    if not rest:
+        return 1
+    interval = first_week_of(rest) - start
+    if progression_mask(start, interval, mask.bit_count()) == mask:
+        return interval
+    return None
+
+def mask_from_week_data(week_type: str, data) -> int:
+    """week_type_detect() 的结果 -> 位图"""
+    if week_type == "continuous":
+        return progression_mask(data["start"], 1, data["end"] - data["start"] + 1)
+    if week_type == "interval":
+        return progression_mask(data["start"], data["interval"], data["count"])
+    if week_type == "discontinuous":
+        return weeks_to_mask(data)
+    raise ValueError(f"未知的周数类型: {week_type}")
+
+def week_data_from_mask(mask: int) -> Tuple[str, object]:
+    """位图 -> (time_type, time_data)，格式与 week_type_detect() 一致"""
+    start = first_week_of(mask)
+    count = mask.bit_count()
+    interval = mask_interval(mask)
+    if interval == 1:
+        return "continuous", {"start": start, "end": start + count - 1}
+    if interval is not None and count > 2:
+        return "interval", {"start": start, "interval": interval, "count": count}
+    return "discontinuous", mask_to_weeks(mask)
+
+@dataclass(frozen=True, slots=True)
+class Course:
+    """一个课程时段：某门课在某个星期、某一节，在哪些周上课"""
+
+    course_id: str
+    class_id: str
+    name: str
+    weekday: int
+    lesson: int
+    teacher: str
+    location: str
+    weeks: int  # 位图，第N周对应第N位
+
+    @property
+    def first_week(self) -> int:
+        return first_week_of(self.weeks)
+
+    @property
+    def last_week(self) -> int:
+        return last_week_of(self.weeks)
+
+    @property
+    def week_count(self) -> int:
+        return self.weeks.bit_count()
+
+    @property
+    def week_list(self) -> List[int]:
+        return mask_to_weeks(self.weeks)
+
+    @property
+    def interval(self) -> Optional[int]:
+        """上课周为等差序列时的间隔，否则为 None"""
+        return mask_interval(self.weeks)
+
+    @property
+    def section_key(self) -> Tuple[str, str]:
+        """教学班：课程号 + 班号"""
+        return self.course_id, self.class_id
+
+    @property
+    def slot_key(self) -> Tuple[str, str, int, int]:
+        """教学班的一个上课时段：课程号 + 班号 + 星期 + 节次"""
+        return self.course_id, self.class_id, self.weekday, self.lesson
+
+    def conflicts_with(self, other: "Course") -> bool:
+        """同一星期同一节且有共同的上课周"""
+        return (self.weekday == other.weekday and self.lesson == other.lesson
+                and bool(self.weeks & other.weeks))
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Course":
+        """从 Parser.parse() 的字典格式转换"""
+        return cls(
+            course_id=data["course_id"],
+            class_id=data["class_id"],
+            name=data["name"],
+            weekday=data["time"]["weekday"],
+            lesson=data["time"]["lesson"],
+            teacher=data["teacher"],
+            location=data["location"],
+            weeks=mask_from_week_data(data["weeks"]["type"], data["weeks"]["data"]),
+        )
+
+    def to_dict(self) -> Dict:
+        """转换为 Parser.parse() 的字典格式"""
+        week_type, week_data = week_data_from_mask(self.weeks)
+        return {
+            "course_id": self.course_id,
+            "class_id": self.class_id,
+            "name": self.name,
+            "time": {"weekday": self.weekday, "lesson": self.lesson},
+            "teacher": self.teacher,
+            "location": self.location,
+            "weeks": {"type": week_type, "data": week_data},
+        }
+
+def as_courses(data: Iterable) -> List[Course]:
+    """把课程字典或 Course 混合的列表统一为 Course 列表"""
+    return [item if isinstance(item, Course) else Course.from_dict(item) for item in data]
+
+def find_conflicts(courses: Iterable[Course]) -> List[Tuple[Course, Course]]:
+    """找出时间冲突的课程对"""
+    by_slot = {}
+    for course in courses:
+        by_slot.setdefault((course.weekday, course.lesson), []).append(course)
+
+    conflicts = []
+    for slot_courses in by_slot.values():
+        for i, course in enumerate(slot_courses):
+            for other in slot_courses[i + 1:]:
+                if course.weeks & other.weeks:
+                    conflicts.append((course, other))
+    return conflicts
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+CalDAV账户凭据
+
+bcrypt 哈希在独立的有界进程池中计算，不占用请求线程的 CPU；
+另外维护一个预先生成好的凭据池（账户ID、用户名、密码、哈希），后台线程持续补充，
+创建账户时直接取出一组，不需要等待哈希。
+池中没有时在请求线程中现场生成，最多等待 CREDENTIAL_TIMEOUT 秒（超时抛出 TimeoutError）；
+校验密码同样最多等待 CREDENTIAL_TIMEOUT 秒。校验与补充凭据共用进程池，
+LoginThrottle 限制每个用户名、每个来源地址在一段时间内失败的次数，猜测密码不能占满进程池。
+进程退出时（atexit）停止后台补充线程。
+"""
+
+import os
+import hmac
+import atexit
+import time
+import uuid
+import hashlib
+import logging
+import threading
+import subprocess
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from metrics import observe, stage
+
+logger = logging.getLogger(__name__)
+
+# bcrypt 计算成本（2^rounds 次迭代），与 bcrypt.gensalt() 默认值一致
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+# 哈希进程池大小
+HASH_MAX_WORKERS = int(os.environ.get('HASH_MAX_WORKERS', 2))
+# 预先生成的凭据数量，0 表示不预生成
+CREDENTIAL_POOL_SIZE = int(os.environ.get('CREDENTIAL_POOL_SIZE', 8))
+# 池中没有凭据时现场生成的最长等待时间（秒），包括在进程池中排队的时间
+CREDENTIAL_TIMEOUT = float(os.environ.get('CREDENTIAL_TIMEOUT', 30))
+# 校验密码失败的限制：LOGIN_FAILURE_WINDOW 秒内同一用户名或来源地址最多失败 LOGIN_MAX_FAILURES 次
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', 5))
+LOGIN_FAILURE_WINDOW = int(os.environ.get('LOGIN_FAILURE_WINDOW', 300))
+# 最多记录的用户名/地址数，超过时丢弃最早的记录
+LOGIN_THROTTLE_ENTRIES = 10000
+
+class Credentials(NamedTuple):
+    """一组CalDAV账户凭据"""
+    account_id: str
+    username: str
+    password: str
+    password_hash: str
+
+def new_account() -> Tuple[str, str, str]:
+    """生成 (账户ID, 用户名, 密码)"""
+    account_id = str(uuid.uuid4())
+    username = f"user_{account_id[:8]}"
+    password = str(uuid.uuid4())[:12]
+    return account_id, username, password
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> Tuple[str, float]:
+    """在子进程中计算密码哈希，返回 (哈希, 耗时毫秒)"""
+    start = time.perf_counter()
+    try:
+        import bcrypt
+        hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+    except ImportError:
+        # 如果没有bcrypt，使用htpasswd命令
+        hashed = _hash_password_htpasswd(password, rounds)
+    return hashed, (time.perf_counter() - start) * 1000
+
+def check_password(password: str, password_hash: str) -> bool:
+    """在子进程中校验密码"""
+    if password_hash.startswith('$2'):
+        import bcrypt
+        return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    # 没有 bcrypt 时降级生成的MD5哈希
+    return hmac.compare_digest(hashlib.md5(password.encode()).hexdigest(), password_hash)
+
+def _hash_password_htpasswd(password: str, rounds: int) -> str:
+    """使用htpasswd命令哈希密码"""
+    try:
+        # 使用htpasswd命令生成bcrypt哈希
+        result = subprocess.run([
+            'htpasswd', '-nbB', '-C', str(rounds), 'temp_user', password
+        ], capture_output=True, text=True)
+
+        if result.returncode == 0:
+            # 提取哈希部分
+            return result.stdout.split(':')[1].strip()
+        else:
+            raise Exception(f"htpasswd命令失败: {result.stderr}")
+
+    except Exception as e:
+        logger.error(f"密码哈希失败: {str(e)}")
+        # 降级到简单的MD5哈希（不推荐用于生产环境）
+        return hashlib.md5(password.encode()).hexdigest()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_hash_executor() -> ProcessPoolExecutor:
+    """获取（按需创建）当前进程共用的哈希进程池"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # 使用 spawn，避免从带线程的 gunicorn worker 中 fork
+            _executor = ProcessPoolExecutor(
+                max_workers=HASH_MAX_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _executor
+
+def discard_hash_executor(executor: ProcessPoolExecutor) -> None:
+    """子进程异常退出后进程池不可再用，丢弃它，下次重新创建"""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+class LoginThrottle:
+    """按键（用户名、来源地址）统计一段时间内校验密码失败的次数，超过上限时拒绝继续校验"""
+
+    def __init__(self, max_failures: int = LOGIN_MAX_FAILURES, window: int = LOGIN_FAILURE_WINDOW,
+                 max_entries: int = LOGIN_THROTTLE_ENTRIES):
+        """
+        :param max_failures: 时间窗口内最多失败次数
+        :param window: 时间窗口（秒）
+        :param max_entries: 最多记录的键数
+        """
+        self.max_failures = max_failures
+        self.window = window
+        self.max_entries = max_entries
+        self._failures = OrderedDict()  # key -> deque(失败时间)
+        self._lock = threading.Lock()
+
+    def retry_after(self, *keys: str) -> int:
+        """任一键已达到上限时返回需要等待的秒数，否则返回 0"""
+        now = time.time()
+        wait = 0
+        with self._lock:
+            for key in keys:
+                failures = self._recent(key, now)
+                if failures is not None and len(failures) >= self.max_failures:
+                    wait = max(wait, int(failures[0] + self.window - now) + 1)
+        return wait
+
+    def failed(self, *keys: str) -> None:
+        """记录一次失败"""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                failures = self._recent(key, now)
+                if failures is None:
+                    failures = self._failures[key] = deque()
+                failures.append(now)
+                self._failures.move_to_end(key)
+            while len(self._failures) > self.max_entries:
+                self._failures.popitem(last=False)
+
+    def succeeded(self, key: str) -> None:
+        """校验成功后清除这个键的失败记录"""
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def _recent(self, key: str, now: float):
+        """键在时间窗口内的失败时间，没有时返回 None"""
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+class CredentialPool:
+    """预先生成的凭据池，以及哈希耗时、池深度等统计"""
+
+    def __init__(self, size: int = CREDENTIAL_POOL_SIZE, rounds: int = BCRYPT_ROUNDS, executor=None):
+        """
+        :param size: 预先生成的凭据数量
+        :param rounds: bcrypt 计算成本
+        :param executor: 计算哈希的执行器，默认使用共用的进程池
+        """
+        self.size = size
+        self.rounds = rounds
+        self._executor = executor
+        self._pool = deque()
+        self._lock = threading.Lock()
+        self._need_refill = threading.Event()
+        self._stop = threading.Event()
+        self._refiller = None
+        self.metrics = {
+            'hashes': 0,
+            'hash_ms_total': 0.0,
+            'hash_ms_max': 0.0,
+            'pool_hits': 0,
+            'pool_misses': 0,
+        }
+
+    def hash(self, password: str, timeout: Optional[float] = None) -> str:
+        """
+        在进程池中计算哈希，等待结果
+        :param timeout: 最长等待时间（秒），超时抛出 TimeoutError，默认一直等待
+        """
+        executor = self._executor or get_hash_executor()
+        future = executor.submit(hash_password, password, self.rounds)
+        try:
+            hashed, elapsed_ms = future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"计算密码哈希超过 {timeout} 秒")
+        except BrokenProcessPool:
+            if self._executor is None:
+                discard_hash_executor(executor)
+            raise
+        # 子进程中 bcrypt 本身的耗时，不含排队等待
+        observe('bcrypt', elapsed_ms / 1000)
+        with self._lock:
+            self.metrics['hashes'] += 1
+            self.metrics['hash_ms_total'] += elapsed_ms
+            self.metrics['hash_ms_max'] = max(self.metrics['hash_ms_max'], elapsed_ms)
+        return hashed
+
+    def verify(self, password: str, password_hash: str, timeout: Optional[float] = CREDENTIAL_TIMEOUT) -> bool:
+        """
+        在进程池中校验密码
+        :param timeout: 最长等待时间（秒），包括排队时间，超时抛出 TimeoutError
+        """
+        executor = self._executor or get_hash_executor()
+        future = executor.submit(check_password, password, password_hash)
+        try:
+            with stage('password_verify'):
+                return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"校验密码超过 {timeout} 秒")
+        except BrokenProcessPool:
+            if self._executor is None:
+                discard_hash_executor(executor)
+            raise
+
+    def generate(self, timeout: Optional[float] = None) -> Credentials:
+        """立即生成一组凭据"""
+        account_id, username, password = new_account()
+        return Credentials(account_id, username, password, self.hash(password, timeout))
+
+    def acquire(self, timeout: float = CREDENTIAL_TIMEOUT) -> Credentials:
+        """
+        取出一组凭据：池中有则直接返回，否则在当前线程现场生成（阻塞，最多 timeout 秒，超时抛出 TimeoutError）；
+        第一次调用时启动后台补充
+        """
+        self._start_refiller()
+        with self._lock:
+            credentials = self._pool.popleft() if self._pool else None
+            if credentials is not None:
+                self.metrics['pool_hits'] += 1
+            else:
+                self.metrics['pool_misses'] += 1
+        self._need_refill.set()
+        return credentials or self.generate(timeout)
+
+    def stats(self) -> Dict:
+        """哈希耗时和池深度"""
+        with self._lock:
+            hashes = self.metrics['hashes']
+            return dict(
+                self.metrics,
+                hash_ms_total=round(self.metrics['hash_ms_total'], 2),
+                hash_ms_max=round(self.metrics['hash_ms_max'], 2),
+                hash_ms_avg=round(self.metrics['hash_ms_total'] / hashes, 2) if hashes else None,
+                pool_depth=len(self._pool),
+                pool_size=self.size,
+                rounds=self.rounds,
+            )
+
+    def close(self, timeout: Optional[float] = 5) -> None:
+        """停止后台补充线程（等待正在进行的一次哈希结束），之后 acquire() 总是现场生成"""
+        self._stop.set()
+        self._need_refill.set()
+        refiller = self._refiller
+        if refiller is not None and refiller is not threading.current_thread():
+            refiller.join(timeout)
+
+    def _start_refiller(self) -> None:
+        if self.size <= 0 or self._refiller is not None or self._stop.is_set():
+            return
+        with self._lock:
+            if self._refiller is not None:
+                return
+            self._refiller = threading.Thread(target=self._refill, name='credential-refill', daemon=True)
+            self._refiller.start()
+
+    def _refill(self) -> None:
+        """后台补充凭据，池满后等待下一次取出；close() 后退出"""
+        while not self._stop.is_set():
+            self._need_refill.wait()
+            self._need_refill.clear()
+            while len(self._pool) < self.size and not self._stop.is_set():
+                try:
+                    credentials = self.generate()
+                except Exception as e:
+                    if self._stop.is_set():
+                        break
+                    logger.error(f"预生成凭据失败: {str(e)}")
+                    self._stop.wait(1)
+                    continue
+                with self._lock:
+                    self._pool.append(credentials)
+
+# 全局实例
+credential_pool = CredentialPool()
+atexit.register(credential_pool.close)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+日历订阅
+
+生成的ICS文件按内容命名（见 result_cache），课表变化后文件名也会变化，
+直接用文件名做订阅地址时日历应用永远看不到更新。
+这里为每个订阅发一个固定的标识，订阅地址 /api/feed/<标识>.ics 始终指向最近一次生成的文件；
+同时发一个只有订阅者知道的修改密钥，重新上传课表后凭它把订阅指向新文件（数据库中只保存密钥的摘要）。
+"""
+
+import os
+import time
+import hmac
+import sqlite3
+import hashlib
+import secrets
+import threading
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+def key_digest(key: str) -> str:
+    """修改密钥的摘要"""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class FeedStore:
+    """订阅标识 -> (ICS文件名, 最后修改时间)，保存在 SQLite 中"""
+
+    def __init__(self, db_path: str):
+        """
+        :param db_path: 数据库路径
+        """
+        self.db_path = db_path
+        self._ready = False
+        self._init_lock = threading.Lock()
+
+    def _init_db(self) -> None:
+        """第一次使用时创建数据库"""
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._open() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS feeds ('
+                'token TEXT PRIMARY KEY, key_digest TEXT NOT NULL, '
+                'ics_file TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+
+    def create(self, ics_file: str) -> Tuple[str, str]:
+        """新建指向 ics_file 的订阅，返回 (订阅标识, 修改密钥)"""
+        token = secrets.token_urlsafe(16)
+        key = secrets.token_urlsafe(24)
+        with self._connect() as conn:
+            conn.execute('INSERT INTO feeds (token, key_digest, ics_file, updated_at) VALUES (?, ?, ?, ?)',
+                         (token, key_digest(key), ics_file, time.time()))
+        return token, key
+
+    def update(self, token: str, key: str, ics_file: str) -> bool:
+        """把订阅指向新的文件；标识不存在或密钥不对时返回 False"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT key_digest, ics_file FROM feeds WHERE token = ?', (token,)).fetchone()
+            if row is None or not hmac.compare_digest(row[0], key_digest(key)):
+                return False
+            if row[1] != ics_file:
+                conn.execute('UPDATE feeds SET ics_file = ?, updated_at = ? WHERE token = ?',
+                             (ics_file, time.time(), token))
+        return True
+
+    def lookup(self, token: str) -> Optional[Tuple[str, float]]:
+        """订阅当前指向的 (ICS文件名, 最后修改时间)，不存在时返回 None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT ics_file, updated_at FROM feeds WHERE token = ?', (token,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def _connect(self):
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return self._open()
+
+    @contextmanager
+    def _open(self):
+        """每次操作使用独立连接，结束时提交并关闭"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+多人共同空闲时间
+
+社团、项目组上传多份课表，找出大家都没课的时段；没有共同空闲时找出冲突人数最少的时段。
+
+每份课表转换为一个占用位集（Python 整数）：按 (星期, 节次) 分成 49 段，每段 week_bits 位，
+第 w 位表示第 w 周这一节有课。课程的上课周本来就是周位图，左移到所在的段再按位或即可，
+构建只需要每门课一次移位。
+  - 共同空闲 = 候选格子 & ~(所有人的位集按位或)
+  - 冲突人数：对所有位集做逐位计数（按位的二进制加法器，计数的每一位是一个位集），
+    从最高位开始筛选计数位为 0 的格子，得到冲突人数最少的格子，不需要逐格统计
+全部是整数的位运算，几百份课表也只需要几毫秒。
+"""
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from course_model import Course, as_courses, last_week_of, mask_to_weeks
+
+# 每天的节次数和每周的天数（与教务系统课表一致）
+LESSONS = 7
+WEEKDAYS = 7
+
+# 冲突最少的时段最多返回的档数（冲突人数从少到多）
+CONFLICT_LEVELS = 3
+
+def slot_index(weekday: int, lesson: int) -> int:
+    """(星期, 节次) -> 段号"""
+    return (weekday - 1) * LESSONS + (lesson - 1)
+
+def occupancy_bitset(courses: Iterable[Course], week_bits: int) -> int:
+    """一份课表的占用位集"""
+    bits = 0
+    for course in courses:
+        if 1 <= course.weekday <= WEEKDAYS and 1 <= course.lesson <= LESSONS:
+            bits |= course.weeks << (slot_index(course.weekday, course.lesson) * week_bits)
+    return bits
+
+def candidate_bitset(weeks: Sequence[int], weekdays: Sequence[int], lessons: Sequence[int], week_bits: int) -> int:
+    """要考虑的格子：指定的周 × 星期 × 节次"""
+    week_mask = 0
+    for week in weeks:
+        week_mask |= 1 << week
+    bits = 0
+    for weekday in weekdays:
+        for lesson in lessons:
+            bits |= week_mask << (slot_index(weekday, lesson) * week_bits)
+    return bits
+
+def count_planes(bitsets: Iterable[int]) -> List[int]:
+    """
+    逐位计数：返回计数的各个二进制位（低位在前），
+    格子 i 的冲突人数 = sum(((plane >> i) & 1) << k for k, plane in enumerate(planes))
+    """
+    planes = []
+    for carry in bitsets:
+        k = 0
+        while carry:
+            if k == len(planes):
+                planes.append(carry)
+                break
+            plane = planes[k]
+            planes[k] = plane ^ carry
+            carry &= plane
+            k += 1
+    return planes
+
+def min_count_cells(planes: List[int], candidates: int) -> Tuple[int, int]:
+    """候选格子中计数最小的格子，返回 (格子位集, 计数)"""
+    count = 0
+    for k in range(len(planes) - 1, -1, -1):
+        zeros = candidates & ~planes[k]
+        if zeros:
+            candidates = zeros
+        else:
+            count |= 1 << k
+    return candidates, count
+
+def group_by_slot(cells: int, week_bits: int) -> List[Tuple[int, int, int]]:
+    """格子位集 -> [(星期, 节次, 周位图)]，按星期、节次排序"""
+    groups = []
+    full = (1 << week_bits) - 1
+    for weekday in range(1, WEEKDAYS + 1):
+        for lesson in range(1, LESSONS + 1):
+            weeks = (cells >> (slot_index(weekday, lesson) * week_bits)) & full
+            if weeks:
+                groups.append((weekday, lesson, weeks))
+    return groups
+
+class FreeSlotFinder:
+    """多份课表的共同空闲时段和冲突最少的时段"""
+
+    def __init__(self, timetables: Dict[str, Iterable], weeks: Optional[Sequence[int]] = None,
+                 weekdays: Optional[Sequence[int]] = None, lessons: Optional[Sequence[int]] = None):
+        """
+        :param timetables: {参与者名称: 课程列表（Course 或 Parser.parse() 的字典格式）}
+        :param weeks: 要考虑的周，默认第1周到所有课表中最晚的上课周
+        :param weekdays: 要考虑的星期，默认 1-7
+        :param lessons: 要考虑的节次，默认 1-LESSONS
+        """
+        courses = {name: as_courses(data) for name, data in timetables.items()}
+        last_week = max((last_week_of(course.weeks) for items in courses.values() for course in items), default=1)
+        self.weeks = list(weeks) if weeks else list(range(1, last_week + 1))
+        self.weekdays = list(weekdays) if weekdays else list(range(1, WEEKDAYS + 1))
+        self.lessons = list(lessons) if lessons else list(range(1, LESSONS + 1))
+        # 每段的位数要容纳所有课程的上课周和要考虑的周
+        self.week_bits = max(last_week, max(self.weeks)) + 1
+
+        self.names = list(courses)
+        self.bitsets = [occupancy_bitset(items, self.week_bits) for items in courses.values()]
+        self.candidates = candidate_bitset(self.weeks, self.weekdays, self.lessons, self.week_bits)
+
+    def common_free(self) -> int:
+        """所有人都没课的格子"""
+        busy = 0
+        for bits in self.bitsets:
+            busy |= bits
+        return self.candidates & ~busy
+
+    def least_conflicting(self, levels: int = CONFLICT_LEVELS) -> List[Tuple[int, int]]:
+        """冲突人数最少的若干档格子 [(格子位集, 冲突人数)]，冲突人数从少到多"""
+        planes = count_planes(self.bitsets)
+        remaining = self.candidates
+        result = []
+        while remaining and len(result) < levels:
+            cells, count = min_count_cells(planes, remaining)
+            result.append((cells, count))
+            remaining &= ~cells
+        return result
+
+    def describe(self, cells: int, with_busy: bool = False) -> List[Dict]:
+        """
+        格子位集 -> 按 (星期, 节次) 分组的描述；with_busy 时同一时段再按有课的参与者分组，
+        每组的 busy 是这组周里都有课的参与者（人数等于这些格子的冲突人数）
+        """
+        slots = []
+        full = (1 << self.week_bits) - 1
+        for weekday, lesson, weeks in group_by_slot(cells, self.week_bits):
+            if not with_busy:
+                slots.append({'weekday': weekday, 'lesson': lesson, 'weeks': mask_to_weeks(weeks)})
+                continue
+            shift = slot_index(weekday, lesson) * self.week_bits
+            busy_weeks = [(name, (bits >> shift) & full & weeks) for name, bits in zip(self.names, self.bitsets)]
+            groups = {}
+            for week in mask_to_weeks(weeks):
+                busy = tuple(name for name, mask in busy_weeks if mask >> week & 1)
+                groups.setdefault(busy, []).append(week)
+            for busy, group_weeks in groups.items():
+                slots.append({'weekday': weekday, 'lesson': lesson, 'weeks': group_weeks, 'busy': list(busy)})
+        return slots
+
+    def find(self, levels: int = CONFLICT_LEVELS) -> Dict:
+        """共同空闲时段；没有时给出冲突最少的时段"""
+        free = self.common_free()
+        result = {
+            'participants': len(self.names),
+            'weeks': self.weeks,
+            'common_free': self.describe(free),
+            'least_conflicting': [],
+        }
+        if not free:
+            result['least_conflicting'] = [
+                {'conflicts': count, 'slots': self.describe(cells, with_busy=True)}
+                for cells, count in self.least_conflicting(levels)
+            ]
+        return result
+
+def parse_range(value: Optional[str], low: int, high: int) -> Optional[List[int]]:
+    """"1-5,7" -> [1, 2, 3, 4, 5, 7]，空值返回 None"""
+    if not value:
+        return None
+    numbers = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first, last = int(first), int(last or first)
+        if not low <= first <= last <= high:
+            raise ValueError(f"超出范围 {low}-{high}: {part}")
+        numbers.update(range(first, last + 1))
+    return sorted(numbers)
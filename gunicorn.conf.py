@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+gunicorn 配置
+
+多个 worker 的 Prometheus 指标写在 PROMETHEUS_MULTIPROC_DIR 中，由 /api/metrics 汇总：
+启动时清空上次运行留下的文件，worker 退出时标记它的数据。
+"""
+
+import os
+import shutil
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+def on_starting(server):
+    """主进程启动时（worker 启动之前）清空指标目录"""
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+def child_exit(server, worker):
+    """worker 退出（重启、超时被杀）后标记它的指标数据"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+节假日表
+
+放假日期从 holidays.json 读取，导入时解析一次。生成日历时按学期第一天换算成
+每个星期几对应的周位图（第N周对应第N位），与课程的上课周位图求交集就得到要排除（EXDATE）的周。
+"""
+
+import os
+import json
+import hashlib
+import logging
+from datetime import date, timedelta
+from typing import Dict, FrozenSet, List
+
+logger = logging.getLogger(__name__)
+
+# 节假日配置文件，可通过环境变量指定
+HOLIDAYS_PATH = os.environ.get(
+    'HOLIDAYS_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'holidays.json'),
+)
+
+class HolidayTable:
+    """放假日期集合，以及按学期换算的周位图"""
+
+    def __init__(self, config: Dict):
+        """
+        :param config: holidays.json 的内容
+        """
+        days = set()
+        self.names = {}
+        for holiday in config.get('holidays', []):
+            start = date.fromisoformat(holiday['start'])
+            end = date.fromisoformat(holiday.get('end', holiday['start']))
+            if end < start:
+                raise ValueError(f"节假日 {holiday.get('name', '')} 的结束日期早于开始日期")
+            day = start
+            while day <= end:
+                days.add(day)
+                self.names[day] = holiday.get('name', '')
+                day += timedelta(days=1)
+        self.dates: FrozenSet[date] = frozenset(days)
+        self.fingerprint = hashlib.sha1(
+            json.dumps(sorted(day.isoformat() for day in days)).encode('ascii')
+        ).hexdigest()[:12]
+        self._week_masks = {}
+
+    @classmethod
+    def load(cls, path: str = HOLIDAYS_PATH) -> 'HolidayTable':
+        """从配置文件加载，文件不存在时为空表"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            logger.warning(f"节假日配置 {path} 不存在，不排除节假日")
+            return cls({})
+
+    def week_masks(self, semester_start: date) -> List[int]:
+        """
+        学期中每个星期几放假的周位图，下标为星期（1-7，下标 0 不用），结果按学期第一天缓存
+        :param semester_start: 学期第一天（第1周星期一）
+        """
+        masks = self._week_masks.get(semester_start)
+        if masks is None:
+            masks = [0] * 8
+            for day in self.dates:
+                offset = (day - semester_start).days
+                if offset >= 0:
+                    masks[offset % 7 + 1] |= 1 << (offset // 7 + 1)
+            self._week_masks[semester_start] = masks
+        return masks
+
+# 导入时构建一次，所有请求共用
+HOLIDAY_TABLE = HolidayTable.load()
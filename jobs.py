@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+异步生成任务
+
+上传后立即返回任务ID，由后台线程从有界队列中取出任务执行；
+任务状态保存在 SQLite 中，因此任意一个 gunicorn worker 都能查询到其他 worker 提交的任务。
+状态：queued -> running -> done / failed
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 每个进程的任务线程数
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# 每个进程最多排队的任务数，队列满时拒绝新任务
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 64))
+# 任务超过该时间仍未完成视为失败（例如所在进程已退出）
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 300))
+# 已结束的任务记录保留时间
+JOB_RETENTION = 24 * 3600
+
+class QueueFull(Exception):
+    """任务队列已满"""
+
+class JobQueue:
+    """有界任务队列 + 线程池，任务状态记录在 SQLite 中"""
+
+    def __init__(self, db_path: str, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_SIZE,
+                 timeout: int = JOB_TIMEOUT):
+        """
+        :param db_path: 任务状态数据库路径
+        :param workers: 工作线程数
+        :param max_queued: 最多排队的任务数
+        :param timeout: 任务超时时间（秒）
+        """
+        self.db_path = db_path
+        self.workers = workers
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._init_db()
+
+    def submit(self, func: Callable[..., Dict], *args) -> str:
+        """
+        提交任务，返回任务ID
+        func 在工作线程中执行，返回值（字典）作为任务结果保存
+        """
+        self._start_workers()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('DELETE FROM jobs WHERE updated_at < ?', (now - JOB_RETENTION,))
+            conn.execute(
+                'INSERT INTO jobs (id, status, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                (job_id, 'queued', now, now),
+            )
+        try:
+            self._queue.put_nowait((job_id, func, args))
+        except queue.Full:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull("任务队列已满，请稍后重试")
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """查询任务状态，不存在时返回 None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT id, status, created_at, updated_at, result, error FROM jobs WHERE id = ?',
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+
+        job = {
+            'job_id': row[0],
+            'status': row[1],
+            'created_at': row[2],
+            'updated_at': row[3],
+        }
+        if job['status'] in ('queued', 'running') and time.time() - job['created_at'] > self.timeout:
+            job['status'] = 'failed'
+            job['error'] = '任务超时'
+        elif job['status'] == 'done':
+            job.update(json.loads(row[4]))
+        elif job['status'] == 'failed':
+            job['error'] = row[5]
+        return job
+
+    def stats(self) -> Dict[str, int]:
+        """队列长度和完成计数（当前进程）"""
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'workers': len(self._threads),
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+            }
+
+    def _start_workers(self) -> None:
+        """第一次提交任务时启动工作线程"""
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self) -> None:
+        while True:
+            job_id, func, args = self._queue.get()
+            try:
+                self._update(job_id, 'running')
+                result = func(*args)
+                self._update(job_id, 'done', result=json.dumps(result, ensure_ascii=False))
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                logger.error(f"任务 {job_id} 失败: {str(e)}")
+                try:
+                    self._update(job_id, 'failed', error=str(e))
+                except Exception as db_error:
+                    logger.error(f"更新任务 {job_id} 状态失败: {str(db_error)}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                self._queue.task_done()
+
+    def _update(self, job_id: str, status: str, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, updated_at = ?, result = ?, error = ? WHERE id = ?',
+                (status, time.time(), result, error, job_id),
+            )
+
+    @contextmanager
+    def _connect(self):
+        """每次操作使用独立连接（线程和进程之间不共享连接），结束时提交并关闭"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self) -> None:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL NOT NULL, '
+                'updated_at REAL NOT NULL, result TEXT, error TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)')
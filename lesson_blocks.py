@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+连堂课合并
+
+一门课连上几节（如第3、4节）时，教务系统课表的同一列里每一节各有一个课程块，
+Parser 为每一节产出一条记录，Writer 原来为每条记录生成一个 VEVENT。
+coalesce_lessons() 在生成事件之前把同一天相邻节次、课程/班号/教师/地点/上课周都相同的记录
+合并成一个时间块，Writer 按块生成一个事件：开始时间取第一节、结束时间取最后一节（按上课时间表）。
+
+两节之间的间隔超过 MAX_GAP_MINUTES（如午饭、晚饭）或时间重叠时不合并，
+合并后的日历上显示的时间与各节分别显示时一致，只是中间的课间休息不再断开。
+"""
+
+import os
+from collections import namedtuple
+from typing import Iterable, List
+
+from course_model import Course
+
+# 相邻两节课之间的最大间隔（分钟），超过时不合并
+MAX_GAP_MINUTES = int(os.environ.get("COALESCE_MAX_GAP_MINUTES", "30"))
+
+# 一个时间块：course 为第一节的记录，last_lesson 为最后一节，courses 为合并的各节记录
+LessonBlock = namedtuple("LessonBlock", ["course", "last_lesson", "courses"])
+
+def single_block(course: Course) -> LessonBlock:
+    """不合并时，每条记录一个块"""
+    return LessonBlock(course, course.lesson, (course,))
+
+def block_key(course: Course):
+    """可以合并的记录：除节次外完全相同"""
+    return (course.course_id, course.class_id, course.name, course.teacher, course.location,
+            course.weeks, course.weekday)
+
+def coalesce_lessons(courses: Iterable[Course], slot_table, max_gap: int = MAX_GAP_MINUTES) -> List[LessonBlock]:
+    """
+    合并连堂课，块的顺序与各块第一节记录在原列表中的顺序一致
+    :param slot_table: 上课时间表，用来判断两节之间的间隔
+    :param max_gap: 相邻两节之间的最大间隔（分钟）
+    """
+    groups = {}
+    for position, course in enumerate(courses):
+        groups.setdefault(block_key(course), []).append((course.lesson, position, course))
+
+    blocks = []
+    for items in groups.values():
+        items.sort(key=lambda item: (item[0], item[1]))
+        current = None
+        current_end = None
+        for lesson, position, course in items:
+            slot = slot_table.slot(course.location, lesson)
+            if (current is not None and slot and current_end is not None
+                    and lesson == current[1].last_lesson + 1 and 0 <= slot[0] - current_end <= max_gap):
+                block = current[1]
+                current = (current[0], LessonBlock(block.course, lesson, block.courses + (course,)))
+            else:
+                if current is not None:
+                    blocks.append(current)
+                current = (position, single_block(course))
+            current_end = slot[1] if slot else None
+        blocks.append(current)
+
+    blocks.sort(key=lambda item: item[0])
+    return [block for _, block in blocks]
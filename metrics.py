@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Prometheus 指标
+
+记录各处理阶段（读取上传、HTML解析、课程解析、生成事件、序列化、写文件、密码哈希、写用户文件、写入日历）的耗时直方图，
+以及按接口统计的请求数和耗时，由 /api/metrics 以 Prometheus 文本格式输出。
+
+gunicorn 多 worker 部署时设置 PROMETHEUS_MULTIPROC_DIR：每个进程把指标写入该目录下的文件，
+/api/metrics 汇总目录中所有进程的数据，无论请求落在哪个 worker 上结果都一样。
+目录在启动时由 gunicorn.conf.py 清空，worker 退出时由 child_exit 钩子标记。
+
+同样的计时也按请求累计（start_timings() 之后），用于响应的 Server-Timing 头。
+
+没有安装 prometheus_client 时只按请求累计，/api/metrics 返回 503。
+"""
+
+import os
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# 多进程指标目录，需要在导入 prometheus_client 之前设置
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# 耗时分桶（秒）：从亚毫秒的缓存查询到数百毫秒的 bcrypt
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'bjtu_stage_duration_seconds', '各处理阶段耗时（秒）', ['stage'], buckets=LATENCY_BUCKETS)
+    STAGE_ERRORS = prometheus_client.Counter(
+        'bjtu_stage_errors_total', '各处理阶段失败次数', ['stage'])
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'bjtu_http_request_duration_seconds', '请求耗时（秒）', ['endpoint', 'method'], buckets=LATENCY_BUCKETS)
+    REQUESTS = prometheus_client.Counter(
+        'bjtu_http_requests_total', '请求数', ['endpoint', 'method', 'status'])
+    EVENTS = prometheus_client.Counter(
+        'bjtu_events_total', '计数事件（结果缓存命中、未命中等）', ['event'])
+
+# 当前请求中各阶段的累计耗时（毫秒），没有调用 start_timings() 时为 None
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+def observe(stage_name: str, seconds: float) -> None:
+    """记录一个阶段的耗时"""
+    if prometheus_client is not None:
+        STAGE_SECONDS.labels(stage_name).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage_name] = timings.get(stage_name, 0.0) + seconds * 1000
+
+def start_timings() -> None:
+    """开始累计当前请求（当前线程/上下文）的阶段耗时"""
+    _request_timings.set({})
+
+def peek_timings() -> Dict[str, float]:
+    """当前请求到目前为止的阶段耗时，不清空（流式响应在内容生成完之后再取出）"""
+    return _request_timings.get() or {}
+
+def collect_timings() -> Dict[str, float]:
+    """取出并清空当前请求的阶段耗时 {阶段: 毫秒}，按第一次出现的顺序"""
+    timings = _request_timings.get()
+    _request_timings.set(None)
+    return timings or {}
+
+def server_timing(timings: Dict[str, float], total_ms: Optional[float] = None) -> str:
+    """Server-Timing 头，浏览器开发者工具的 Timing 面板中按阶段显示"""
+    parts = [f"{name};dur={ms:.2f}" for name, ms in timings.items()]
+    if total_ms is not None:
+        parts.append(f"total;dur={total_ms:.2f}")
+    return ", ".join(parts)
+
+@contextmanager
+def stage(stage_name: str):
+    """记录 with 块的耗时；抛出异常时同时记一次失败"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if prometheus_client is not None:
+            STAGE_ERRORS.labels(stage_name).inc()
+        raise
+    finally:
+        observe(stage_name, time.perf_counter() - start)
+
+def timed_iter(stage_name: str, iterable: Iterable) -> Iterator:
+    """逐个产出 iterable 的元素，只累计生成元素本身的耗时（不含使用方处理、发送的时间），迭代结束时记录"""
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        observe(stage_name, elapsed)
+
+def count(event: str, amount: int = 1) -> None:
+    """计数事件"""
+    if prometheus_client is not None:
+        EVENTS.labels(event).inc(amount)
+
+def observe_request(endpoint: str, method: str, status: int, seconds: float) -> None:
+    """记录一个请求"""
+    if prometheus_client is not None:
+        REQUESTS.labels(endpoint, method, str(status)).inc()
+        REQUEST_SECONDS.labels(endpoint, method).observe(seconds)
+
+def render(multiproc_dir: Optional[str] = MULTIPROC_DIR) -> Tuple[bytes, str]:
+    """
+    Prometheus 文本格式的全部指标
+    :param multiproc_dir: 多进程指标目录，设置时汇总目录中所有进程的数据
+    :return: (内容, Content-Type)
+    """
+    if prometheus_client is None:
+        raise RuntimeError("未安装 prometheus_client")
+    if multiproc_dir:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid: int) -> None:
+    """worker 退出后清理它的实时数据（gauge 的 live 模式），计数和直方图继续保留在汇总中"""
+    if prometheus_client is not None and MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
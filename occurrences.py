@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上课实例展开
+
+Writer 只输出 RRULE，这里把课程展开成每一次具体的上课：周、星期、节次、开始/结束时间（作息时区的本地时间），
+用于按周或日期范围查询课表（/api/schedule），以及标记落在节假日（holidays.json）的上课。
+
+结果按列保存为 NumPy 数组，整个课表一次向量化计算完成：
+上课周位图按位展开成 (课程数 × 周数) 的 0/1 矩阵，np.nonzero 得到每次上课的 (课程下标, 周)，
+日期、时间和节假日标记都是对这些列的整数运算。
+expand_python() 是逐个课程展开的纯 Python 实现，结果相同，用作对照和基准测试。
+没有安装 numpy 时 expand() 抛出 RuntimeError。
+"""
+
+import logging
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, List, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from course_model import Course, as_courses, last_week_of, mask_to_weeks
+from holiday_table import HOLIDAY_TABLE
+from slot_table import SLOT_TABLE
+
+logger = logging.getLogger(__name__)
+
+# 一次上课；start、end 为不带时区的本地时间
+Occurrence = namedtuple("Occurrence", ["course", "week", "weekday", "lesson", "start", "end", "holiday"])
+
+def semester_date(semester_start) -> date:
+    """学期第一天（datetime 或 date）"""
+    return semester_start.date() if isinstance(semester_start, datetime) else semester_start
+
+class Occurrences:
+    """按开始时间排序的上课实例，每一列是一个 NumPy 数组"""
+
+    def __init__(self, courses: List[Course], course_index, week, weekday, lesson, start, end, holiday):
+        """
+        :param courses: 课程列表，course_index 是其中的下标
+        :param start: 开始时间（datetime64[m]，本地时间）
+        :param end: 结束时间（datetime64[m]，本地时间）
+        :param holiday: 是否落在节假日
+        """
+        self.courses = courses
+        self.course_index = course_index
+        self.week = week
+        self.weekday = weekday
+        self.lesson = lesson
+        self.start = start
+        self.end = end
+        self.holiday = holiday
+
+    def __len__(self) -> int:
+        return len(self.course_index)
+
+    def select(self, keep) -> 'Occurrences':
+        """按布尔数组或下标数组筛选"""
+        return Occurrences(self.courses, self.course_index[keep], self.week[keep], self.weekday[keep],
+                           self.lesson[keep], self.start[keep], self.end[keep], self.holiday[keep])
+
+    def in_week(self, week: int) -> 'Occurrences':
+        """第 week 周的上课"""
+        return self.select(self.week == week)
+
+    def between(self, first_day: date, last_day: date) -> 'Occurrences':
+        """first_day 到 last_day（含）之间的上课"""
+        days = self.start.astype('datetime64[D]')
+        return self.select((days >= np.datetime64(first_day, 'D')) & (days <= np.datetime64(last_day, 'D')))
+
+    def without_holidays(self) -> 'Occurrences':
+        """去掉节假日不上课的"""
+        return self.select(~self.holiday)
+
+    def records(self) -> List[Occurrence]:
+        """转换为 Occurrence 列表"""
+        return [
+            Occurrence(self.courses[index], week, weekday, lesson, start, end, holiday)
+            for index, week, weekday, lesson, start, end, holiday in zip(
+                self.course_index.tolist(), self.week.tolist(), self.weekday.tolist(), self.lesson.tolist(),
+                self.start.astype('datetime64[m]').tolist(), self.end.astype('datetime64[m]').tolist(),
+                self.holiday.tolist())
+        ]
+
+def _slots(courses: List[Course], slot_table):
+    """每门课的 (开始分钟, 结束分钟)，没有这一节时为 None；按 (地点, 节次) 查询一次"""
+    cache = {}
+    slots = []
+    for course in courses:
+        key = (course.location, course.lesson)
+        if key not in cache:
+            cache[key] = slot_table.slot(course.location, course.lesson)
+        slots.append(cache[key])
+    return slots
+
+def expand(courses: Iterable, semester_start, slot_table=None, holiday_table=None) -> Occurrences:
+    """
+    向量化展开所有课程的上课实例
+    :param courses: 课程列表（Course 或 Parser.parse() 的字典格式）
+    :param semester_start: 学期开始日期（第1周星期一）
+    :param slot_table: 上课时间表，默认使用 slot_profiles.json 中的配置
+    :param holiday_table: 节假日表，默认使用 holidays.json 中的配置
+    """
+    if np is None:
+        raise RuntimeError("未安装 numpy")
+    courses = as_courses(courses)
+    slot_table = slot_table or SLOT_TABLE
+    holiday_table = holiday_table or HOLIDAY_TABLE
+
+    # 没有对应节次的课程不生成事件，与 Writer 一致
+    slots = _slots(courses, slot_table)
+    kept = [i for i, slot in enumerate(slots) if slot]
+    max_week = max((last_week_of(courses[i].weeks) for i in kept), default=0)
+    if max_week >= 64:
+        raise ValueError(f"上课周超出范围: 第{max_week}周")
+
+    indexes = np.array(kept, dtype=np.int64)
+    masks = np.array([courses[i].weeks for i in kept], dtype=np.uint64)
+    weekdays = np.array([courses[i].weekday for i in kept], dtype=np.int64)
+    lessons = np.array([courses[i].lesson for i in kept], dtype=np.int64)
+    start_minutes = np.array([slots[i][0] for i in kept], dtype=np.int64)
+    end_minutes = np.array([slots[i][1] for i in kept], dtype=np.int64)
+
+    # (课程数 × 周数) 的位矩阵，第 w 列为第 w 周是否上课
+    weeks = np.arange(max_week + 1, dtype=np.uint64)
+    rows, week = np.nonzero((masks[:, None] >> weeks) & np.uint64(1))
+
+    weekday = weekdays[rows]
+    days = np.datetime64(semester_date(semester_start), 'D') + ((week - 1) * 7 + weekday - 1)
+    midnight = days.astype('datetime64[m]')
+    start = midnight + start_minutes[rows]
+    end = midnight + end_minutes[rows]
+    holiday_days = np.array(sorted(holiday_table.dates), dtype='datetime64[D]')
+    holiday = np.isin(days, holiday_days)
+
+    order = np.argsort(start, kind='stable')
+    return Occurrences(courses, indexes[rows][order], week[order], weekday[order], lessons[rows][order],
+                       start[order], end[order], holiday[order])
+
+def expand_python(courses: Iterable, semester_start, slot_table=None, holiday_table=None) -> List[Occurrence]:
+    """逐个课程、逐周展开，结果与 expand(...).records() 相同"""
+    courses = as_courses(courses)
+    slot_table = slot_table or SLOT_TABLE
+    holiday_dates = (holiday_table or HOLIDAY_TABLE).dates
+    first_day = semester_date(semester_start)
+
+    occurrences = []
+    for course, slot in zip(courses, _slots(courses, slot_table)):
+        if not slot:
+            continue
+        start_minute, end_minute = slot
+        for week in mask_to_weeks(course.weeks):
+            day = first_day + timedelta(days=(week - 1) * 7 + course.weekday - 1)
+            midnight = datetime.combine(day, time())
+            occurrences.append(Occurrence(
+                course, week, course.weekday, course.lesson,
+                midnight + timedelta(minutes=start_minute), midnight + timedelta(minutes=end_minute),
+                day in holiday_dates,
+            ))
+    occurrences.sort(key=lambda occurrence: occurrence.start)
+    return occurrences
+
+def occurrence_to_dict(occurrence: Occurrence, holiday_name: Optional[str] = None) -> dict:
+    """/api/schedule 返回的一次上课"""
+    course = occurrence.course
+    data = {
+        "course_id": course.course_id,
+        "class_id": course.class_id,
+        "name": course.name,
+        "teacher": course.teacher,
+        "location": course.location,
+        "week": occurrence.week,
+        "weekday": occurrence.weekday,
+        "lesson": occurrence.lesson,
+        "start": occurrence.start.isoformat(timespec='minutes'),
+        "end": occurrence.end.isoformat(timespec='minutes'),
+        "holiday": occurrence.holiday,
+    }
+    if occurrence.holiday and holiday_name:
+        data["holiday_name"] = holiday_name
+    return data
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+按需性能分析
+
+被 @profiled 包装的接口（如 /api/upload）满足以下任一条件时，用 cProfile 记录这一次请求，
+结果写入 PROFILE_DIR（用 `python -m pstats <文件>` 或 snakeviz 查看），响应头 X-Profile-Id 给出文件名：
+  - 按 PROFILE_SAMPLE_RATE 抽样（如 0.001 表示约每 1000 个请求记录一个），可以在生产环境长期开启
+  - 请求带有用 PROFILE_SECRET 签名且未过期的 X-Profile 头，复现某个学生的慢请求时使用：
+        python profiling.py token 3600    # 生成一小时内有效的头的值
+    没有设置 PROFILE_SECRET 时使用 SECRET_KEY；两者都未设置，或是示例配置中的占位值
+    （如 docker-compose.yml 里的 your-secret-key-change-in-production）时不接受这个头
+目录中只保留最新的 PROFILE_KEEP 个文件。
+"""
+
+import os
+import sys
+import hmac
+import time
+import uuid
+import random
+import hashlib
+import cProfile
+import logging
+import threading
+from typing import Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 抽样比例，0 表示只在请求带有签名头时记录
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# 结果保存目录
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# 最多保留的文件数
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))
+
+# 仓库中示例配置和开发默认值里的密钥，任何人都能用它们签名，不接受
+PLACEHOLDER_SECRETS = {
+    'your-secret-key-change-in-production',
+    'dev-secret-key-change-in-production',
+}
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SUFFIX = '.prof'
+
+def sign_token(secret: str, expires: int) -> str:
+    """生成 X-Profile 头的值：<过期时间戳>:<HMAC-SHA256>"""
+    signature = hmac.new(secret.encode('utf-8'), f"profile:{expires}".encode('ascii'), hashlib.sha256).hexdigest()
+    return f"{expires}:{signature}"
+
+def verify_token(secret: str, token: str, now: Optional[float] = None) -> bool:
+    """签名正确且未过期"""
+    expires, _, _ = token.partition(':')
+    if not expires.isdigit():
+        return False
+    if int(expires) < (time.time() if now is None else now):
+        return False
+    return hmac.compare_digest(sign_token(secret, int(expires)), token)
+
+def profile_secret() -> Optional[str]:
+    """校验 X-Profile 头的密钥：PROFILE_SECRET 或 SECRET_KEY，未设置或为占位值时返回 None"""
+    secret = os.environ.get('PROFILE_SECRET') or os.environ.get('SECRET_KEY')
+    if not secret:
+        return None
+    if secret in PLACEHOLDER_SECRETS:
+        logger.warning("签名密钥是示例配置中的占位值，不接受 X-Profile 头；请设置 PROFILE_SECRET")
+        return None
+    return secret
+
+class Profiler:
+    """决定是否记录一次请求，并保存 cProfile 结果"""
+
+    def __init__(self, directory: str = PROFILE_DIR, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 keep: int = PROFILE_KEEP, secret: Optional[str] = None):
+        """
+        :param directory: 结果保存目录
+        :param sample_rate: 抽样比例
+        :param keep: 最多保留的文件数
+        :param secret: 校验 X-Profile 头的密钥，None 表示不接受这个头
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.secret = secret
+        # 同一线程中不能同时运行两个 cProfile
+        self._local = threading.local()
+
+    def should_profile(self, token: Optional[str] = None) -> bool:
+        """按签名头或抽样比例决定是否记录"""
+        if getattr(self._local, 'active', False):
+            return False
+        if token and self.secret and verify_token(self.secret, token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def run(self, name: str, func: Callable, *args, **kwargs) -> Tuple[object, Optional[str]]:
+        """在 cProfile 下执行 func，返回 (结果, 结果文件名)；保存失败时文件名为 None"""
+        profile = cProfile.Profile()
+        self._local.active = True
+        try:
+            profile.enable()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            self._local.active = False
+
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}{PROFILE_SUFFIX}"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(os.path.join(self.directory, filename))
+            self._prune()
+        except OSError as e:
+            logger.warning(f"保存性能分析结果失败: {str(e)}")
+            return result, None
+        logger.info(f"已记录性能分析: {filename}")
+        return result, filename
+
+    def _prune(self) -> None:
+        """删除最旧的文件，只保留 keep 个"""
+        with os.scandir(self.directory) as it:
+            entries = [entry for entry in it if entry.name.endswith(PROFILE_SUFFIX)]
+        if len(entries) <= self.keep:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.keep]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def main(argv=None) -> int:
+    """命令行：python profiling.py token [有效秒数]，使用与服务端相同的密钥（profile_secret()）签名"""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != 'token':
+        print("用法: python profiling.py token [seconds]")
+        return 2
+    secret = profile_secret()
+    if not secret:
+        print("需要设置与服务端相同的 PROFILE_SECRET（或 SECRET_KEY）环境变量，且不能是占位值")
+        return 2
+    ttl = int(argv[1]) if len(argv) > 1 else 3600
+    print(f"{PROFILE_HEADER}: {sign_token(secret, int(time.time()) + ttl)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ICS结果缓存
+
+同一份课表导出（或同班同学几乎相同的页面）只需要解析一次。
+缓存键由归一化后的课表表格和学期开始日期计算得出，生成的ICS文件按缓存键命名保存在 outputs/ 中
+（见 artifact_store），因此多个 gunicorn worker 之间也能共享命中。
+"""
+
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# 生成逻辑（解析、ICS格式）变化时递增，使旧的缓存全部失效
+CACHE_VERSION = 4
+
+# 课表表格：<table class="table table-bordered">
+TABLE_RE = re.compile(r'<table[^>]*class="table table-bordered"[^>]*>.*?</table>', re.IGNORECASE | re.DOTALL)
+# 选课页面中的 "[ 选中 ]" 标记，与课程内容无关
+SELECTED_SPAN_RE = re.compile(r'<span[^>]*>\s*\[\s*选中\s*\]\s*</span>', re.IGNORECASE)
+# 标签两侧的空白（缩进、换行），解析时会被去掉
+TAG_WHITESPACE_RE = re.compile(r'\s*(<[^>]*>)\s*')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_timetable_html(html: str) -> str:
+    """
+    提取课表表格并去掉易变部分（选中标记、标签之间的空白）；
+    文本中的空白压缩为一个空格，只差在文本中空白的课表（如课程名、教师、教室）缓存键不同
+    """
+    match = TABLE_RE.search(html)
+    markup = match.group(0) if match else html
+    markup = SELECTED_SPAN_RE.sub('', markup)
+    markup = TAG_WHITESPACE_RE.sub(r'\1', markup)
+    return WHITESPACE_RE.sub(' ', markup)
+
+def make_cache_key(html: str, semester_start, variant: str = '') -> str:
+    """
+    计算缓存键：归一化表格 + 学期开始日期
+    :param variant: 影响输出的其他配置（如作息表指纹），配置变化后旧结果自然失效
+    """
+    digest = hashlib.sha256()
+    digest.update(f"v{CACHE_VERSION}|{variant}|{semester_start.strftime('%Y-%m-%d')}|".encode('utf-8'))
+    digest.update(normalize_timetable_html(html).encode('utf-8'))
+    return digest.hexdigest()
+
+class ResultCache:
+    """缓存键 -> outputs/ 中ICS文件名，支持条目数上限（LRU）和TTL淘汰"""
+
+    def __init__(self, store, max_entries: int = 4096, ttl: int = 7 * 24 * 3600):
+        """
+        :param store: ICS文件所在的 ArtifactStore
+        :param max_entries: 内存索引最多保存的条目数
+        :param ttl: 条目有效期（秒）
+        """
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (ics_filename, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def filename_for(key: str) -> str:
+        """缓存键对应的ICS文件名"""
+        return f"{key}.ics"
+
+    def get(self, key: str) -> Optional[str]:
+        """查找缓存，命中时返回ICS文件名"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                ics_filename, stored_at = entry
+                if now - stored_at <= self.ttl and self._exists(ics_filename):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return ics_filename
+                del self._entries[key]
+                self.evictions += 1
+
+            # 其他 worker 可能已经生成过同一份文件
+            ics_filename = self.filename_for(key)
+            stored_at = self._mtime(ics_filename)
+            if stored_at is not None and now - stored_at <= self.ttl:
+                self._insert(key, ics_filename, stored_at)
+                self.hits += 1
+                return ics_filename
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, ics_filename: str) -> None:
+        """记录新生成的ICS文件"""
+        with self._lock:
+            self._insert(key, ics_filename, time.time())
+
+    def stats(self) -> Dict[str, int]:
+        """命中/未命中计数"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
+
+    def _insert(self, key: str, ics_filename: str, stored_at: float) -> None:
+        self._entries[key] = (ics_filename, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _exists(self, ics_filename: str) -> bool:
+        return self.store.exists(ics_filename)
+
+    def _mtime(self, ics_filename: str) -> Optional[float]:
+        return self.store.mtime(ics_filename)
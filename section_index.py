@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+教学班索引
+
+同一个教学班（课程号 + 班号）的几百名学生上传的课表中，这个班的课程记录完全相同。
+每次成功解析后，把各教学班的记录（节次、上课周、地点、教师）按内容摘要写入 SQLite：
+相同的记录只保存一份并累计出现次数，内容不同（如新导出的课表换了教室）时保存为另一个版本。
+
+  - canonical()：出现次数达到 MIN_AGREEMENT 的版本中最近出现的为准（一次旧导出或伪造的上传不能覆盖
+    大家一致的版本）；都没达到时取出现次数最多的
+  - disagreements()：有多个版本的教学班，以及哪些字段不一致
+  - 辅导员按课程号或教学班生成合并日历时直接使用索引中的记录，不需要重新解析任何文件
+
+上传接口调用 submit()，记录放入队列由后台线程成批写入（一个事务、一个长期连接），不占用请求的时间；
+每个线程复用自己的连接，不再每次操作都重新打开数据库。
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from course_model import Course, mask_to_weeks
+
+logger = logging.getLogger(__name__)
+
+# 比较版本差异时检查的字段
+VARIANT_FIELDS = ('name', 'teacher', 'location', 'weeks', 'slots')
+
+# 新版本至少出现这么多次才能取代已有的版本成为当前版本
+MIN_AGREEMENT = int(os.environ.get('SECTION_MIN_AGREEMENT', '3'))
+
+# 等待后台写入的解析结果数上限，超出时丢弃（索引只是统计用途，不影响生成）
+QUEUE_SIZE = int(os.environ.get('SECTION_INDEX_QUEUE_SIZE', '1000'))
+
+# 后台线程一个事务最多写入的解析结果数
+WRITE_BATCH = 100
+
+def section_records(courses: Iterable[Course]) -> Dict[Tuple[str, str], List[Course]]:
+    """按教学班分组，每组按星期、节次排序（同一课表中同一教学班的记录顺序无关）"""
+    sections = {}
+    for course in courses:
+        sections.setdefault(course.section_key, []).append(course)
+    for records in sections.values():
+        records.sort(key=lambda course: (course.weekday, course.lesson, course.weeks, course.location, course.teacher))
+    return sections
+
+def encode_records(records: List[Course]) -> str:
+    """一个教学班的记录 -> JSON（上课周位图以整数保存）"""
+    return json.dumps([
+        [course.name, course.weekday, course.lesson, course.teacher, course.location, course.weeks]
+        for course in records
+    ], ensure_ascii=False, separators=(',', ':'))
+
+def decode_records(course_id: str, class_id: str, data: str) -> List[Course]:
+    """encode_records() 的逆运算"""
+    return [
+        Course(course_id, class_id, name, weekday, lesson, teacher, location, weeks)
+        for name, weekday, lesson, teacher, location, weeks in json.loads(data)
+    ]
+
+def describe_variant(records: List[Course]) -> Dict:
+    """一个版本中各字段的取值，用于比较差异"""
+    return {
+        'name': sorted({course.name for course in records}),
+        'teacher': sorted({course.teacher for course in records}),
+        'location': sorted({course.location for course in records}),
+        'weeks': sorted({tuple(mask_to_weeks(course.weeks)) for course in records}),
+        'slots': sorted({(course.weekday, course.lesson) for course in records}),
+    }
+
+class SectionIndex:
+    """(课程号, 班号) -> 各版本的课程记录，保存在 SQLite 中"""
+
+    def __init__(self, db_path: str, min_agreement: int = MIN_AGREEMENT):
+        """
+        :param db_path: 索引数据库路径
+        :param min_agreement: 新版本成为当前版本所需的出现次数
+        """
+        self.db_path = db_path
+        self.min_agreement = min_agreement
+        self._ready = False
+        self._init_lock = threading.Lock()
+        self._local = threading.local()
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._writer = None
+        # 本进程的写入计数（由 submit 和后台线程更新），健康检查读取这些计数，不查询数据库
+        self._counter_lock = threading.Lock()
+        self._counters = {'submitted': 0, 'dropped': 0, 'written': 0, 'write_errors': 0}
+
+    def _init_db(self) -> None:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._open() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS section_variants ('
+                'course_id TEXT NOT NULL, class_id TEXT NOT NULL, digest TEXT NOT NULL, records TEXT NOT NULL, '
+                'seen_count INTEGER NOT NULL, first_seen REAL NOT NULL, last_seen REAL NOT NULL, '
+                'PRIMARY KEY (course_id, class_id, digest))'
+            )
+
+    def record(self, courses: Iterable[Course], seen: Optional[float] = None) -> int:
+        """
+        记录一次解析结果中的所有教学班（同步写入），返回教学班数
+        :param seen: 出现时间，默认为当前时间
+        """
+        rows = self._rows(courses, seen)
+        with self._connect() as conn:
+            self._write(conn, rows)
+        return len(rows)
+
+    def submit(self, courses: Iterable[Course], seen: Optional[float] = None) -> bool:
+        """放入队列由后台线程写入，立即返回；队列已满时丢弃并返回 False"""
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((list(courses), time.time() if seen is None else seen))
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('submitted')
+        return True
+
+    def counters(self) -> Dict:
+        """本进程提交、丢弃、写入、写入失败的解析结果数和队列长度（只读内存，不打开数据库）"""
+        with self._counter_lock:
+            counters = dict(self._counters)
+        counters['queue_depth'] = self._queue.qsize()
+        return counters
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._counter_lock:
+            self._counters[name] += amount
+
+    def flush(self) -> None:
+        """等待队列中的解析结果全部写入"""
+        if self._writer is not None:
+            self._queue.join()
+
+    @staticmethod
+    def _rows(courses: Iterable[Course], seen: Optional[float]) -> List[Tuple]:
+        seen = time.time() if seen is None else seen
+        rows = []
+        for (course_id, class_id), records in section_records(courses).items():
+            data = encode_records(records)
+            digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+            rows.append((course_id, class_id, digest, data, seen, seen))
+        return rows
+
+    @staticmethod
+    def _write(conn, rows: List[Tuple]) -> None:
+        conn.executemany(
+            'INSERT INTO section_variants '
+            '(course_id, class_id, digest, records, seen_count, first_seen, last_seen) VALUES (?, ?, ?, ?, 1, ?, ?) '
+            'ON CONFLICT (course_id, class_id, digest) DO UPDATE SET '
+            'seen_count = seen_count + 1, last_seen = MAX(last_seen, excluded.last_seen)',
+            rows,
+        )
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None:
+            with self._init_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name='section-index-writer', daemon=True)
+                    self._writer.start()
+
+    def _write_loop(self) -> None:
+        """后台线程：取出队列中已有的解析结果（最多 WRITE_BATCH 个），在一个事务中写入"""
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                rows = [row for courses, seen in batch for row in self._rows(courses, seen)]
+                with self._connect() as conn:
+                    self._write(conn, rows)
+                self._count('written', len(batch))
+            except Exception as e:
+                self._count('write_errors', len(batch))
+                logger.warning(f"写入教学班索引失败: {str(e)}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def canonical(self, sections: Optional[Iterable[Tuple[str, str]]] = None,
+                  course_ids: Optional[Iterable[str]] = None) -> List[Course]:
+        """
+        各教学班当前的课程记录：出现次数达到 min_agreement 的版本中最近出现的；都没达到时出现次数最多的
+        :param sections: 要取的教学班 [(课程号, 班号)]
+        :param course_ids: 要取的课程号（包含其下所有教学班）
+        """
+        conditions = []
+        params = []
+        for course_id, class_id in sections or ():
+            conditions.append('(course_id = ? AND class_id = ?)')
+            params += [course_id, class_id]
+        for course_id in course_ids or ():
+            conditions.append('course_id = ?')
+            params.append(course_id)
+        if not conditions:
+            return []
+
+        query = (
+            'SELECT course_id, class_id, records FROM ('
+            ' SELECT course_id, class_id, records, ROW_NUMBER() OVER ('
+            f'  PARTITION BY course_id, class_id ORDER BY {self._rank_order()}) AS rank'
+            f' FROM section_variants WHERE {" OR ".join(conditions)}'
+            ') WHERE rank = 1 ORDER BY course_id, class_id'
+        )
+        with self._connect() as conn:
+            rows = conn.execute(query, [self.min_agreement] + params).fetchall()
+        courses = []
+        for course_id, class_id, data in rows:
+            courses.extend(decode_records(course_id, class_id, data))
+        return courses
+
+    @staticmethod
+    def _rank_order() -> str:
+        """版本的排序（第一个为当前版本），参数为 min_agreement"""
+        return '(seen_count >= ?) DESC, last_seen DESC, seen_count DESC'
+
+    def disagreements(self, limit: int = 100) -> List[Dict]:
+        """有多个版本的教学班：各版本的出现次数、时间和不一致的字段，最近变化的在前，当前版本排第一"""
+        with self._connect() as conn:
+            keys = conn.execute(
+                'SELECT course_id, class_id FROM section_variants GROUP BY course_id, class_id '
+                'HAVING COUNT(*) > 1 ORDER BY MAX(last_seen) DESC LIMIT ?', (limit,)
+            ).fetchall()
+            result = []
+            for course_id, class_id in keys:
+                rows = conn.execute(
+                    'SELECT records, seen_count, first_seen, last_seen FROM section_variants '
+                    f'WHERE course_id = ? AND class_id = ? ORDER BY {self._rank_order()}',
+                    (course_id, class_id, self.min_agreement),
+                ).fetchall()
+                variants = [
+                    dict(describe_variant(decode_records(course_id, class_id, data)),
+                         seen_count=seen_count, first_seen=first_seen, last_seen=last_seen)
+                    for data, seen_count, first_seen, last_seen in rows
+                ]
+                result.append({
+                    'course_id': course_id,
+                    'class_id': class_id,
+                    'fields': [field for field in VARIANT_FIELDS
+                               if any(variant[field] != variants[0][field] for variant in variants[1:])],
+                    'variants': variants,
+                })
+        return result
+
+    def stats(self) -> Dict:
+        """教学班数和版本数"""
+        with self._connect() as conn:
+            sections, variants, seen = conn.execute(
+                'SELECT COUNT(DISTINCT course_id || char(31) || class_id), COUNT(*), COALESCE(SUM(seen_count), 0) '
+                'FROM section_variants'
+            ).fetchone()
+        return {'sections': sections, 'variants': variants, 'records_seen': seen}
+
+    def _connect(self):
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    self._init_db()
+                    self._ready = True
+        return self._open()
+
+    @contextmanager
+    def _open(self):
+        """每个线程复用一个连接，每次操作结束时提交（出错时回滚）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            self._local.conn = conn
+        with conn:
+            yield conn
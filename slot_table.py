@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上课时间表
+
+各校区/教学楼的作息（profile）从 slot_profiles.json 读取，导入时解析一次：
+每个 (profile, 节次) 的开始、结束时间预先换算成当天的分钟数，教学楼到 profile 的映射建成字典索引，
+生成事件时只需要整数运算。
+"""
+
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# 作息配置文件，可通过环境变量指定
+SLOT_PROFILES_PATH = os.environ.get(
+    'SLOT_PROFILES_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'slot_profiles.json'),
+)
+
+# 按地点缓存 profile 的最大条目数
+LOCATION_CACHE_SIZE = 4096
+
+def _minutes(hhmm: str) -> int:
+    """"08:00" -> 480"""
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+class SlotTable:
+    """(profile, 节次) -> (开始分钟, 结束分钟)，以及教学楼 -> profile 的索引"""
+
+    def __init__(self, config: Dict):
+        """
+        :param config: slot_profiles.json 的内容
+        """
+        self.timezone_name = config.get('timezone', 'Asia/Shanghai')
+        self.timezone = pytz.timezone(self.timezone_name)
+        self.default_profile = config['default_profile']
+
+        # profile -> {节次: (开始分钟, 结束分钟)}
+        self.profiles = {}
+        for name, profile in config['profiles'].items():
+            self.profiles[name] = {
+                int(lesson): (_minutes(times['start']), _minutes(times['end']))
+                for lesson, times in profile['lessons'].items()
+            }
+        if self.default_profile not in self.profiles:
+            raise ValueError(f"默认作息 {self.default_profile} 不存在")
+
+        # 教学楼名称 -> profile
+        self.buildings = {}
+        for building, profile in config.get('buildings', {}).items():
+            if profile not in self.profiles:
+                raise ValueError(f"教学楼 {building} 使用了不存在的作息 {profile}")
+            self.buildings[building] = profile
+
+        self._location_cache = {}
+        self.fingerprint = hashlib.sha1(
+            json.dumps(config, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()[:12]
+
+    @classmethod
+    def load(cls, path: str = SLOT_PROFILES_PATH) -> 'SlotTable':
+        """从配置文件加载"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def resolve_profile(self, location: str) -> str:
+        """
+        地点 -> profile
+        地点一般是 "逸夫教学楼 YF415"，先按第一段的教学楼名查索引；
+        查不到时按子串匹配（兼容不规范的地点），结果按地点缓存
+        """
+        profile = self.buildings.get(location.split(' ', 1)[0])
+        if profile is not None:
+            return profile
+
+        profile = self._location_cache.get(location)
+        if profile is None:
+            profile = next(
+                (profile for building, profile in self.buildings.items() if building in location),
+                self.default_profile,
+            )
+            if len(self._location_cache) >= LOCATION_CACHE_SIZE:
+                self._location_cache.clear()
+            self._location_cache[location] = profile
+        return profile
+
+    def slot(self, location: str, lesson: int) -> Optional[Tuple[int, int]]:
+        """某地点某一节课的 (开始分钟, 结束分钟)，没有这一节时返回 None"""
+        return self.profiles[self.resolve_profile(location)].get(lesson)
+
+    def utc_offset_minutes(self, day) -> int:
+        """时区在某一天的UTC偏移（分钟）"""
+        return int(self.timezone.utcoffset(day.replace(tzinfo=None)).total_seconds() // 60)
+
+    def vtimezone(self, day) -> str:
+        """
+        生成 VTIMEZONE 块（适用于不实行夏令时的时区，如 Asia/Shanghai）
+        :param day: 用来确定偏移量的日期
+        """
+        offset = self.utc_offset_minutes(day)
+        sign = '+' if offset >= 0 else '-'
+        offset_str = f"{sign}{abs(offset) // 60:02d}{abs(offset) % 60:02d}"
+        tzname = self.timezone.tzname(day.replace(tzinfo=None))
+        return (
+            "BEGIN:VTIMEZONE\r\n"
+            f"TZID:{self.timezone_name}\r\n"
+            "BEGIN:STANDARD\r\n"
+            "DTSTART:19700101T000000\r\n"
+            f"TZOFFSETFROM:{offset_str}\r\n"
+            f"TZOFFSETTO:{offset_str}\r\n"
+            f"TZNAME:{tzname}\r\n"
+            "END:STANDARD\r\n"
+            "END:VTIMEZONE\r\n"
+        )
+
+# 导入时构建一次，所有请求共用
+SLOT_TABLE = SlotTable.load()
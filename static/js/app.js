@@ -1,6 +1,9 @@
 // 应用主要JavaScript功能
 
+// 当前选择的课表文件，以及服务器保存后的结果（只在订阅、CalDAV时才保存）
+let currentFile = null;
 let currentIcsFile = null;
+let storedResult = null;
 
 // DOM加载完成后初始化
 document.addEventListener('DOMContentLoaded', function () {
@@ -68,10 +71,20 @@ function handleFile(file) {
     uploadFile(file);
 }
 
-// 上传文件
+// 任务状态轮询间隔（毫秒）和最长等待时间
+const JOB_POLL_INTERVAL = 500;
+const JOB_POLL_MAX_INTERVAL = 3000;
+const JOB_POLL_TIMEOUT = 5 * 60 * 1000;
+
+// 上传文件：行内模式直接返回ICS内容，服务器不保存任何文件
 function uploadFile(file) {
     const formData = new FormData();
     formData.append('file', file);
+    formData.append('mode', 'inline');
+
+    currentFile = file;
+    currentIcsFile = null;
+    storedResult = null;
 
     // 显示进度条
     showProgress();
@@ -79,18 +92,24 @@ function uploadFile(file) {
     // 发送请求
     fetch('/api/upload', {
         method: 'POST',
+        headers: {
+            'Accept': 'text/calendar'
+        },
         body: formData
     })
-        .then(response => response.json())
-        .then(data => {
-            hideProgress();
-
-            if (data.success) {
-                currentIcsFile = data.ics_file;
-                showResult(data.message, data.download_url);
-            } else {
-                showAlert(data.error || '上传失败', 'danger');
+        .then(response => {
+            if (!response.ok) {
+                return response.json().then(data => {
+                    throw new Error(data.error || '上传失败');
+                });
             }
+            const courseCount = response.headers.get('X-Course-Count');
+            return response.blob().then(blob => ({ blob, courseCount }));
+        })
+        .then(({ blob, courseCount }) => {
+            hideProgress();
+            const message = courseCount ? `课表解析成功，共 ${courseCount} 个课程时段` : '课表解析成功';
+            showResult(message, blob);
         })
         .catch(error => {
             hideProgress();
@@ -99,6 +118,104 @@ function uploadFile(file) {
         });
 }
 
+// 订阅和CalDAV需要服务器保存的ICS文件：第一次用到时以任务模式再上传一次
+function storeCalendar() {
+    if (storedResult) {
+        return Promise.resolve(storedResult);
+    }
+    if (!currentFile) {
+        return Promise.reject(new Error('请先上传并处理课表文件'));
+    }
+
+    const formData = new FormData();
+    formData.append('file', currentFile);
+    // 任务模式：服务器立即返回任务ID，后台生成
+    formData.append('mode', 'job');
+
+    return fetch('/api/upload', {
+        method: 'POST',
+        body: formData
+    })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success && data.job_id) {
+                return pollJob(data.status_url, JOB_POLL_INTERVAL, Date.now());
+            }
+            if (data.success) {
+                return data;
+            }
+            throw new Error(data.error || '上传失败');
+        })
+        .then(data => {
+            storedResult = data;
+            currentIcsFile = data.ics_file;
+            return data;
+        });
+}
+
+// 浏览器中保存的订阅标识和修改密钥
+const FEED_STORAGE_KEY = 'calendarFeed';
+
+// 订阅ICS文件：已有订阅时把它指向新文件（订阅地址不变），否则新建订阅
+function subscribeCalendar(icsFile, retry = true) {
+    const saved = JSON.parse(localStorage.getItem(FEED_STORAGE_KEY) || 'null');
+    return fetch('/api/feed', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(Object.assign({ ics_file: icsFile }, saved || {}))
+    })
+        .then(response => response.json().then(data => ({ status: response.status, data })))
+        .then(({ status, data }) => {
+            // 保存的订阅已失效：新建订阅
+            if (status === 403 && saved && retry) {
+                localStorage.removeItem(FEED_STORAGE_KEY);
+                return subscribeCalendar(icsFile, false);
+            }
+            if (!data.success) {
+                throw new Error(data.error || '订阅失败');
+            }
+            localStorage.setItem(FEED_STORAGE_KEY, JSON.stringify({
+                feed_token: data.feed_token,
+                feed_key: data.feed_key
+            }));
+            return data;
+        });
+}
+
+// 轮询生成任务状态，间隔逐渐增加
+function pollJob(statusUrl, interval, startedAt) {
+    if (Date.now() - startedAt > JOB_POLL_TIMEOUT) {
+        return Promise.reject(new Error('处理超时，请稍后重试'));
+    }
+
+    return new Promise(resolve => setTimeout(resolve, interval))
+        .then(() => fetch(statusUrl))
+        .then(response => response.json())
+        .then(data => {
+            if (data.status === 'queued' || data.status === 'running') {
+                return pollJob(statusUrl, Math.min(interval * 2, JOB_POLL_MAX_INTERVAL), startedAt);
+            }
+            if (data.status === 'done' && data.success) {
+                return data;
+            }
+            throw new Error(data.error || '上传失败');
+        });
+}
+
+// 把浏览器中的ICS内容保存为文件
+function saveBlob(blob, filename) {
+    const url = URL.createObjectURL(blob);
+    const link = document.createElement('a');
+    link.href = url;
+    link.download = filename;
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
+    setTimeout(() => URL.revokeObjectURL(url), 1000);
+}
+
 // 显示进度条
 function showProgress() {
     document.getElementById('uploadProgress').style.display = 'block';
@@ -111,14 +228,32 @@ function hideProgress() {
 }
 
 // 显示结果
-function showResult(message, downloadUrl) {
+function showResult(message, icsBlob) {
     document.getElementById('resultMessage').textContent = message;
     document.getElementById('resultArea').style.display = 'block';
 
-    // 设置下载按钮
+    // 设置下载按钮：内容已经在浏览器中，不再请求服务器
     const downloadBtn = document.getElementById('downloadBtn');
     downloadBtn.onclick = function () {
-        window.open(downloadUrl, '_blank');
+        saveBlob(icsBlob, '课表.ics');
+    };
+
+    // 设置订阅按钮：第一次订阅时把 webcal:// 地址交给系统日历应用，之后只更新原来的订阅
+    const subscribeBtn = document.getElementById('subscribeBtn');
+    subscribeBtn.onclick = function () {
+        storeCalendar()
+            .then(data => subscribeCalendar(data.ics_file))
+            .then(feed => {
+                if (feed.created) {
+                    window.location.href = 'webcal://' + window.location.host + feed.feed_url;
+                } else {
+                    showAlert('已更新订阅的日历，日历应用下次刷新时会显示新课表', 'success');
+                }
+            })
+            .catch(error => {
+                console.error('生成订阅地址错误:', error);
+                showAlert('生成订阅地址失败: ' + error.message, 'danger');
+            });
     };
 
     // 设置CalDAV按钮
@@ -130,20 +265,16 @@ function showResult(message, downloadUrl) {
 
 // 创建CalDAV账户
 function createCalDAVAccount() {
-    if (!currentIcsFile) {
-        showAlert('请先上传并处理课表文件', 'warning');
-        return;
-    }
-
-    fetch('/api/caldav/create', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-            ics_file: currentIcsFile
-        })
-    })
+    storeCalendar()
+        .then(() => fetch('/api/caldav/create', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                ics_file: currentIcsFile
+            })
+        }))
         .then(response => response.json())
         .then(data => {
             if (data.success) {
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+静态文件预压缩
+
+nginx 直接发送 /static/ 并开启了 gzip_static：存在 <文件>.gz 时直接发送压缩版本，不在请求中压缩。
+docker-compose.yml 中的 static 服务在启动时运行这个脚本生成 .gz 文件，
+不用 docker-compose 部署时，部署或更新静态文件后手动运行：
+    python static_assets.py [静态文件目录]
+内容没有变化的文件不重新压缩。
+"""
+
+import os
+import sys
+import gzip
+
+# 需要预先压缩的静态文件类型
+STATIC_SUFFIXES = ('.js', '.css', '.html', '.svg', '.json')
+
+# 只压缩一次、之后多次发送，使用最高压缩级别
+GZIP_LEVEL = 9
+
+GZIP_SUFFIX = '.gz'
+
+def compress_static(directory: str) -> int:
+    """为静态文件写好 .gz 版本，返回写入的文件数（已是最新的不计入）"""
+    count = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for name in filenames:
+            if not name.endswith(STATIC_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            gz_path = f"{path}{GZIP_SUFFIX}"
+            if os.path.exists(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(path):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 先写临时文件再改名，nginx 不会发送写了一半的文件
+            tmp_path = f"{gz_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+            os.replace(tmp_path, gz_path)
+            count += 1
+    return count
+
+def main(argv=None) -> int:
+    """命令行：python static_assets.py [静态文件目录]"""
+    argv = sys.argv[1:] if argv is None else argv
+    directory = argv[0] if argv else 'static'
+    if not os.path.isdir(directory):
+        print(f"目录不存在: {directory}")
+        return 2
+    print(f"已压缩 {compress_static(directory)} 个文件")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,12 +9,8 @@ import os
 import tempfile
 from calendar_generator import BJTUCalendarGenerator
 
-def test_calendar_generator():
-    """测试日历生成器"""
-    print("测试日历生成器...")
-    
-    # 创建测试HTML内容（使用BJTU教务系统格式）
-    test_html = """
+# 测试HTML内容（使用BJTU教务系统格式）
+TEST_HTML = """
     <html>
     <body>
         <table class="table table-bordered">
@@ -69,7 +65,13 @@ def test_calendar_generator():
         </table>
     </body>
     </html>
-    """
+"""
+
+def test_calendar_generator():
+    """测试日历生成器"""
+    print("测试日历生成器...")
+    
+    test_html = TEST_HTML
     
     # 创建临时文件
     with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False, encoding='utf-8') as f:
@@ -95,6 +97,1421 @@ def test_calendar_generator():
         # 清理临时文件
         os.unlink(temp_file)
 
+def test_generate_from_memory():
+    """测试直接从字节和文件对象生成（不落盘）"""
+    print("\n测试内存输入...")
+    
+    import io
+    from calendar_generator import Parser
+    
+    expected = Parser(TEST_HTML.encode('utf-8')).parse()
+    assert len(expected) == 2
+    
+    # 上传流：读指针不在开头时也应完整读取
+    stream = io.BytesIO(TEST_HTML.encode('utf-8'))
+    stream.read(10)
+    assert Parser(stream).parse() == expected
+    
+    # GBK编码并声明了charset的旧版页面
+    gbk_html = TEST_HTML.replace('<html>', '<html><head><meta charset="gbk"></head>', 1)
+    assert Parser(gbk_html.encode('gbk')).parse() == expected
+    
+    # 未声明charset的GBK页面
+    assert Parser(TEST_HTML.encode('gbk')).parse() == expected
+    
+    ics_content = BJTUCalendarGenerator().generate_from_html(TEST_HTML.encode('utf-8'))
+    assert 'BEGIN:VEVENT' in ics_content
+    print("✅ 内存输入测试通过")
+
+def test_parser_engines():
+    """测试 lxml 与 bs4 解析引擎结果一致"""
+    print("\n测试解析引擎一致性...")
+    
+    from calendar_generator import Parser
+    from benchmark import make_sample_html
+    
+    # 不规范的单元格：缺少地点、实体字符、缺少周数、同一格多门课
+    messy_html = TEST_HTML.replace(
+        '<td></td>',
+        """<td><div><span>A101 [01]<br/>离散数学&amp;图论</span><div>第1, 3, 5周
+        <i>张&nbsp;三</i></div></div><div><span>B202 [02] 体育</span></div></td>""",
+        1,
+    )
+    
+    for html in (TEST_HTML, messy_html, make_sample_html()):
+        bs4_courses = Parser(html, engine="bs4").parse()
+        lxml_courses = Parser(html, engine="lxml").parse()
+        assert bs4_courses, "bs4 引擎没有解析出课程"
+        assert lxml_courses == bs4_courses
+    
+    print("✅ 解析引擎一致性测试通过")
+
+def split_ics(ics_content):
+    """展开折行，拆分为日历头和按UID排序的VEVENT块，便于比较两种序列化结果"""
+    unfolded = ics_content.replace('\r\n ', '').strip('\r\n')
+    header, _, rest = unfolded.partition('\r\nBEGIN:VEVENT')
+    events = ('BEGIN:VEVENT' + rest).split('\r\nEND:VEVENT')
+    return header, sorted(event.strip('\r\n') for event in events if 'BEGIN:VEVENT' in event)
+
+def test_course_model():
+    """测试位图周集合的课程模型"""
+    print("\n测试课程模型...")
+    
+    from datetime import datetime
+    from calendar_generator import Parser, Writer, week_type_detect
+    from course_model import Course, find_conflicts, mask_from_week_data, week_data_from_mask
+    
+    for weeks_str in ('第01-16周', '第02, 04, 06, 08, 10, 12, 14, 16周', '第1, 4, 5, 9周', '第3, 7周'):
+        week_type, week_data = week_type_detect(weeks_str)
+        mask = mask_from_week_data(week_type, week_data)
+        assert week_data_from_mask(mask) == (week_type, week_data)
+    
+    courses = Parser(TEST_HTML).parse_courses()
+    assert all(isinstance(course, Course) for course in courses)
+    se, prob = courses
+    assert (se.first_week, se.last_week, se.week_count, se.interval) == (1, 16, 16, 1)
+    assert (prob.first_week, prob.week_count, prob.interval) == (2, 8, 2)
+    
+    # 字典格式与 Course 可以互相转换，Writer 对两种输入生成相同的日历
+    dicts = Parser(TEST_HTML).parse()
+    assert [Course.from_dict(item) for item in dicts] == courses
+    semester_start = datetime(2025, 9, 8)
+    assert ''.join(Writer(dicts, semester_start).iter_ics()) == ''.join(Writer(courses, semester_start).iter_ics())
+    
+    # 同一时段周数有交集才算冲突
+    from dataclasses import replace
+    odd_weeks = replace(se, course_id='X100', weeks=mask_from_week_data('interval', {'start': 1, 'interval': 2, 'count': 8}))
+    even_weeks = replace(odd_weeks, weeks=odd_weeks.weeks << 1)
+    late_weeks = replace(odd_weeks, weeks=mask_from_week_data('continuous', {'start': 17, 'end': 18}))
+    assert se.conflicts_with(odd_weeks) and not odd_weeks.conflicts_with(even_weeks)
+    assert find_conflicts([se, odd_weeks, even_weeks, late_weeks, prob]) == [(se, odd_weeks), (se, even_weeks)]
+    
+    print("✅ 课程模型测试通过")
+
+def test_synthetic_timetable():
+    """测试基准用的合成课表能被完整解析"""
+    print("\n测试合成课表...")
+    
+    from calendar_generator import Parser
+    from benchmark import make_timetable_html
+    
+    html = make_timetable_html(courses=80, multi_div_ratio=0.3, seed=1)
+    courses = Parser(html).parse()
+    assert len(courses) == 80
+    assert {course['weeks']['type'] for course in courses} == {'continuous', 'discontinuous', 'interval'}
+    # 超过49个格子的课程会放进已有课程的格子
+    assert len({(course['time']['weekday'], course['time']['lesson']) for course in courses}) < 80
+    assert make_timetable_html(courses=80, multi_div_ratio=0.3, seed=1) == html
+    
+    print("✅ 合成课表测试通过")
+
+def test_native_serializer():
+    """测试原生序列化与 ics 库输出一致，并正确折行"""
+    print("\n测试原生ICS序列化...")
+    
+    from datetime import datetime
+    from calendar_generator import Parser, Writer
+    from benchmark import make_sample_html
+    
+    data = Parser(make_sample_html()).parse() + Parser(TEST_HTML).parse()
+    # 需要转义和折行的长字段
+    data.append(dict(data[0], name='数据结构, 算法; 设计\\实践' * 4, location='逸夫教学楼 YF101, 多媒体教室'))
+    
+    writer = Writer(data, datetime(2025, 9, 8))
+    native = ''.join(writer.iter_ics())
+    assert split_ics(native) == split_ics(str(writer.generate_ics()))
+    
+    # 每行不超过75字节，且以CRLF结尾
+    assert native.endswith('END:VCALENDAR\r\n')
+    lines = native.split('\r\n')
+    assert all(len(line.encode('utf-8')) <= 75 for line in lines)
+    assert any(line.startswith(' ') for line in lines)
+    
+    print("✅ 原生ICS序列化测试通过")
+
+def test_slot_table():
+    """测试作息表：教学楼索引、子串兜底和本地时间模式"""
+    print("\n测试作息表...")
+    
+    from datetime import datetime
+    from calendar_generator import Parser, Writer
+    from slot_table import SLOT_TABLE
+    
+    assert SLOT_TABLE.slot('逸夫教学楼 YF415', 2) == (10 * 60 + 30, 12 * 60 + 20)
+    assert SLOT_TABLE.slot('思源楼 SY207', 2) == (10 * 60 + 10, 12 * 60)
+    assert SLOT_TABLE.resolve_profile('(思源西楼)SX101') == 'staggered'
+    assert SLOT_TABLE.slot('思源楼 SY207', 9) is None
+    
+    writer = Writer(Parser(TEST_HTML).parse(), datetime(2025, 9, 8), time_mode='local')
+    local = ''.join(writer.iter_ics())
+    assert local.count('BEGIN:VTIMEZONE') == 1
+    assert 'DTSTART;TZID=Asia/Shanghai:20250908T080000' in local
+    assert 'DTEND;TZID=Asia/Shanghai:20250916T120000' in local
+    # ics 库输出总是UTC时间
+    assert '20250908T000000Z' in str(writer.generate_ics())
+    
+    print("✅ 作息表测试通过")
+
+def test_occurrences():
+    """测试上课实例展开、节假日排除（EXDATE）和按周查询接口"""
+    print("\n测试上课实例展开...")
+    
+    import io
+    from datetime import date, datetime
+    from calendar_generator import Parser, Writer
+    from holiday_table import HolidayTable
+    from occurrences import expand, expand_python
+    from benchmark import make_timetable_html
+    import app as app_module
+    
+    holidays = HolidayTable({'holidays': [{'name': '国庆节', 'start': '2025-10-01', 'end': '2025-10-08'}]})
+    semester_start = datetime(2025, 9, 8)
+    # 2025-10-01 是第4周星期三，2025-10-06 是第5周星期一
+    masks = holidays.week_masks(semester_start.date())
+    assert masks[3] == (1 << 4) | (1 << 5) and masks[1] == 1 << 5
+    
+    # 向量化展开与逐个展开一致（连续、间隔、不连续周）
+    html = make_timetable_html(courses=60, week_mix={'continuous': 1, 'interval': 1, 'discontinuous': 1})
+    courses = Parser(html).parse_courses()
+    occurrences = expand(courses, semester_start, holiday_table=holidays)
+    assert occurrences.records() == expand_python(courses, semester_start, holiday_table=holidays)
+    assert len(occurrences) == sum(course.week_count for course in courses)
+    week5 = occurrences.in_week(5)
+    assert set(week5.week.tolist()) == {5} and len(week5.without_holidays()) < len(week5)
+    assert len(occurrences.between(date(2025, 10, 6), date(2025, 10, 12))) == len(week5)
+    
+    # 节假日的上课写成 EXDATE，两种序列化一致
+    writer = Writer(Parser(TEST_HTML).parse(), semester_start, holiday_table=holidays)
+    native = ''.join(writer.iter_ics())
+    assert 'EXDATE:20251006T000000Z' in native
+    assert split_ics(native) == split_ics(str(writer.generate_ics()))
+    local = ''.join(Writer(Parser(TEST_HTML).parse(), semester_start, time_mode='local', holiday_table=holidays).iter_ics())
+    assert 'EXDATE;TZID=Asia/Shanghai:20251006T080000' in local
+    
+    with app_module.app.test_client() as client:
+        def query(**params):
+            data = {'file': (io.BytesIO(TEST_HTML.encode('utf-8')), 'timetable.html')}
+            return client.post('/api/schedule', data=data, query_string=params, content_type='multipart/form-data')
+        
+        response = query(week=1)
+        assert response.status_code == 200
+        result = response.get_json()
+        assert result['count'] == len(result['occurrences']) > 0
+        assert all(item['week'] == 1 for item in result['occurrences'])
+        starts = [item['start'] for item in result['occurrences']]
+        assert starts == sorted(starts)
+        
+        first_day = result['semester_start']
+        response = query(start=first_day, end=first_day)
+        assert all(item['start'].startswith(first_day) for item in response.get_json()['occurrences'])
+        assert query(week='x').status_code == 400
+        assert query(start='2025/09/08').status_code == 400
+    
+    print("✅ 上课实例展开测试通过")
+
+def test_week_rules():
+    """测试不规则上课周拆成重复规则：展开后与原来的周集合完全一致"""
+    print("\n测试上课周重复规则...")
+    
+    from unittest import mock
+    import random
+    from dataclasses import replace
+    from datetime import datetime, timedelta
+    from dateutil.rrule import rrulestr
+    from calendar_generator import Parser, Writer, course_uid, week_type_detect
+    from course_model import mask_from_week_data, mask_to_weeks, weeks_to_mask
+    from holiday_table import HolidayTable
+    from week_rules import EVENT_COST, SEARCH_MAX_WEEKS, _rest, decompose_weeks, plan_cost, run_mask
+    
+    # 区间和单周混合的写法
+    assert week_type_detect('第1-4, 6, 9-16周') == ('discontinuous', [1, 2, 3, 4, 6, 9, 10, 11, 12, 13, 14, 15, 16])
+    assert week_type_detect('第3周') == ('continuous', {'start': 3, 'end': 3})
+    runs = decompose_weeks(weeks_to_mask([1, 2, 3, 4, 6, 9, 10, 11, 12, 13, 14, 15, 16]))
+    assert [(run.start, run.interval, run.count, run.exdates) for run in runs] == [(1, 1, 16, (5, 7, 8))]
+    
+    # 随机周集合：各段实际上课的周互不重复，合起来恰好是原集合；不会比每周一个事件更贵
+    rng = random.Random(0)
+    for _ in range(500):
+        mask = weeks_to_mask(rng.sample(range(1, 21), rng.randint(1, 14)))
+        runs = decompose_weeks(mask)
+        covered = 0
+        for run in runs:
+            assert covered & run_mask(run) == 0
+            covered |= run_mask(run)
+        assert covered == mask
+        assert plan_cost(runs) <= EVENT_COST * mask.bit_count()
+    long_mask = weeks_to_mask(rng.sample(range(1, 60), SEARCH_MAX_WEEKS + 5))
+    assert weeks_to_mask([week for run in decompose_weeks(long_mask) for week in mask_to_weeks(run_mask(run))]) == long_mask
+    
+    # 最坏情况：分布很散的周集合（32 of 63 周）考察的候选数有上限，超出时改用贪心拆分（耗时见 benchmark.py --only week-rules）
+    import week_rules
+    sparse = [weeks_to_mask(rng.sample(range(1, 64), n)) for n in (SEARCH_MAX_WEEKS, 32) for _ in range(50)]
+    _rest.cache_clear()
+    spent = [0]
+    def counting_spend(spend=week_rules._spend):
+        spent[0] += 1
+        spend()
+    with mock.patch.object(week_rules, '_spend', counting_spend), \
+            mock.patch.object(week_rules, '_greedy', wraps=week_rules._greedy) as greedy:
+        for mask in sparse:
+            spent[0] = 0
+            assert weeks_to_mask([week for run in decompose_weeks(mask) for week in mask_to_weeks(run_mask(run))]) == mask
+            assert spent[0] <= week_rules.SEARCH_BUDGET + 1
+            if mask.bit_count() > SEARCH_MAX_WEEKS:
+                assert spent[0] == 0
+        assert greedy.call_count == 50  # 超过 SEARCH_MAX_WEEKS 的 50 个周集合
+        # 预算用完时中止搜索，改用贪心拆分
+        _rest.cache_clear()
+        greedy.reset_mock()
+        with mock.patch.object(week_rules, 'SEARCH_BUDGET', 100):
+            spent[0] = 0
+            mask = sparse[0]
+            assert weeks_to_mask([week for run in decompose_weeks(mask) for week in mask_to_weeks(run_mask(run))]) == mask
+            assert spent[0] == 101 and greedy.call_count == 1
+    
+    # 生成的日历用 dateutil 展开，与每门课的上课时间一致（包括节假日排除）
+    holidays = HolidayTable({'holidays': [{'name': '国庆节', 'start': '2025-10-01', 'end': '2025-10-08'}]})
+    semester_start = datetime(2025, 9, 8)
+    base = Parser(TEST_HTML).parse_courses()[0]
+    week_sets = [rng.sample(range(1, 19), rng.randint(1, 12)) for _ in range(60)] + [
+        # 需要拆成多个事件的周集合
+        list(range(1, 19)) + list(range(45, 63)),
+        list(range(1, 19)) + list(range(22, 60, 2)),
+        list(range(1, 36, 2)) + list(range(40, 63)),
+        list(range(1, 19)) + list(range(30, 48)),
+        [1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 14, 16],
+    ]
+    courses = [
+        replace(base, class_id=f'{i:02d}', weekday=i % 7 + 1, weeks=weeks_to_mask(weeks))
+        for i, weeks in enumerate(week_sets)
+    ]
+    assert sum(len(decompose_weeks(course.weeks)) > 1 for course in courses) >= 2
+    writer = Writer(courses, semester_start, holiday_table=holidays)
+    native = ''.join(writer.iter_ics())
+    assert 'BYSETPOS' not in native
+    assert split_ics(native) == split_ics(str(writer.generate_ics()))
+    
+    # 同一门课拆成的各个事件 UID 为 course_uid(course, 1, 段号)，按课程汇总展开的上课时间
+    uid_courses = {course_uid(course, 1, part): course for course in courses for part in range(1, 8)}
+    expanded = {}
+    for event in split_ics(native)[1]:
+        lines = [line for line in event.split('\r\n')
+                 if line.split(':')[0].split(';')[0] in ('DTSTART', 'RRULE', 'RDATE', 'EXDATE')]
+        uid = next(line for line in event.split('\r\n') if line.startswith('UID:'))[4:]
+        rule = rrulestr('\n'.join(lines), forceset=True)
+        expanded.setdefault(uid_courses[uid], []).extend(dt.replace(tzinfo=None) for dt in rule)
+    
+    start_minute = writer.slot_table.slot(base.location, base.lesson)[0]
+    offset = timedelta(minutes=start_minute) - timedelta(hours=8)  # 事件时间为 UTC
+    expected = {}
+    for course in courses:
+        days = [semester_start + timedelta(days=(week - 1) * 7 + course.weekday - 1) for week in mask_to_weeks(course.weeks)]
+        expected[course] = sorted(day + offset for day in days if day.date() not in holidays.dates)
+    assert {course: sorted(dts) for course, dts in expanded.items()} == {
+        course: dts for course, dts in expected.items() if dts}
+    
+    print("✅ 上课周重复规则测试通过")
+
+def test_lesson_blocks():
+    """测试连堂课合并为一个事件"""
+    print("\n测试连堂课合并...")
+    
+    from dataclasses import replace
+    from datetime import datetime
+    from calendar_generator import Parser, Writer, course_uid
+    from lesson_blocks import coalesce_lessons
+    from slot_table import SlotTable
+    
+    slot_table = SlotTable({'timezone': 'Asia/Shanghai', 'default_profile': 'standard', 'profiles': {'standard': {
+        'lessons': {'1': {'start': '08:00', 'end': '09:50'}, '2': {'start': '10:10', 'end': '12:00'},
+                    '3': {'start': '14:00', 'end': '15:50'}, '4': {'start': '16:10', 'end': '18:00'}}}}})
+    base = replace(Parser(TEST_HTML).parse_courses()[0], weekday=2)
+    first, second, third, fourth = (replace(base, lesson=lesson) for lesson in (1, 2, 3, 4))
+    other_teacher = replace(base, weekday=3, lesson=2, teacher='另一位教师')
+    courses = [fourth, replace(base, weekday=3, lesson=1), second, other_teacher, first, third]
+    
+    # 第1、2节合并；第2、3节之间隔午饭不合并；教师不同的不合并；块按第一节在原列表中的顺序
+    blocks = coalesce_lessons(courses, slot_table, max_gap=30)
+    assert [(block.course.weekday, block.course.lesson, block.last_lesson) for block in blocks] == \
+        [(3, 1, 1), (3, 2, 2), (2, 1, 2), (2, 3, 4)]
+    assert blocks[2].courses == (first, second)
+    assert len(coalesce_lessons(courses, slot_table, max_gap=120)) == 3
+    
+    semester_start = datetime(2025, 9, 8)
+    merged = Writer(courses, semester_start, slot_table=slot_table, time_mode='local')
+    separate = Writer(courses, semester_start, slot_table=slot_table, time_mode='local', coalesce=False)
+    merged_ics, separate_ics = ''.join(merged.iter_ics()), ''.join(separate.iter_ics())
+    assert merged_ics.count('BEGIN:VEVENT') == 4 and separate_ics.count('BEGIN:VEVENT') == 6
+    # 合并后的事件从第一节上课到最后一节下课，UID 与第一节单独生成时相同
+    event = next(event for event in split_ics(merged_ics)[1] if course_uid(first) in event)
+    assert 'DTSTART;TZID=Asia/Shanghai:20250909T080000' in event
+    assert 'DTEND;TZID=Asia/Shanghai:20250909T120000' in event
+    assert 'DTEND;TZID=Asia/Shanghai:20250909T180000' in merged_ics
+    
+    utc_writer = Writer(courses, semester_start, slot_table=slot_table)
+    assert split_ics(''.join(utc_writer.iter_ics())) == split_ics(str(utc_writer.generate_ics()))
+    
+    print("✅ 连堂课合并测试通过")
+
+def test_free_slots():
+    """测试多份课表的共同空闲时段和冲突最少的时段"""
+    print("\n测试共同空闲时间...")
+    
+    import io
+    import random
+    from course_model import Course, weeks_to_mask
+    from free_slots import FreeSlotFinder, parse_range
+    import app as app_module
+    
+    def course(weekday, lesson, weeks):
+        return Course('M1', '01', '课程', weekday, lesson, '教师', '思源楼 SY101', weeks_to_mask(weeks))
+    
+    # 甲周一第1节全学期有课，乙只有单周有课：周一第1节只有双周共同空闲
+    finder = FreeSlotFinder({'甲': [course(2, 1, range(1, 17))], '乙': [course(1, 1, range(1, 17, 2))]},
+                            weekdays=[1, 2], lessons=[1])
+    result = finder.find()
+    assert result['common_free'] == [{'weekday': 1, 'lesson': 1, 'weeks': list(range(2, 17, 2))}]
+    assert result['least_conflicting'] == []
+    
+    # 与逐格统计的结果一致
+    rng = random.Random(7)
+    timetables = {
+        f'学生{i}': [course(rng.randint(1, 5), rng.randint(1, 7), rng.sample(range(1, 17), rng.randint(1, 16)))
+                    for _ in range(30)]
+        for i in range(40)
+    }
+    finder = FreeSlotFinder(timetables, weeks=range(1, 17), weekdays=range(1, 6))
+    counts = {
+        (weekday, lesson, week): sum(1 for items in timetables.values() if any(
+            c.weekday == weekday and c.lesson == lesson and c.weeks >> week & 1 for c in items))
+        for weekday in range(1, 6) for lesson in range(1, 8) for week in range(1, 17)
+    }
+    levels = sorted(set(counts.values()))
+    result = finder.find()
+    if not result['common_free']:
+        for level, expected in zip(result['least_conflicting'], levels):
+            assert level['conflicts'] == expected
+            cells = {(slot['weekday'], slot['lesson'], week) for slot in level['slots'] for week in slot['weeks']}
+            assert cells == {key for key, value in counts.items() if value == expected}
+            for slot in level['slots']:
+                assert len(slot['busy']) == expected, slot
+    
+    # 甲只在第1周、乙只在第2周有课：同一时段按有课的人分组，busy 与冲突人数一致
+    finder = FreeSlotFinder({'甲': [course(1, 1, [1])], '乙': [course(1, 1, [2])]},
+                            weeks=[1, 2], weekdays=[1], lessons=[1])
+    level = finder.find()['least_conflicting'][0]
+    assert level['conflicts'] == 1
+    assert level['slots'] == [{'weekday': 1, 'lesson': 1, 'weeks': [1], 'busy': ['甲']},
+                              {'weekday': 1, 'lesson': 1, 'weeks': [2], 'busy': ['乙']}]
+    
+    assert parse_range('1-3,5', 1, 7) == [1, 2, 3, 5] and parse_range('', 1, 7) is None
+    
+    with app_module.app.test_client() as client:
+        data = {'files': [(io.BytesIO(TEST_HTML.encode('utf-8')), '甲.html'),
+                          (io.BytesIO(TEST_HTML.encode('utf-8')), '甲.html'),
+                          (io.BytesIO(b'<html>nothing</html>'), '乙.html')]}
+        response = client.post('/api/free-slots?weekdays=1-5&lessons=1-5', data=data, content_type='multipart/form-data')
+        assert response.status_code == 200
+        result = response.get_json()
+        assert result['participants'] == 2 and len(result['errors']) == 1
+        assert all(slot['weekday'] <= 5 and slot['lesson'] <= 5 for slot in result['common_free'])
+        data = {'files': [(io.BytesIO(TEST_HTML.encode('utf-8')), '甲.html')]}
+        assert client.post('/api/free-slots?weekdays=0-9', data=data, content_type='multipart/form-data').status_code == 400
+    
+    print("✅ 共同空闲时间测试通过")
+
+def test_section_index():
+    """测试教学班索引：相同记录只存一份、发现不一致、由索引生成合并日历"""
+    print("\n测试教学班索引...")
+    
+    import io
+    import os
+    import dataclasses
+    import tempfile
+    from unittest import mock
+    from calendar_generator import Parser
+    from section_index import SectionIndex
+    import app as app_module
+    
+    courses = Parser(TEST_HTML).parse_courses()
+    section = courses[0].section_key
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SectionIndex(os.path.join(tmp, 'sections.sqlite3'))
+        for seen in (1.0, 2.0, 3.0):
+            # 同一课表中记录的顺序不影响版本
+            index.record(list(reversed(courses)) if seen == 2.0 else courses, seen=seen)
+        stats = index.stats()
+        assert stats['variants'] == stats['sections'] == len({course.section_key for course in courses})
+        assert index.disagreements() == []
+        
+        # 新导出的课表换了教室：只出现一次时不取代出现3次的版本
+        moved = [dataclasses.replace(course, location='思源东楼 SD101') if course.section_key == section else course
+                 for course in courses]
+        original = {course.location for course in courses if course.section_key == section}
+        index.record(moved, seen=4.0)
+        conflicts = index.disagreements()
+        assert len(conflicts) == 1 and conflicts[0]['fields'] == ['location']
+        assert conflicts[0]['variants'][0]['seen_count'] == 3
+        assert conflicts[0]['variants'][1]['location'] == ['思源东楼 SD101']
+        assert {course.location for course in index.canonical([section])} == original
+        
+        # 后台写入：再出现两次后成为当前版本
+        assert index.submit(moved, seen=5.0) and index.submit(moved, seen=6.0)
+        index.flush()
+        assert index.disagreements()[0]['variants'][0]['location'] == ['思源东楼 SD101']
+        assert {course.location for course in index.canonical([section])} == {'思源东楼 SD101'}
+        assert index.canonical(course_ids=[section[0]]) == index.canonical([section])
+        assert index.canonical() == []
+    
+    with app_module.app.test_client() as client:
+        html = TEST_HTML.replace('</table>', '<!-- sections --></table>')
+        before = app_module.section_index.stats()['records_seen']
+        # 直接下载模式不写入索引
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html'), 'mode': 'inline'}
+        assert client.post('/api/upload', data=data, content_type='multipart/form-data').status_code == 200
+        app_module.section_index.flush()
+        assert app_module.section_index.stats()['records_seen'] == before
+        
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+        assert client.post('/api/upload', data=data, content_type='multipart/form-data').status_code == 200
+        app_module.section_index.flush()
+        assert app_module.section_index.stats()['records_seen'] > before
+        
+        # 健康检查只读写入计数，不查询数据库；读取失败也不影响健康检查
+        with mock.patch.object(app_module.section_index, 'stats', side_effect=AssertionError("不应查询数据库")):
+            sections = client.get('/api/health').get_json()['sections']
+        assert sections['written'] >= 1 and sections['queue_depth'] == 0 and sections['write_errors'] == 0
+        with mock.patch.object(app_module.section_index, 'counters', side_effect=RuntimeError("locked")):
+            response = client.get('/api/health')
+            assert response.status_code == 200 and response.get_json()['sections'] == {'error': 'locked'}
+        
+        response = client.get('/api/sections/calendar', query_string={'section': '-'.join(section)})
+        assert response.status_code == 200 and response.mimetype == 'text/calendar'
+        assert response.data.count(b'BEGIN:VEVENT') == sum(1 for course in courses if course.section_key == section)
+        assert client.get('/api/sections/calendar', query_string={'course': 'NOPE'}).status_code == 404
+        assert client.get('/api/sections/calendar').status_code == 400
+        assert client.get('/api/sections/disagreements').get_json()['success']
+    
+    print("✅ 教学班索引测试通过")
+
+def test_batch_convert():
+    """测试批量转换的流式zip输出"""
+    print("\n测试批量转换...")
+    
+    import io
+    import json
+    import zipfile
+    from datetime import datetime
+    from concurrent.futures import ThreadPoolExecutor
+    from batch_converter import stream_batch_zip
+    
+    inputs = [(f'学生{i}.html', TEST_HTML.encode('utf-8')) for i in range(5)]
+    inputs.append(('学生0.html', b'<html>nothing</html>'))
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        chunks = list(stream_batch_zip(inputs, datetime(2025, 9, 8), executor=executor, max_in_flight=2))
+    # 每完成一批就输出一段，而不是最后一次性输出
+    assert len(chunks) > 2
+    
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    manifest = json.loads(archive.read('manifest.json'))
+    assert manifest['total'] == 6 and manifest['succeeded'] == 5
+    ics_files = [item['ics_file'] for item in manifest['files'] if item['status'] == 'ok']
+    assert len(set(ics_files)) == 5
+    assert all(b'BEGIN:VEVENT' in archive.read(name) for name in ics_files)
+    
+    # 文件数和解压后总大小在解压每个文件之前检查：超出限制时不会把整个 zip 读入内存
+    import batch_converter
+    import app as app_module
+    
+    def make_zip(count, size):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as bomb:
+            for i in range(count):
+                bomb.writestr(f'{i}.html', b'<html>' + b' ' * size)
+        return buffer.getvalue()
+    
+    reads = []
+    original_read = zipfile.ZipFile.read
+    zipfile.ZipFile.read = lambda self, name, pwd=None: reads.append(name) or original_read(self, name, pwd)
+    limits = (batch_converter.BATCH_MAX_FILES, batch_converter.BATCH_MAX_TOTAL_SIZE)
+    batch_converter.BATCH_MAX_FILES, batch_converter.BATCH_MAX_TOTAL_SIZE = 5, 4 * 1024 * 1024
+    try:
+        with app_module.app.test_client() as client:
+            def post(content):
+                data = {'files': (io.BytesIO(content), 'class.zip')}
+                return client.post('/api/batch', data=data, content_type='multipart/form-data')
+            
+            response = post(make_zip(1000, 10))
+            assert response.status_code == 400 and '5' in response.get_json()['error']
+            assert len(reads) == 5
+            
+            reads.clear()
+            response = post(make_zip(3, 3 * 1024 * 1024))  # 压缩后只有几 KB
+            assert response.status_code == 400 and 'MB' in response.get_json()['error']
+            assert len(reads) == 1
+    finally:
+        zipfile.ZipFile.read = original_read
+        batch_converter.BATCH_MAX_FILES, batch_converter.BATCH_MAX_TOTAL_SIZE = limits
+    
+    print("✅ 批量转换测试通过")
+
+def test_result_cache():
+    """测试ICS结果缓存"""
+    print("\n测试ICS结果缓存...")
+    
+    import io
+    from datetime import datetime
+    from app import app, result_cache
+    from result_cache import make_cache_key
+    
+    semester_start = datetime(2025, 9, 8)
+    key = make_cache_key(TEST_HTML, semester_start)
+    
+    # 空白和 "[ 选中 ]" 标记不影响缓存键
+    noisy_html = TEST_HTML.replace('软件工程<br />', '软件工程<br />\n   <span class="sel">[ 选中 ]</span>')
+    assert make_cache_key(noisy_html, semester_start) == key
+    assert make_cache_key(TEST_HTML.replace('\n', '\n    '), semester_start) == key
+    assert make_cache_key(TEST_HTML, datetime(2026, 3, 2)) != key
+    # 文本中的空白不同是不同的课表
+    assert 'YF415' in TEST_HTML
+    assert make_cache_key(TEST_HTML.replace('YF415', 'YF 415'), semester_start) != key
+    assert make_cache_key(TEST_HTML.replace('YF415', 'YF  415'), semester_start) == \
+        make_cache_key(TEST_HTML.replace('YF415', 'YF 415'), semester_start)
+    
+    with app.test_client() as client:
+        def upload(html):
+            data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+            return client.post('/api/upload', data=data, content_type='multipart/form-data')
+        
+        first = upload(TEST_HTML)
+        assert first.status_code == 200
+        hits = result_cache.stats()['hits']
+        
+        second = upload(noisy_html)
+        assert second.status_code == 200
+        assert second.get_json()['download_url'] == first.get_json()['download_url']
+        assert result_cache.stats()['hits'] == hits + 1
+    
+    print("✅ ICS结果缓存测试通过")
+
+def test_artifact_store():
+    """测试生成文件的分目录存储、访问记录和清理"""
+    print("\n测试生成文件清理...")
+    
+    import os
+    import time
+    import tempfile
+    from artifact_store import ArtifactStore, ORPHAN_MAX_AGE
+    
+    with tempfile.TemporaryDirectory() as root:
+        uploads = os.path.join(root, 'uploads')
+        os.makedirs(uploads)
+        store = ArtifactStore(os.path.join(root, 'outputs'), max_age=3600, max_bytes=300, upload_folder=uploads,
+                              encodings=[])
+        
+        now = time.time()
+        paths = {name: store.write_text(name, 'x' * 100) for name in ('a.ics', 'b.ics', 'c.ics', 'old.ics')}
+        assert os.path.dirname(paths['a.ics']) == os.path.join(store.root, store.shard_for('a.ics'))
+        assert store.resolve('../a.ics') is None
+        
+        # 最后访问时间：old 已过期，a 最久未访问，c 刚被下载
+        for name, age in (('old.ics', 7200), ('a.ics', 600), ('b.ics', 300), ('c.ics', 300)):
+            os.utime(paths[name], (now - age, now - age))
+        store.record_access(paths['c.ics'])
+        assert os.stat(paths['c.ics']).st_mtime == now - 300
+        
+        orphan = os.path.join(uploads, 'crashed.html')
+        open(orphan, 'w').close()
+        os.utime(orphan, (now - ORPHAN_MAX_AGE - 1, now - ORPHAN_MAX_AGE - 1))
+        
+        result = store.sweep(now)
+        assert (result['expired'], result['evicted'], result['orphans']) == (1, 1, 1)
+        assert [name for name in paths if store.exists(name)] == ['b.ics', 'c.ics']
+        # 100 字节的文件 + 32 字节的 ETag 文件
+        assert store.stats()['bytes'] == 2 * 132
+        # ETag 文件随主文件删除
+        assert not os.path.exists(paths['old.ics'] + '.etag') and os.path.exists(paths['b.ics'] + '.etag')
+        assert store.etag(paths['b.ics']) == store.etag(paths['c.ics'])
+    
+    print("✅ 生成文件清理测试通过")
+
+def test_calendar_feed():
+    """测试订阅地址：强ETag、条件请求返回304且不读取文件"""
+    print("\n测试日历订阅...")
+    
+    import io
+    import os
+    from unittest import mock
+    import app as app_module
+    
+    with app_module.app.test_client() as client:
+        def upload(marker, room='YF415'):
+            html = TEST_HTML.replace('</table>', f'<!-- {marker} --></table>').replace('YF415', room)
+            data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+            return client.post('/api/upload', data=data, content_type='multipart/form-data').get_json()['ics_file']
+        
+        ics_file = upload('feed')
+        feed = client.post('/api/feed', json={'ics_file': ics_file}).get_json()
+        assert feed['created'] and feed['feed_url'] == f"/api/feed/{feed['feed_token']}.ics"
+        feed_url = feed['feed_url']
+        
+        response = client.get(feed_url)
+        assert response.status_code == 200
+        assert response.mimetype == 'text/calendar' and b'BEGIN:VCALENDAR' in response.data
+        assert 'public' in response.headers['Cache-Control'] and 'max-age' in response.headers['Cache-Control']
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        assert not etag.startswith('W/')
+        
+        # 条件请求：返回 304，不打开文件
+        with mock.patch.object(app_module, 'send_file', side_effect=AssertionError("不应读取文件")):
+            for headers in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified}):
+                response = client.get(feed_url, headers=headers)
+                assert response.status_code == 304 and response.data == b''
+                assert response.headers['ETag'] == etag
+        
+        # ETag 不匹配时优先于 If-Modified-Since
+        response = client.get(feed_url, headers={'If-None-Match': '"stale"', 'If-Modified-Since': last_modified})
+        assert response.status_code == 200
+        
+        # 升级前生成、没有 ETag 文件的文件；之前直接用文件名的订阅地址仍然可用
+        path = app_module.artifact_store.resolve(ics_file)
+        os.remove(path + '.etag')
+        assert client.get(feed_url, headers={'If-None-Match': etag}).status_code == 304
+        legacy_url = f"/api/feed/{ics_file}"
+        assert client.get(legacy_url).data == client.get(feed_url).data
+        
+        # 课表变化后更新订阅：地址不变，旧的 ETag 不再匹配，返回新内容
+        other_file = upload('feed-changed', room='YF416')
+        assert other_file != ics_file
+        wrong_key = {'ics_file': other_file, 'feed_token': feed['feed_token'], 'feed_key': 'wrong'}
+        assert client.post('/api/feed', json=wrong_key).status_code == 403
+        update = {'ics_file': other_file, 'feed_token': feed['feed_token'], 'feed_key': feed['feed_key']}
+        updated = client.post('/api/feed', json=update).get_json()
+        assert not updated['created'] and updated['feed_url'] == feed_url
+        response = client.get(feed_url, headers={'If-None-Match': etag})
+        assert response.status_code == 200 and response.headers['ETag'] != etag
+        assert b'YF416' in response.data and response.data == client.get(f"/api/download/{other_file}").data
+        
+        assert client.post('/api/feed', json={'ics_file': 'missing.ics'}).status_code == 404
+        assert client.get('/api/feed/missing.ics').status_code == 404
+    
+    print("✅ 日历订阅测试通过")
+
+def test_compressed_responses():
+    """测试预压缩的ICS文件按 Accept-Encoding 发送，以及JSON响应压缩"""
+    print("\n测试压缩响应...")
+    
+    import io
+    import gzip
+    import json
+    import os
+    import tempfile
+    import app as app_module
+    from artifact_store import ArtifactStore, enabled_encodings
+    from static_assets import compress_static
+    
+    with app_module.app.test_client() as client:
+        html = TEST_HTML.replace('</table>', '<!-- gzip --></table>')
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+        result = client.post('/api/upload', data=data, content_type='multipart/form-data').get_json()
+        path = app_module.artifact_store.resolve(result['ics_file'])
+        assert os.path.exists(path + '.gz')
+        result['feed_url'] = client.post('/api/feed', json={'ics_file': result['ics_file']}).get_json()['feed_url']
+        
+        plain = client.get(result['download_url'])
+        assert 'Content-Encoding' not in plain.headers and 'Accept-Encoding' in plain.headers['Vary']
+        for url in (result['download_url'], result['feed_url']):
+            response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert response.mimetype == 'text/calendar'
+            assert gzip.decompress(response.data) == plain.data
+        
+        # 不接受 gzip 时发送原文件
+        response = client.get(result['download_url'], headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        assert 'Content-Encoding' not in response.headers and response.data == plain.data
+        
+        # 订阅地址：不同编码的 ETag 不同，各自可以返回 304
+        etag = client.get(result['feed_url'], headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        assert etag != client.get(result['feed_url']).headers['ETag']
+        assert client.get(result['feed_url'], headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag}).status_code == 304
+        assert client.get(result['feed_url'], headers={'If-None-Match': etag}).status_code == 200
+        
+        # JSON 响应
+        response = client.get('/api/health', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'status' in json.loads(gzip.decompress(response.data))
+        assert 'Content-Encoding' not in client.get('/api/health').headers
+    
+    with tempfile.TemporaryDirectory() as root:
+        store = ArtifactStore(root, encodings=enabled_encodings('gzip'))
+        path = store.write_text('a.ics', 'BEGIN:VCALENDAR\r\n' * 100)
+        assert list(store.variants(path)) == ['gzip']
+        assert ArtifactStore(root, encodings=[]).variants(path) == {}
+        
+        static = os.path.join(root, 'static')
+        os.makedirs(static)
+        with open(os.path.join(static, 'app.js'), 'w') as f:
+            f.write('console.log(1);\n' * 100)
+        assert compress_static(static) == 1 and os.path.exists(os.path.join(static, 'app.js.gz'))
+        with open(os.path.join(static, 'app.js.gz'), 'rb') as f:
+            assert gzip.decompress(f.read()) == b'console.log(1);\n' * 100
+        # 没有变化的文件不重新压缩，.gz 文件本身不再压缩
+        assert compress_static(static) == 0 and sorted(os.listdir(static)) == ['app.js', 'app.js.gz']
+    
+    print("✅ 压缩响应测试通过")
+
+def test_inline_upload():
+    """测试行内模式：直接返回ICS内容，不写入outputs/"""
+    print("\n测试行内上传...")
+    
+    import io
+    import app as app_module
+    from calendar_generator import BJTUCalendarGenerator, Parser
+    
+    def listing():
+        return sorted(path for path, _ in app_module.artifact_store._iter_files())
+    
+    with app_module.app.test_client() as client:
+        html = TEST_HTML.replace('</table>', '<!-- inline --></table>')
+        before = listing()
+        for kwargs in ({'query_string': {'mode': 'inline'}}, {'headers': {'Accept': 'text/calendar'}}):
+            data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+            response = client.post('/api/upload', data=data, content_type='multipart/form-data', **kwargs)
+            assert response.status_code == 200 and response.is_streamed
+            assert response.mimetype == 'text/calendar'
+            assert response.headers['X-Course-Count'] == str(len(Parser(html).parse_courses()))
+            assert 'attachment' in response.headers['Content-Disposition']
+            assert 'no-store' in response.headers['Cache-Control']
+            assert response.data.decode('utf-8') == BJTUCalendarGenerator().generate_from_html(html)
+        assert listing() == before
+        
+        # 浏览器默认的 Accept 仍返回JSON
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+        response = client.post('/api/upload', data=data, content_type='multipart/form-data',
+                               headers={'Accept': 'application/json, text/plain, */*'})
+        assert response.get_json()['success']
+        
+        # 已保存过的课表直接发送保存的文件
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+        response = client.post('/api/upload?mode=inline', data=data, content_type='multipart/form-data')
+        assert response.mimetype == 'text/calendar' and b'BEGIN:VCALENDAR' in response.data
+        
+        # 解析失败时返回JSON错误，而不是半截日历
+        data = {'file': (io.BytesIO('<html><body></body></html>'.encode('utf-8')), 'empty.html')}
+        response = client.post('/api/upload?mode=inline', data=data, content_type='multipart/form-data')
+        assert response.status_code == 500 and 'error' in response.get_json()
+    
+    print("✅ 行内上传测试通过")
+
+def test_metrics():
+    """测试 Prometheus 指标：阶段耗时、请求计数，以及多进程汇总"""
+    print("\n测试指标...")
+    
+    import io
+    import os
+    import sys
+    import subprocess
+    import tempfile
+    from prometheus_client.parser import text_string_to_metric_families
+    import metrics
+    from app import app
+    
+    def samples(text):
+        return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+                for family in text_string_to_metric_families(text) for sample in family.samples}
+    
+    with app.test_client() as client:
+        before = samples(client.get('/api/metrics').get_data(as_text=True))
+        html = TEST_HTML.replace('</table>', '<!-- metrics --></table>')
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+        assert client.post('/api/upload', data=data, content_type='multipart/form-data').status_code == 200
+        
+        response = client.get('/api/metrics')
+        assert response.status_code == 200 and response.mimetype == 'text/plain'
+        after = samples(response.get_data(as_text=True))
+    
+    delta = lambda name, **labels: after.get((name, tuple(sorted(labels.items()))), 0) - \
+        before.get((name, tuple(sorted(labels.items()))), 0)
+    for stage_name in ('upload_read', 'cache_lookup', 'html_parse', 'course_parse', 'file_write'):
+        assert delta('bjtu_stage_duration_seconds_count', stage=stage_name) == 1, stage_name
+    assert delta('bjtu_http_requests_total', endpoint='upload_file', method='POST', status='200') == 1
+    assert delta('bjtu_events_total', event='result_cache_miss') == 1
+    
+    # 失败的阶段
+    try:
+        with metrics.stage('test_failure'):
+            raise ValueError
+    except ValueError:
+        pass
+    assert samples(metrics.render(None)[0].decode())[('bjtu_stage_errors_total', (('stage', 'test_failure'),))] == 1
+    
+    # 多进程：两个进程各记录一次，汇总结果为两次
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+        for _ in range(2):
+            subprocess.run([sys.executable, '-c', 'import metrics; metrics.observe("worker", 0.01)'],
+                           env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        merged = samples(metrics.render(directory)[0].decode())
+        assert merged[('bjtu_stage_duration_seconds_count', (('stage', 'worker'),))] == 2
+    
+    print("✅ 指标测试通过")
+
+def test_profiling():
+    """测试按需性能分析（签名头、抽样、保留数量）和 Server-Timing 头"""
+    print("\n测试性能分析...")
+    
+    import io
+    import os
+    import time
+    import tempfile
+    from unittest import mock
+    import app as app_module
+    from profiling import Profiler, sign_token, verify_token
+    
+    now = int(time.time())
+    token = sign_token('secret', now + 60)
+    assert verify_token('secret', token)
+    assert not verify_token('other', token)
+    assert not verify_token('secret', sign_token('secret', now - 1))
+    assert not verify_token('secret', token.replace(':', ':0', 1)) and not verify_token('secret', 'x')
+    
+    def upload(client, marker, headers=None):
+        html = TEST_HTML.replace('</table>', f'<!-- {marker} --></table>')
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html')}
+        return client.post('/api/upload', data=data, content_type='multipart/form-data', headers=headers or {})
+    
+    with tempfile.TemporaryDirectory() as directory, app_module.app.test_client() as client:
+        profiler = Profiler(directory, sample_rate=0, keep=2, secret='secret')
+        with mock.patch.object(app_module, 'profiler', profiler):
+            response = upload(client, 'profile-none')
+            assert 'X-Profile-Id' not in response.headers and os.listdir(directory) == []
+            # Server-Timing 包含各阶段和总耗时
+            timing = response.headers['Server-Timing']
+            for stage_name in ('upload_read', 'html_parse', 'course_parse', 'file_write', 'total'):
+                assert f"{stage_name};dur=" in timing, timing
+            
+            # 伪造的签名头不会触发
+            assert 'X-Profile-Id' not in upload(client, 'profile-forged', {'X-Profile': f"{now + 60}:0"}).headers
+            
+            response = upload(client, 'profile-signed', {'X-Profile': token})
+            assert response.status_code == 200 and response.get_json()['success']
+            assert os.listdir(directory) == [response.headers['X-Profile-Id']]
+            
+            # 抽样：全部记录，只保留最新的两个
+            profiler.sample_rate = 1.0
+            for index in range(3):
+                upload(client, f'profile-sampled-{index}')
+            assert len(os.listdir(directory)) == 2
+
+            # 行内流式上传：分析时先生成完整内容，结果和 Server-Timing 都包含生成日历的耗时
+            import pstats
+            profiler.sample_rate = 0
+            response = upload(client, 'profile-inline', {'X-Profile': token, 'Accept': 'text/calendar'})
+            assert response.status_code == 200 and response.data.startswith(b'BEGIN:VCALENDAR')
+            assert 'render;dur=' in response.headers['Server-Timing'], response.headers['Server-Timing']
+            stats = pstats.Stats(os.path.join(directory, response.headers['X-Profile-Id']))
+            assert any(function[2] == 'iter_ics' for function in stats.stats), "分析结果应包含生成日历"
+
+        # 不分析的流式响应：Server-Timing 标明内容耗时未计入，请求耗时在发送完毕后记录
+        with mock.patch.object(app_module, 'profiler', Profiler(directory, sample_rate=0, secret=None)), \
+                mock.patch.object(app_module.metrics, 'observe_request') as observe_request:
+            response = upload(client, 'profile-stream', {'Accept': 'text/calendar'})
+            assert 'stream;desc=' in response.headers['Server-Timing']
+            assert observe_request.call_count == 0
+            response.get_data()
+            response.close()
+            assert observe_request.call_count == 1 and observe_request.call_args[0][0] == 'upload_file'
+
+        # 没有设置密钥时不接受签名头
+        assert not Profiler(directory, sample_rate=0, secret=None).should_profile(token)
+
+    # 占位密钥不用于签名，PROFILE_SECRET 优先于 SECRET_KEY
+    from profiling import profile_secret
+    with mock.patch.dict(os.environ, {'SECRET_KEY': 'your-secret-key-change-in-production'}):
+        os.environ.pop('PROFILE_SECRET', None)
+        assert profile_secret() is None
+        os.environ['PROFILE_SECRET'] = 'profile-only'
+        assert profile_secret() == 'profile-only'
+    
+    print("✅ 性能分析测试通过")
+
+def test_jobs():
+    """测试异步生成任务和有界队列"""
+    print("\n测试异步生成任务...")
+    
+    import io
+    import os
+    import time
+    import tempfile
+    import threading
+    from app import app
+    from jobs import JobQueue, QueueFull
+    
+    with app.test_client() as client:
+        # 加一段注释，避免命中其他测试生成的缓存
+        html = TEST_HTML.replace('</table>', '<!-- job --></table>')
+        data = {'file': (io.BytesIO(html.encode('utf-8')), 'timetable.html'), 'mode': 'job'}
+        response = client.post('/api/upload', data=data, content_type='multipart/form-data')
+        assert response.status_code == 202
+        status_url = response.get_json()['status_url']
+        
+        for _ in range(100):
+            job = client.get(status_url).get_json()
+            if job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.05)
+        assert job['status'] == 'done', job
+        assert client.get(job['download_url']).status_code == 200
+        assert client.get('/api/jobs/missing').status_code == 404
+    
+    # 队列满时拒绝新任务，失败的任务记录错误信息
+    with tempfile.TemporaryDirectory() as root:
+        jobs = JobQueue(os.path.join(root, 'jobs.sqlite3'), workers=1, max_queued=1)
+        release = threading.Event()
+        running = jobs.submit(lambda: release.wait(5) and {'ok': True})
+        while jobs.get(running)['status'] != 'running':
+            time.sleep(0.01)
+        failing = jobs.submit(lambda: 1 / 0)
+        try:
+            jobs.submit(dict)
+            assert False, "队列已满时应拒绝任务"
+        except QueueFull:
+            pass
+        release.set()
+        while jobs.get(failing)['status'] in ('queued', 'running'):
+            time.sleep(0.01)
+        assert jobs.get(running)['ok'] is True
+        assert jobs.get(failing)['error'] == 'division by zero'
+    
+    print("✅ 异步生成任务测试通过")
+
+def _create_users(path, prefix, count):
+    """压力测试子进程：逐个创建用户"""
+    from user_store import HtpasswdUserStore
+    store = HtpasswdUserStore(path)
+    for i in range(count):
+        store.add(f"{prefix}_{i}", f"$2b$04$hash{prefix}{i}")
+
+def test_user_store():
+    """测试用户文件：多进程并发创建不丢用户，删除后旧行不再存在"""
+    print("\n测试Radicale用户文件...")
+    
+    import os
+    import tempfile
+    import multiprocessing
+    from user_store import HtpasswdUserStore
+    
+    processes, per_process = 4, 500
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'users')
+        store = HtpasswdUserStore(path)
+        store.add('existing', 'hash0')
+        
+        context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+        workers = [context.Process(target=_create_users, args=(path, f"p{n}", per_process)) for n in range(processes)]
+        for worker in workers:
+            worker.start()
+        # 创建过程中本进程的索引增量读取不出错
+        assert 'existing' in store
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+        
+        assert len(store) == processes * per_process + 1
+        with open(path, encoding='utf-8') as f:
+            assert len(f.read().splitlines()) == processes * per_process + 1
+        
+        # 删除和修改密码会去掉旧的行
+        assert store.delete('p0_0') and not store.delete('p0_0')
+        store.add('p1_0', 'new-hash')
+        assert store.get('p1_0') == 'new-hash'
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+        assert 'p0_0:' not in content and content.count('p1_0:') == 1
+        
+        # 重复的行可以压缩掉
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('p2_0:dup\n')
+        assert store.get('p2_0') == 'dup'
+        assert store.compact() == 1 and store.get('p2_0') == 'dup'
+    
+    print("✅ Radicale用户文件测试通过")
+
+def test_credential_pool():
+    """测试预生成凭据池：取出后自动补充，哈希可以验证"""
+    print("\n测试凭据池...")
+    
+    import time
+    import bcrypt
+    from concurrent.futures import ThreadPoolExecutor
+    from credential_pool import CredentialPool
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pool = CredentialPool(size=3, rounds=4, executor=executor)
+        first = pool.acquire()  # 池为空，现场生成并启动后台补充
+        assert bcrypt.checkpw(first.password.encode('utf-8'), first.password_hash.encode('utf-8'))
+        assert first.username == f"user_{first.account_id[:8]}"
+        
+        deadline = time.time() + 10
+        while pool.stats()['pool_depth'] < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        second = pool.acquire()
+        assert second.username != first.username
+        
+        stats = pool.stats()
+        assert (stats['pool_hits'], stats['pool_misses']) == (1, 1)
+        assert stats['hashes'] >= 4 and stats['hash_ms_avg'] > 0
+        
+        # 关闭后补充线程退出，不会在执行器关闭后继续提交任务
+        pool.close()
+        assert not pool._refiller.is_alive()
+        
+        # 池中没有凭据时现场生成，等待有上限
+        slow = CredentialPool(size=0, rounds=13, executor=executor)
+        try:
+            slow.acquire(timeout=0.01)
+            assert False, "应当超时"
+        except TimeoutError:
+            pass
+    
+    print("✅ 凭据池测试通过")
+
+class CalDAVStandIn:
+    """测试用的最小 CalDAV 服务：支持 MKCALENDAR、PUT、DELETE、PROPFIND、REPORT，检查 Basic 认证"""
+    
+    def __init__(self, password):
+        import base64
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        
+        self.collections = set()
+        self.objects = {}  # URL路径 -> 内容
+        self.requests = []
+        server = self
+        expected_auth = 'Basic ' + base64.b64encode(f"alice:{password}".encode()).decode()
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            
+            def _start(self):
+                server.requests.append((self.command, self.path))
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.headers.get('Authorization') != expected_auth:
+                    self._reply(401)
+                    return None
+                return body
+            
+            def do_MKCALENDAR(self):
+                if self._start() is None:
+                    return
+                if self.path in server.collections:
+                    self._reply(409)
+                else:
+                    server.collections.add(self.path)
+                    self._reply(201)
+            
+            def do_PUT(self):
+                body = self._start()
+                if body is None:
+                    return
+                existed = self.path in server.objects
+                server.objects[self.path] = body.decode('utf-8')
+                self._reply(204 if existed else 201)
+            
+            def do_DELETE(self):
+                if self._start() is None:
+                    return
+                self._reply(204 if server.objects.pop(self.path, None) is not None else 404)
+            
+            def _multistatus(self, with_data):
+                from xml.sax.saxutils import escape
+                if self.path not in server.collections:
+                    self._reply(404)
+                    return
+                items = ''.join(
+                    f'<D:response><D:href>{path}</D:href><D:propstat><D:prop><D:getetag>"1"</D:getetag>'
+                    + (f'<C:calendar-data>{escape(body)}</C:calendar-data>' if with_data else '')
+                    + '</D:prop></D:propstat></D:response>'
+                    for path, body in server.objects.items() if path.startswith(self.path)
+                )
+                data = ('<?xml version="1.0"?><D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+                        f'{items}</D:multistatus>').encode('utf-8')
+                self.send_response(207)
+                self.send_header('Content-Type', 'application/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def do_PROPFIND(self):
+                if self._start() is not None:
+                    self._multistatus(with_data=False)
+            
+            def do_REPORT(self):
+                if self._start() is not None:
+                    self._multistatus(with_data=True)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def test_caldav_client():
+    """测试通过 CalDAV 协议上传日历：每个事件一个对象，重复上传只更新"""
+    print("\n测试CalDAV客户端...")
+    
+    from datetime import datetime
+    from calendar_generator import Parser, Writer
+    from caldav_client import CalDAVClient, CalDAVError, split_calendar
+    from benchmark import make_sample_html
+    
+    ics_content = ''.join(Writer(Parser(make_sample_html()).parse(), datetime(2025, 9, 8)).iter_ics())
+    objects = split_calendar(ics_content)
+    assert len(objects) == ics_content.count('BEGIN:VEVENT') and len({uid for uid, _ in objects}) == len(objects)
+    assert all(body.count('BEGIN:VEVENT') == 1 and body.endswith('END:VCALENDAR\r\n') for _, body in objects)
+    
+    server = CalDAVStandIn('secret')
+    try:
+        client = CalDAVClient(server.url, workers=4, retries=0)
+        result = client.upload_calendar('alice', 'secret', '课表', ics_content)
+        assert result == {'events': len(objects), 'created': len(objects), 'updated': 0}
+        assert server.collections == {'/alice/%E8%AF%BE%E8%A1%A8/'}
+        assert len(server.objects) == len(objects)
+        
+        # 日历已存在时继续写入
+        assert client.upload_calendar('alice', 'secret', '课表', ics_content)['updated'] == len(objects)
+        
+        try:
+            client.upload_calendar('alice', 'wrong', '课表', ics_content)
+            assert False, "认证失败时应抛出异常"
+        except CalDAVError:
+            pass
+    finally:
+        server.close()
+    
+    print("✅ CalDAV客户端测试通过")
+
+def test_radicale_collection():
+    """测试直接写入Radicale集合：每个事件一个文件，未变化的课表重复上传不改动任何文件"""
+    print("\n测试Radicale日历集合...")
+    
+    import os
+    import json
+    import tempfile
+    from datetime import datetime
+    from calendar_generator import Parser, Writer
+    from caldav_client import CalDAVClient
+    from caldav_integration import RadicaleIntegration
+    
+    courses = Parser(TEST_HTML).parse()
+    render = lambda data: ''.join(Writer(data, datetime(2025, 9, 8)).iter_ics())
+    
+    with tempfile.TemporaryDirectory() as root:
+        integration = RadicaleIntegration(root, upload_mode='filesystem', data_path=os.path.join(root, 'data'))
+        collection = integration.collection_path('alice', '课表')
+        assert collection == os.path.join(root, 'data', 'collection-root', 'alice', '课表')
+        
+        assert integration.write_collection('alice', '课表', render(courses)) == \
+            {'added': 2, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+        with open(os.path.join(collection, '.Radicale.props'), encoding='utf-8') as f:
+            assert json.load(f)['tag'] == 'VCALENDAR'
+        items = sorted(name for name in os.listdir(collection) if not name.startswith('.'))
+        mtimes = {name: os.stat(os.path.join(collection, name)).st_mtime_ns for name in items}
+        
+        # 重复上传：不改动任何事件
+        assert integration.write_collection('alice', '课表', render(courses)) == \
+            {'added': 0, 'updated': 0, 'unchanged': 2, 'deleted': 0}
+        assert {name: os.stat(os.path.join(collection, name)).st_mtime_ns for name in items} == mtimes
+        
+        # 换教室只改动一个事件，删掉的课程对应的文件被删除
+        moved = [dict(courses[0], location='逸夫教学楼 YF101')]
+        assert integration.write_collection('alice', '课表', render(moved)) == \
+            {'added': 0, 'updated': 1, 'unchanged': 0, 'deleted': 1}
+        
+        assert integration.upload_calendar('alice', '课表', render(courses))
+    
+        # HTTP 方式同样按已写入的事件比较：重复上传不发出任何 PUT/DELETE，已取消的事件被删除
+        server = CalDAVStandIn('secret')
+        try:
+            http = RadicaleIntegration(os.path.join(root, 'http'), upload_mode='http')
+            http.caldav_client = CalDAVClient(server.url, workers=1, retries=0)
+            assert http.upload_calendar('alice', '课表', render(courses), 'secret')
+            assert len(server.objects) == 2
+            
+            server.requests.clear()
+            assert http.upload_calendar('alice', '课表', render(courses), 'secret')
+            assert not [method for method, _ in server.requests if method in ('PUT', 'DELETE')]
+            
+            server.requests.clear()
+            assert http.upload_calendar('alice', '课表', render(moved), 'secret')
+            assert sorted(method for method, _ in server.requests) == ['DELETE', 'PUT']
+            assert len(server.objects) == 1
+        finally:
+            server.close()
+    
+    print("✅ Radicale日历集合测试通过")
+
+def test_caldav_update():
+    """测试增量更新CalDAV日历：按课程号、班号、星期、节次比较，只写入变化的事件"""
+    print("\n测试CalDAV日历增量更新...")
+    
+    import io
+    import os
+    import tempfile
+    from datetime import date, datetime
+    from unittest import mock
+    from concurrent.futures import ThreadPoolExecutor
+    import app as app_module
+    from calendar_generator import Parser, Writer
+    from caldav_client import CalDAVClient, CalDAVError
+    from caldav_integration import RadicaleIntegration
+    from credential_pool import CredentialPool
+    
+    courses = Parser(TEST_HTML).parse_courses()
+    objects = lambda data: [
+        (uid, body, {'course_id': course.course_id, 'lesson': course.lesson})
+        for uid, course, body in Writer(data, datetime(2025, 9, 8)).iter_objects()
+    ]
+    
+    with tempfile.TemporaryDirectory() as root:
+        integration = RadicaleIntegration(root, upload_mode='filesystem', data_path=os.path.join(root, 'data'))
+        collection = integration.collection_path('alice', '课表')
+        
+        diff = integration.sync_calendar('alice', 'secret', '课表', objects(courses))
+        assert len(diff['added']) == 2 and not diff['modified'] and not diff['deleted']
+        assert len(os.listdir(collection)) == 3  # 两个事件 + .Radicale.props
+        
+        # 没有变化：不写入任何文件
+        mtimes = {name: os.stat(os.path.join(collection, name)).st_mtime_ns for name in os.listdir(collection)}
+        diff = integration.sync_calendar('alice', 'secret', '课表', objects(courses))
+        assert diff == {'added': [], 'modified': [], 'deleted': [], 'unverified': [], 'unchanged': 2}
+        assert {name: os.stat(os.path.join(collection, name)).st_mtime_ns for name in os.listdir(collection)} == mtimes
+        
+        # 换教室、删一门课
+        from dataclasses import replace
+        moved = [replace(courses[0], location='逸夫教学楼 YF101')]
+        diff = integration.sync_calendar('alice', 'secret', '课表', objects(moved))
+        assert [item['course_id'] for item in diff['modified']] == [courses[0].course_id]
+        assert [item['lesson'] for item in diff['deleted']] == [courses[1].lesson]
+        assert diff['unchanged'] == 0
+        assert len(os.listdir(collection)) == 2
+        
+        # 状态丢失时以集合中现有的事件为准
+        fresh = RadicaleIntegration(os.path.join(root, 'other'), upload_mode='filesystem',
+                                    data_path=os.path.join(root, 'data'))
+        diff = fresh.sync_calendar('alice', 'secret', '课表', objects(courses))
+        assert len(diff['added']) == 1 and len(diff['modified']) == 1 and diff['unchanged'] == 0
+        assert fresh.sync_calendar('alice', 'secret', '课表', objects(courses))['unchanged'] == 2
+        
+        # 校验排队超时：取消等待并抛出 TimeoutError
+        import threading
+        with ThreadPoolExecutor(max_workers=1) as busy:
+            release = threading.Event()
+            busy.submit(release.wait)
+            try:
+                CredentialPool(size=0, executor=busy).verify('secret', 'hash', timeout=0.01)
+                assert False, "应超时"
+            except TimeoutError:
+                pass
+            finally:
+                release.set()
+        
+        # 接口：校验密码后更新
+        executor = ThreadPoolExecutor(max_workers=1)
+        pool = CredentialPool(size=0, rounds=4, executor=executor)
+        integration.user_store.add('alice', pool.hash('secret'))
+        with executor, mock.patch.object(app_module, 'radicale_integration', integration), \
+                mock.patch.object(app_module, 'credential_pool', pool), \
+                app_module.app.test_client() as client:
+            upload = lambda password: client.post('/api/caldav/update', data={
+                'username': 'alice', 'password': password,
+                'file': (io.BytesIO(TEST_HTML.encode('utf-8')), 'schedule.html'),
+            }, content_type='multipart/form-data')
+            assert upload('wrong').status_code == 401
+            response = upload('secret')
+            assert response.status_code == 200 and response.get_json()['success']
+            assert not response.get_json()['diff']['deleted']
+            
+            # 进程池繁忙、校验超时：返回 503，不无限等待
+            with mock.patch.object(pool, 'verify', side_effect=TimeoutError("busy")):
+                response = upload('secret')
+                assert response.status_code == 503 and response.headers['Retry-After'] == '5'
+            
+            # 密码错误次数过多：不再校验（不占用进程池），返回 429
+            from credential_pool import LoginThrottle
+            with mock.patch.object(app_module, 'login_throttle', LoginThrottle(max_failures=2, window=60)):
+                assert upload('wrong').status_code == 401 and upload('wrong').status_code == 401
+                with mock.patch.object(pool, 'verify', side_effect=AssertionError("不应校验")):
+                    response = upload('secret')
+                assert response.status_code == 429 and 0 < int(response.headers['Retry-After']) <= 61
+            # 同一个课表再次上传没有任何变化
+            assert upload('secret').get_json()['diff'] == \
+                {'added': [], 'modified': [], 'deleted': [], 'unverified': [], 'unchanged': 2}
+            
+            # 更新时沿用第一次写入时记录的学期开始日期，默认学期变化（如跨过9月）后不会改动所有事件
+            recorded = integration.calendar_state.semester_start('alice', '课表')
+            assert recorded is not None
+            next_year = datetime(recorded.year + 1, 9, 7)
+            with mock.patch('calendar_generator.BJTUCalendarGenerator._get_default_semester_start', return_value=next_year):
+                response = upload('secret').get_json()
+                assert response['semester_start'] == recorded.isoformat() and response['diff']['unchanged'] == 2
+                # 也可以明确指定
+                response = client.post('/api/caldav/update', data={
+                    'username': 'alice', 'password': 'secret', 'semester_start': '2030-09-02',
+                    'file': (io.BytesIO(TEST_HTML.encode('utf-8')), 'schedule.html'),
+                }, content_type='multipart/form-data').get_json()
+                assert len(response['diff']['modified']) == 2
+                assert integration.calendar_state.semester_start('alice', '课表') == date(2030, 9, 2)
+            
+            # 创建账户时记录生成ICS文件时的学期开始日期，而不是创建时的默认值（文件可能是之前生成的缓存）
+            generator = 'calendar_generator.BJTUCalendarGenerator._get_default_semester_start'
+            with mock.patch(generator, return_value=datetime(2025, 9, 8)):
+                html = TEST_HTML.replace('</table>', '<!-- caldav-create --></table>')
+                ics_file = client.post('/api/upload', data={'file': (io.BytesIO(html.encode('utf-8')), 't.html')},
+                                       content_type='multipart/form-data').get_json()['ics_file']
+            with mock.patch(generator, return_value=datetime(2026, 9, 7)):
+                response = client.post('/api/caldav/create', json={'ics_file': ics_file})
+                assert response.status_code == 200, response.get_json()
+            created = response.get_json()['caldav_account']['username']
+            assert integration.calendar_state.semester_start(created, '课表') == date(2025, 9, 8)
+        
+        # HTTP 方式、没有记录状态：读回已有事件的内容比较，服务器改写过格式的事件也算未变化
+        server = CalDAVStandIn('secret')
+        try:
+            http = RadicaleIntegration(os.path.join(root, 'http'), upload_mode='http')
+            http.caldav_client = CalDAVClient(server.url, workers=1, retries=0)
+            http.caldav_client.make_calendar('alice', 'secret', '课表')
+            for uid, body, _ in objects(courses):
+                http.caldav_client.put_object('alice', 'secret', '课表', uid, body)
+            for path, body in server.objects.items():
+                server.objects[path] = body.replace('BEGIN:VEVENT\r\n', 'BEGIN:VEVENT\r\nDTSTAMP:20250101T000000Z\r\n')
+            server.requests.clear()
+            diff = http.sync_calendar('alice', 'secret', '课表', objects(courses[:1]))
+            assert diff['unchanged'] == 1 and not diff['modified'] and not diff['unverified'] and len(diff['deleted']) == 1
+            assert [method for method, _ in server.requests] == ['REPORT', 'MKCALENDAR', 'DELETE']
+            
+            # 服务器不支持 REPORT 时不能确定是否变化：报告为 unverified 并重新写入，而不是当作修改
+            fallback = RadicaleIntegration(os.path.join(root, 'http2'), upload_mode='http')
+            fallback.caldav_client = http.caldav_client
+            with mock.patch.object(CalDAVClient, 'fetch_objects', side_effect=CalDAVError('HTTP 405')):
+                diff = fallback.sync_calendar('alice', 'secret', '课表', objects(courses))
+            assert len(diff['unverified']) == 1 and len(diff['added']) == 1 and not diff['modified']
+        finally:
+            server.close()
+    
+    print("✅ CalDAV日历增量更新测试通过")
+
 def test_flask_app():
     """测试Flask应用"""
     print("\n测试Flask应用...")
@@ -123,5 +1540,30 @@ def test_flask_app():
 if __name__ == '__main__':
     print("开始测试...")
     test_calendar_generator()
+    test_generate_from_memory()
+    test_parser_engines()
+    test_course_model()
+    test_synthetic_timetable()
+    test_native_serializer()
+    test_slot_table()
+    test_occurrences()
+    test_week_rules()
+    test_lesson_blocks()
+    test_free_slots()
+    test_section_index()
+    test_batch_convert()
+    test_result_cache()
+    test_artifact_store()
+    test_calendar_feed()
+    test_compressed_responses()
+    test_inline_upload()
+    test_metrics()
+    test_profiling()
+    test_jobs()
+    test_user_store()
+    test_credential_pool()
+    test_caldav_client()
+    test_radicale_collection()
+    test_caldav_update()
     test_flask_app()
     print("\n测试完成！")
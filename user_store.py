@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Radicale htpasswd 用户文件
+
+新用户以追加一行的方式写入，多个 gunicorn worker 通过文件锁（users.lock）互斥；
+每个进程缓存 用户名 -> 哈希 的索引，文件的 inode、大小或修改时间变化时才重新读取，
+文件只增长时只读取新增的部分。
+
+删除用户或修改已有用户的密码需要去掉旧的行：Radicale 只要任意一行的用户名和密码匹配就允许登录，
+追加"删除标记"无法让旧密码失效，所以这两种操作在锁内重写整个文件（写临时文件后原子改名）。
+compact() 同样通过重写去掉同一用户的重复行（例如手工编辑留下的）。
+"""
+
+import os
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+class HtpasswdUserStore:
+    """htpasswd 用户文件：追加写入 + 文件锁 + 进程内索引"""
+
+    def __init__(self, path: str, fsync: bool = True):
+        """
+        :param path: htpasswd 文件路径
+        :param fsync: 写入后是否 fsync，保证返回成功的用户不会因断电丢失
+        """
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.fsync = fsync
+        self._thread_lock = threading.Lock()
+        self._index = {}  # 用户名 -> 哈希
+        self._lines = 0  # 已读取的有效行数（含同一用户的重复行），用于判断是否需要压缩
+        self._offset = 0  # 已读取到的字节位置
+        self._signature = None  # (st_dev, st_ino, st_mtime_ns)
+
+    def get(self, username: str) -> Optional[str]:
+        """用户的密码哈希，不存在时返回 None"""
+        with self._thread_lock:
+            self._refresh()
+            return self._index.get(username)
+
+    def __contains__(self, username: str) -> bool:
+        return self.get(username) is not None
+
+    def __len__(self) -> int:
+        with self._thread_lock:
+            self._refresh()
+            return len(self._index)
+
+    def users(self) -> Dict[str, str]:
+        """全部用户（副本）"""
+        with self._thread_lock:
+            self._refresh()
+            return dict(self._index)
+
+    def add(self, username: str, password_hash: str) -> None:
+        """添加用户；用户已存在时替换密码（需要重写文件）"""
+        self._check_entry(username, password_hash)
+        with self._locked():
+            self._refresh()
+            if username in self._index:
+                users = dict(self._index)
+                users[username] = password_hash
+                self._rewrite(users)
+            else:
+                self._append(f"{username}:{password_hash}\n")
+                self._index[username] = password_hash
+
+    def delete(self, username: str) -> bool:
+        """删除用户，用户不存在时返回 False"""
+        with self._locked():
+            self._refresh()
+            if username not in self._index:
+                return False
+            users = dict(self._index)
+            del users[username]
+            self._rewrite(users)
+            return True
+
+    def compact(self) -> int:
+        """去掉同一用户的重复行，返回删除的行数"""
+        with self._locked():
+            self._refresh()
+            removed = self._lines - len(self._index)
+            if removed > 0:
+                self._rewrite(dict(self._index))
+            return removed
+
+    @staticmethod
+    def _check_entry(username: str, password_hash: str) -> None:
+        for value in (username, password_hash):
+            if not value or '\n' in value or '\r' in value:
+                raise ValueError("用户名和密码哈希不能为空或包含换行")
+        if ':' in username:
+            raise ValueError("用户名不能包含冒号")
+
+    @contextmanager
+    def _locked(self):
+        """进程内线程锁 + 跨进程文件锁（锁单独的文件，数据文件会被原子替换）"""
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            directory = os.path.dirname(self.lock_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self) -> None:
+        """文件变化时更新索引：只追加时读取新增部分，否则全部重新读取"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._index, self._lines, self._offset, self._signature = {}, 0, 0, None
+            return
+
+        signature = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        if signature == self._signature and st.st_size == self._offset:
+            return
+
+        # 同一个文件且变长了，说明只有追加；其他变化（被替换、被修改）都全部重新读取
+        appended = self._signature is not None and self._signature[:2] == signature[:2] and st.st_size > self._offset
+        if not appended:
+            self._index, self._lines, self._offset = {}, 0, 0
+
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        # 只处理完整的行，写了一半的行留到下次读取
+        end = data.rfind(b'\n') + 1
+        for username, password_hash in _parse_lines(data[:end]):
+            self._index[username] = password_hash
+            self._lines += 1
+        self._offset += end
+        self._signature = signature
+
+    def _append(self, line: str) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # O_APPEND 保证每次写入都在文件末尾，整行一次写入
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _rewrite(self, users: Dict[str, str]) -> None:
+        """写入临时文件后原子替换"""
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for username, password_hash in users.items():
+                    f.write(f"{username}:{password_hash}\n")
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            if os.path.exists(self.path):
+                os.chmod(tmp_path, os.stat(self.path).st_mode & 0o777)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # 下次访问时重新读取
+        self._signature = None
+
+def _parse_lines(data: bytes) -> Iterator[Tuple[str, str]]:
+    """解析 htpasswd 内容，跳过空行、注释和无效行"""
+    for raw in data.decode('utf-8', errors='replace').splitlines():
+        line = raw.strip()
+        if not line or line.startswith('#') or ':' not in line:
+            continue
+        username, password_hash = line.split(':', 1)
+        yield username, password_hash
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上课周集合 -> 重复规则
+
+连续周、等差周可以直接写成一条 FREQ=WEEKLY;INTERVAL=k;COUNT=n，不规则的周集合（如第1-4、6、9-16周）
+拆成若干段等差序列，每段一个 VEVENT；个别多出的周用第一个事件的 RDATE 补上，
+等差序列中缺的周（包括节假日）用 EXDATE 去掉。
+
+decompose_weeks() 在所有拆法中选总字节数最少的：一个 VEVENT 约 EVENT_COST 字节，
+一个 RDATE/EXDATE 值约 DATE_COST 字节。从最早的一周开始，它要么是一段等差序列的第一周（DTSTART），
+要么作为 RDATE 附在第一个事件上；对剩余的周递归，结果按周集合缓存（同一种周集合在所有课表中反复出现）。
+周数超过 SEARCH_MAX_WEEKS 或搜索超出 SEARCH_BUDGET 时改用贪心拆分，单门课的耗时有上限。
+"""
+
+import threading
+from collections import namedtuple
+from functools import lru_cache
+from typing import List, Tuple
+
+from course_model import first_week_of, last_week_of, mask_interval, mask_to_weeks, progression_mask
+
+# 一个 VEVENT 的大致字节数（UID、时间、标题、地点、重复规则）
+EVENT_COST = 300
+# 一个 RDATE/EXDATE 值的字节数（如 "20251006T000000Z,"）
+DATE_COST = 17
+
+# 周集合超过这个周数时不做完整搜索，按最长等差段贪心拆分
+SEARCH_MAX_WEEKS = 20
+
+# 一次完整搜索最多考察的候选等差段数，超出时同样改用贪心拆分（周数不多但分布很散的集合），
+# 保证单门课的拆分在几毫秒内完成
+SEARCH_BUDGET = 20000
+
+# 一段等差序列：第 start 周起每 interval 周一次共 count 次，去掉 exdates 中的周，再加上 rdates 中的周
+WeekRun = namedtuple("WeekRun", ["start", "interval", "count", "rdates", "exdates"])
+
+class SearchBudgetExceeded(Exception):
+    """完整搜索考察的候选超过 SEARCH_BUDGET"""
+
+# 当前线程本次搜索剩余的候选数
+_budget = threading.local()
+
+def _spend() -> None:
+    """考察一个候选，预算用完时中止搜索（已缓存的结果都是完整的，不受影响）"""
+    _budget.left -= 1
+    if _budget.left < 0:
+        raise SearchBudgetExceeded()
+
+def run_mask(run: WeekRun) -> int:
+    """一段规则实际上课的周位图"""
+    mask = progression_mask(run.start, run.interval, run.count)
+    for week in run.exdates:
+        mask &= ~(1 << week)
+    for week in run.rdates:
+        mask |= 1 << week
+    return mask
+
+def plan_cost(runs: List[WeekRun]) -> int:
+    """一种拆法的大致字节数"""
+    return sum(EVENT_COST + DATE_COST * (len(run.rdates) + len(run.exdates)) for run in runs)
+
+def _candidate_runs(mask: int, start: int):
+    """以第 start 周开始、以 mask 中某一周结束的等差序列，产出 (间隔, 次数, 覆盖的位图)"""
+    last = last_week_of(mask)
+    yield 1, 1, 1 << start
+    for interval in range(1, last - start + 1):
+        covered = 1 << start
+        count = 1
+        week = start + interval
+        while week <= last:
+            covered |= 1 << week
+            count += 1
+            if mask >> week & 1:
+                yield interval, count, covered
+            week += interval
+
+@lru_cache(maxsize=8192)
+def _rest(mask: int) -> Tuple[int, Tuple[Tuple[int, int, int, int], ...], Tuple[int, ...]]:
+    """
+    第一个事件之后剩余的周：逐周作为 RDATE，或者开始新的等差段
+    新的一段覆盖的周用 RDATE 表示不会更贵时不必考虑，因此剩余周数不超过 EVENT_COST / DATE_COST 时全部用 RDATE
+    :return: (字节数, ((start, interval, count, 需要排除的位图), ...), RDATE 的周)
+    """
+    weeks = mask.bit_count()
+    best = (DATE_COST * weeks, (), tuple(mask_to_weeks(mask)))
+    if DATE_COST * weeks <= EVENT_COST:
+        return best
+
+    start = first_week_of(mask)
+    cost, runs, rdates = _rest(mask & ~(1 << start))
+    if cost + DATE_COST < best[0]:
+        best = (cost + DATE_COST, runs, (start,) + rdates)
+    for interval, count, covered in _candidate_runs(mask, start):
+        _spend()
+        holes = covered & ~mask
+        hole_cost = DATE_COST * holes.bit_count()
+        if DATE_COST * (covered & mask).bit_count() <= EVENT_COST + hole_cost:
+            continue
+        cost, runs, rdates = _rest(mask & ~covered)
+        cost += EVENT_COST + hole_cost
+        if cost < best[0]:
+            best = (cost, ((start, interval, count, holes),) + runs, rdates)
+    return best
+
+def _greedy(mask: int) -> List[WeekRun]:
+    """
+    周数很多时的近似拆法：每次取从最早一周开始、上课周数减缺的周数最多的等差段，缺的周用 EXDATE 排除；
+    这一段不比逐周 RDATE 便宜时，最早的一周作为第一个事件的 RDATE
+    """
+    runs = []
+    rdates = []
+    while mask:
+        start = first_week_of(mask)
+        interval, count, covered = max(
+            _candidate_runs(mask, start),
+            key=lambda item: (item[2] & mask).bit_count() - (item[2] & ~mask).bit_count(),
+        )
+        holes = covered & ~mask
+        if runs and DATE_COST * (covered & mask).bit_count() <= EVENT_COST + DATE_COST * holes.bit_count():
+            rdates.append(start)
+            mask &= ~(1 << start)
+            continue
+        # 缺的周可能已由前面的段覆盖，同样排除，各段实际上课的周不会重复
+        runs.append(WeekRun(start, interval, count, (), tuple(mask_to_weeks(holes))))
+        mask &= ~covered
+    runs[0] = runs[0]._replace(rdates=tuple(rdates))
+    return runs
+
+def _search(mask: int):
+    """完整搜索，返回 (字节数, ((start, interval, count, 需要排除的位图), ...), RDATE 的周)"""
+    # 最早的一周必须是第一个事件的 DTSTART
+    start = first_week_of(mask)
+    best = None
+    for interval, count, covered in _candidate_runs(mask, start):
+        _spend()
+        holes = covered & ~mask
+        cost, runs, rdates = _rest(mask & ~covered)
+        cost += EVENT_COST + DATE_COST * holes.bit_count()
+        if best is None or cost < best[0]:
+            best = (cost, ((start, interval, count, holes),) + runs, rdates)
+    return best
+
+def decompose_weeks(mask: int) -> List[WeekRun]:
+    """
+    把周位图拆成字节数最少的一组 WeekRun，按开始周排序，RDATE 都附在第一个上
+    所有 WeekRun 的实际上课周合起来恰好是 mask，且互不重复
+    """
+    if not mask:
+        return []
+    interval = mask_interval(mask)
+    if interval is not None:
+        return [WeekRun(first_week_of(mask), interval, mask.bit_count(), (), ())]
+    if mask.bit_count() > SEARCH_MAX_WEEKS:
+        return _greedy(mask)
+
+    _budget.left = SEARCH_BUDGET
+    try:
+        _, runs, rdates = _search(mask)
+    except SearchBudgetExceeded:
+        return _greedy(mask)
+    result = [
+        WeekRun(start, interval, count, (), tuple(mask_to_weeks(holes)))
+        for start, interval, count, holes in runs
+    ]
+    result[0] = result[0]._replace(rdates=tuple(sorted(rdates)))
+    return result